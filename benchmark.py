@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+"""
+VoiceWriter Benchmarks - measure the server with a fake typing backend
+"""
+
+import argparse
+import array
+import collections
+import contextlib
+import http.client
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import voicewriter
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def start_server(mode, backend=None):
+    """Start a VoiceWriter server on a free local port in a background thread"""
+    backend = backend or voicewriter.FakeBackend()
+    httpd = voicewriter.create_server(mode, ('127.0.0.1', 0), backend)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def stop_server(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+def post_burst(port, texts, latencies, errors):
+    """POST texts back to back, reusing the connection whenever the server allows it"""
+    conn = None
+    for text in texts:
+        body = json.dumps({'text': text}).encode()
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('POST', '/type', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn = None
+            continue
+        latencies.append(time.perf_counter() - start)
+    if conn:
+        conn.close()
+
+def run_http_burst(mode, clients, requests_per_client):
+    """Fire bursts of dictation from several clients at once and collect latencies"""
+    httpd = start_server(mode)
+    port = httpd.server_address[1]
+    latencies = []
+    errors = []
+    threads = []
+    for c in range(clients):
+        texts = [f"client {c} says sentence number {i} right now" for i in range(requests_per_client)]
+        threads.append(threading.Thread(target=post_burst, args=(port, texts, latencies, errors)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop_server(httpd)
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'elapsed': elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0) * 1000,
+    }
+
+def bench_http(args):
+    """Compare per-request latency of the server modes under burst dictation"""
+    # Measure the HTTP layer, not the typing rate limit
+    settings = voicewriter.settings
+    voicewriter.settings = settings._replace(typing=settings.typing._replace(min_interval=0))
+    print(f"📊 HTTP burst: {args.clients} clients x {args.requests} requests")
+    results = []
+    for mode in args.modes:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            result = run_http_burst(mode, args.clients, args.requests)
+        results.append(result)
+        print(f"  {mode:9} p50 {result['p50_ms']:6.2f} ms  p95 {result['p95_ms']:6.2f} ms  "
+              f"p99 {result['p99_ms']:6.2f} ms  max {result['max_ms']:6.2f} ms  "
+              f"errors {result['errors']}  total {result['elapsed']:.2f}s")
+    return results
+
+SAMPLE_TRANSCRIPTS = [
+    "hello world how are you doing today",
+    "please send the report to the team comma and copy me question mark",
+    "first item new line second item new line third item",
+    "caps on important caps off read this before the meeting period",
+    "thank you",
+    "the quick brown fox jumps over the lazy dog and keeps running far away",
+]
+
+def bench_commands(args):
+    """Per-utterance cost of the command engine as the rule set grows"""
+    print(f"📊 Command engine: {len(SAMPLE_TRANSCRIPTS)} transcripts x {args.iterations} iterations")
+    results = []
+    for size in args.sizes:
+        commands = dict(voicewriter.DEFAULT_COMMANDS)
+        for i in range(max(0, size - len(commands))):
+            commands[f"macro {i} insert"] = f"<snippet {i}>"
+        engine = voicewriter.CommandEngine(commands)
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            for text in SAMPLE_TRANSCRIPTS:
+                engine.process(text, voicewriter.CommandState())
+        per_utterance = (time.perf_counter() - start) / (args.iterations * len(SAMPLE_TRANSCRIPTS))
+        results.append({'rules': len(commands), 'us_per_utterance': per_utterance * 1e6})
+        print(f"  {len(commands):6} rules  {per_utterance * 1e6:7.2f} µs/utterance")
+    return results
+
+def synthetic_vocabulary(size, seed=1):
+    """Random multi-word phrases with replacements, like a large jargon list"""
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    entries = {}
+    while len(entries) < size:
+        words = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 8)))
+                 for _ in range(rng.randint(1, 3))]
+        entries[' '.join(words)] = f"<{len(entries)}>"
+    return list(entries.items())
+
+def bench_vocabulary(args):
+    """Vocabulary build, cached load and per-transcript cost as the entry count grows"""
+    print(f"📊 Vocabulary: {len(SAMPLE_TRANSCRIPTS)} transcripts x {args.iterations} iterations")
+    results = []
+    for size in args.sizes:
+        entries = synthetic_vocabulary(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'vocabulary.txt')
+            with open(path, 'w') as f:
+                f.writelines(f"{phrase} => {replacement}\n" for phrase, replacement in entries)
+            start = time.perf_counter()
+            voicewriter.Vocabulary.load(path, tmp)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            vocabulary = voicewriter.Vocabulary.load(path, tmp)
+            cached = time.perf_counter() - start
+        # Make sure some phrases actually match
+        texts = SAMPLE_TRANSCRIPTS + [f"{entries[0][0]} and {entries[-1][0]} in one line"]
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            for text in texts:
+                vocabulary.apply(text)
+        per_text = (time.perf_counter() - start) / (args.iterations * len(texts))
+        results.append({'entries': size, 'build_ms': build * 1000, 'cached_load_ms': cached * 1000,
+                        'us_per_transcript': per_text * 1e6})
+        print(f"  {size:7} entries  build {build * 1000:8.1f} ms  cached load {cached * 1000:7.1f} ms  "
+              f"{per_text * 1e6:6.2f} µs/transcript")
+    return results
+
+def synthetic_stream(count, duplicate_rate=0.0, seed=1):
+    """Dictation-like transcripts; a share of them repeat the previous one, as recognizers do"""
+    rng = random.Random(seed)
+    stream = []
+    for i in range(count):
+        if stream and rng.random() < duplicate_rate:
+            stream.append(stream[-1])
+        else:
+            stream.append(f"{rng.choice(SAMPLE_TRANSCRIPTS)} number {i}")
+    return stream
+
+def journal_entry(record):
+    """What to send for one journal record: its raw transcript, or the undo it ran"""
+    if record.get('raw') is None:
+        return voicewriter.UndoAction(record.get('count', 1))
+    if 'utterance' in record:
+        return {'text': record['raw'], 'utterance': record['utterance'], 'final': True}
+    return record['raw']
+
+def load_stream(path):
+    """A recorded stream: one transcript per line, or JSON lines (a "text" field, or journal records)"""
+    stream = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                stream.append(journal_entry(record) if 'raw' in record else record.get('text', ''))
+            else:
+                stream.append(line)
+    return stream
+
+def journal_stream(paths):
+    """The transcripts and undos of journal files, each with its arrival time after the first"""
+    records = [record for record in voicewriter.read_journal(paths) if 'seq' in record]
+    arrivals = [record['ts'] - record.get('latency', 0) for record in records]
+    first = min(arrivals, default=0)
+    return records, [journal_entry(record) for record in records], [arrived - first for arrived in arrivals]
+
+def entry_text(entry):
+    return entry['text'] if isinstance(entry, dict) else entry
+
+def expected_output(entries):
+    """What the pipeline should put on screen for transcripts and undos typed in this order"""
+    backend = voicewriter.FakeBackend()
+    state = voicewriter.CommandState()
+    units = collections.deque()
+    for entry in entries:
+        if isinstance(entry, voicewriter.UndoAction):
+            ops = [entry]
+        else:
+            ops = voicewriter.process_ops(entry_text(entry), state)
+        ops, undone = voicewriter.resolve_undo(ops, units)
+        voicewriter.type_ops(backend, ops)
+    return backend.text
+
+def paced_client(port, stream, schedule, start, sent, results, lock, host='127.0.0.1', session=None):
+    """POST a stream to /type (undos to /undo), each entry at its offset in `schedule`
+
+    With a `session` the transcripts are numbered like the page numbers them.
+    """
+    conn = None
+    for n, (entry, offset) in enumerate(zip(stream, schedule), 1):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if isinstance(entry, voicewriter.UndoAction):
+            path, payload = '/undo', {'count': entry.count}
+        else:
+            path, payload = '/type', entry if isinstance(entry, dict) else {'text': entry}
+            if session:
+                payload = dict(payload, n=n)
+        if session:
+            payload = dict(payload, session=session)
+        body = json.dumps(payload).encode()
+        began = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(host, port, timeout=10)
+            conn.request('POST', path, body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            reply = json.loads(response.read() or b'{}')
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            reply = {'status': 'error', 'message': str(e)}
+            conn = None
+        answered = time.perf_counter()
+        with lock:
+            if 'seq' in reply:
+                sent[reply['seq']] = (entry, began)
+            results.append((reply.get('status'), reply.get('message'), answered - began))
+    if conn:
+        conn.close()
+
+def drive_clients(port, streams, schedules, host='127.0.0.1'):
+    """Run one paced client (and session) per stream; returns {seq: (entry, sent at)}, replies and the start time"""
+    sent = {}
+    results = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    run = f"bench-{random.getrandbits(32):08x}"  # New sessions even against a long-running server
+    threads = [threading.Thread(target=paced_client,
+                                args=(port, stream, schedule, start, sent, results, lock, host,
+                                      f"{run}-{index}"))
+               for index, (stream, schedule) in enumerate(zip(streams, schedules))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sent, results, start
+
+def run_load(mode, streams, schedules, rate=None):
+    """Replay one stream per client against /type and check what got typed"""
+    backend = voicewriter.FakeBackend()
+    httpd = start_server(mode, backend)
+    port = httpd.server_address[1]
+    typed_at = {}
+    states = {}
+    order = []  # Sessions take turns, so this is not sequence order
+    def on_typed(seq, state):
+        typed_at[seq] = time.perf_counter()
+        states[seq] = state
+        order.append(seq)
+    httpd.typing_queue.add_listener(on_typed)
+    sent, results, start = drive_clients(port, streams, schedules)
+    deadline = time.perf_counter() + 30
+    for seq in sorted(sent):
+        httpd.typing_queue.wait(seq, max(0, deadline - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+    stop_server(httpd)
+    
+    end_to_end = [typed_at[seq] - began for seq, (entry, began) in sent.items() if seq in typed_at]
+    typed = sum(1 for state in states.values() if state == 'typed')
+    expected = expected_output(sent[seq][0] for seq in order if seq in sent)
+    return {
+        'mode': mode,
+        'clients': len(streams),
+        'rate': rate,
+        'sent': len(results),
+        'queued': len(sent),
+        'typed': typed,
+        'duplicates': sum(1 for status, message, _ in results if message == 'Duplicate text'),
+        'skipped': sum(1 for status, _, _ in results if status == 'skipped'),
+        'dropped': len(results) - typed - sum(1 for status, _, _ in results if status == 'skipped'),
+        'correct': backend.text == expected,
+        'elapsed': elapsed,
+        'throughput': typed / elapsed if elapsed else 0.0,
+        'request_p50_ms': percentile([r[2] for r in results], 50) * 1000,
+        'request_p99_ms': percentile([r[2] for r in results], 99) * 1000,
+        'p50_ms': percentile(end_to_end, 50) * 1000,
+        'p95_ms': percentile(end_to_end, 95) * 1000,
+        'p99_ms': percentile(end_to_end, 99) * 1000,
+    }
+
+# Result fields compared against a baseline, and which direction is worse
+REGRESSION_CHECKS = {
+    'throughput': 'lower',
+    'p95_ms': 'higher',
+    'p99_ms': 'higher',
+    'dropped': 'higher',
+}
+
+def compare_results(results, baseline, tolerance):
+    """Describe every regression of results against a saved baseline"""
+    problems = []
+    previous = {(r['mode'], r['clients'], r['rate']): r for r in baseline.get('results', [])}
+    for result in results:
+        key = (result['mode'], result['clients'], result['rate'])
+        before = previous.get(key)
+        if before is None:
+            continue
+        label = f"{result['mode']} x{result['clients']} @{result['rate']}/s"
+        if not result['correct']:
+            problems.append(f"{label}: typed output does not match process_text")
+        for field, worse in REGRESSION_CHECKS.items():
+            old, new = before[field], result[field]
+            if field == 'dropped':
+                regressed = new > old
+            elif worse == 'lower':
+                regressed = new < old * (1 - tolerance)
+            else:
+                # Sub-millisecond latencies are noise, not regressions
+                regressed = new > old * (1 + tolerance) and new - old > 1.0
+            if regressed:
+                problems.append(f"{label}: {field} {old:.2f} -> {new:.2f}")
+    return problems
+
+def bench_load(args):
+    """Replay transcript streams at a paced rate from several clients; check latency, losses and output"""
+    settings = voicewriter.settings
+    voicewriter.settings = settings._replace(typing=settings.typing._replace(min_interval=args.min_interval))
+    if args.stream:
+        recorded = load_stream(args.stream)
+        streams = [recorded] * args.clients
+        source = args.stream
+    else:
+        # Distinct text per client so only deliberate repeats hit the dedup cache
+        streams = [[f"{text} from client {c}" for text in
+                    synthetic_stream(args.requests, args.duplicate_rate, seed=c)]
+                   for c in range(args.clients)]
+        source = 'synthetic'
+    print(f"📊 Load: {args.clients} clients x {len(streams[0])} transcripts at {args.rate}/s each ({source})")
+    results = []
+    for mode in args.modes:
+        schedules = [[i / args.rate if args.rate else 0.0 for i in range(len(stream))] for stream in streams]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            result = run_load(mode, streams, schedules, args.rate)
+        results.append(result)
+        print(f"  {mode:9} {result['throughput']:7.1f}/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p95 {result['p95_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+              f"dropped {result['dropped']}  duplicates {result['duplicates']}  "
+              f"{'correct' if result['correct'] else 'WRONG OUTPUT'}")
+    
+    report = {'source': source, 'requests': len(streams[0]), 'duplicate_rate': args.duplicate_rate,
+              'min_interval': args.min_interval, 'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Baseline saved to {args.save}")
+    failed = not all(result['correct'] for result in results)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            problems = compare_results(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if not problems:
+            print(f"✅ No regressions against {args.compare}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+def bench_replay(args):
+    """Feed journal files back into a server, at the pace they were dictated"""
+    records, stream, schedule = journal_stream(args.journal)
+    if not stream:
+        print("❌ No records in the journal")
+        return 1
+    schedule = [offset / args.speed for offset in schedule] if args.speed else [0.0] * len(stream)
+    print(f"📼 Replaying {len(stream)} records over {schedule[-1]:.1f}s")
+    if args.url:
+        # A live instance types into the focused window; only the requests can be measured
+        target = urllib.parse.urlsplit(args.url)
+        sent, results, start = drive_clients(target.port or 80, [stream], [schedule], target.hostname)
+        latencies = [seconds for _, _, seconds in results]
+        print(f"  {len(sent)} queued, {len(results) - len(sent)} not  "
+              f"request p50 {percentile(latencies, 50) * 1000:.2f} ms  "
+              f"p99 {percentile(latencies, 99) * 1000:.2f} ms")
+        return 0 if len(sent) == len(results) else 1
+    
+    # In process: journal the replay too, and compare it with the original
+    settings = voicewriter.settings
+    with tempfile.TemporaryDirectory() as directory:
+        replay_journal = os.path.join(directory, 'replay.jsonl')
+        # The journal holds what got through; the replay is one session, so lift its limit
+        voicewriter.settings = settings._replace(
+            typing=settings.typing._replace(min_interval=args.min_interval),
+            journal=settings.journal._replace(enabled=True, file=replay_journal),
+            sessions=settings.sessions._replace(max_pending=settings.typing.queue_size))
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            result = run_load(args.mode, [stream], [schedule])
+        replayed = voicewriter.read_journal([replay_journal])
+    voicewriter.settings = settings
+    
+    original = [record['text'] for record in records if record.get('state') == 'typed']
+    again = [record['text'] for record in replayed if record.get('state') == 'typed']
+    print(f"  {result['typed']} typed, {result['dropped']} dropped, {result['duplicates']} duplicates  "
+          f"p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+    print(f"  typed output {'matches' if result['correct'] else 'DOES NOT MATCH'} the pipeline; "
+          f"{'same' if original == again else 'DIFFERENT'} processed text as the journal")
+    return 0 if result['correct'] and original == again else 1
+
+def synthetic_speech(seconds, rate, seed=1):
+    """Utterances of voiced tones and fricative noise between quiet pauses; returns (PCM, utterances)"""
+    rng = random.Random(seed)
+    samples = array.array('h')
+    utterances = []
+    while len(samples) < seconds * rate:
+        for _ in range(int(rng.uniform(0.8, 2.5) * rate)):
+            samples.append(int(rng.gauss(0, 30)))
+        start = len(samples) / rate
+        for _ in range(rng.randint(1, 4)):
+            # A "word": a voiced vowel with harmonics, sometimes ending in an "s"
+            pitch = rng.uniform(100, 250)
+            for i in range(int(rng.uniform(0.15, 0.4) * rate)):
+                t = i / rate
+                samples.append(int(2500 * math.sin(2 * math.pi * pitch * t)
+                                   + 800 * math.sin(6 * math.pi * pitch * t) + rng.gauss(0, 100)))
+            if rng.random() < 0.4:
+                for _ in range(int(0.1 * rate)):
+                    samples.append(int(rng.gauss(0, 500)))
+            for _ in range(int(rng.uniform(0.05, 0.2) * rate)):
+                samples.append(int(rng.gauss(0, 30)))  # Gap between words, shorter than the hangover
+        utterances.append((start, len(samples) / rate))
+    return samples.tobytes(), utterances
+
+def bench_vad(args):
+    """Frames per second one core can classify and segment, with and without NumPy"""
+    rate = args.rate
+    audio, spoken = synthetic_speech(args.seconds, rate)
+    chunk = 2 * int(rate * args.chunk_ms / 1000)
+    duration = len(audio) / 2 / rate
+    print(f"📊 VAD: {duration:.0f}s of synthetic speech ({len(spoken)} utterances) at {rate} Hz, "
+          f"{args.chunk_ms} ms chunks")
+    variants = [('numpy', True), ('python', False)] if voicewriter.numpy is not None else [('python', False)]
+    for name, vectorized in variants:
+        vad = voicewriter.VoiceActivityDetector(rate, vectorized=vectorized)
+        segments = []
+        start = time.perf_counter()
+        for offset in range(0, len(audio), chunk):
+            segments.extend(vad.feed(audio[offset:offset + chunk]))
+        last = vad.finish()
+        elapsed = time.perf_counter() - start
+        if last:
+            segments.append(last)
+        frames = vad.position
+        sent = sum(segment.end - segment.start for segment in segments)
+        chunks = math.ceil(len(audio) / chunk)
+        print(f"  {name:7} {frames / elapsed:10.0f} frames/s  {duration / elapsed:6.0f} live streams per core  "
+              f"{elapsed / chunks * 1e6:7.1f} us per chunk  {len(segments)} utterances  "
+              f"{sent / duration:.0%} of the audio sent to the recognizer")
+    if voicewriter.numpy is None:
+        print("  (install numpy for the vectorized detector)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subcommands = parser.add_subparsers(dest='command')
+    subcommands.required = True
+
+    http_parser = subcommands.add_parser('http', help='server latency under burst dictation')
+    http_parser.add_argument('--clients', type=int, default=4)
+    http_parser.add_argument('--requests', type=int, default=50)
+    http_parser.add_argument('--modes', nargs='+', default=['single', 'threaded'],
+                             choices=sorted(voicewriter.SERVER_MODES))
+    http_parser.set_defaults(func=bench_http)
+
+    commands_parser = subcommands.add_parser('commands', help='command engine cost vs rule count')
+    commands_parser.add_argument('--sizes', type=int, nargs='+', default=[14, 100, 500, 5000])
+    commands_parser.add_argument('--iterations', type=int, default=2000)
+    commands_parser.set_defaults(func=bench_commands)
+
+    vocabulary_parser = subcommands.add_parser('vocabulary', help='vocabulary cost vs entry count')
+    vocabulary_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    vocabulary_parser.add_argument('--iterations', type=int, default=1000)
+    vocabulary_parser.set_defaults(func=bench_vocabulary)
+
+    load_parser = subcommands.add_parser('load', help='paced load against /type, with baselines')
+    load_parser.add_argument('--clients', type=int, default=4)
+    load_parser.add_argument('--requests', type=int, default=100, help='synthetic transcripts per client')
+    load_parser.add_argument('--rate', type=float, default=20.0, help='requests per second per client (0: no pacing)')
+    load_parser.add_argument('--stream', help='recorded transcripts to replay instead of synthetic ones')
+    load_parser.add_argument('--duplicate-rate', type=float, default=0.05)
+    load_parser.add_argument('--min-interval', type=float, default=0.0, help='typing.min_interval for the run')
+    load_parser.add_argument('--modes', nargs='+', default=['single', 'threaded'],
+                             choices=sorted(voicewriter.SERVER_MODES))
+    load_parser.add_argument('--save', help='write the results as a JSON baseline')
+    load_parser.add_argument('--compare', help='fail on regressions against a JSON baseline')
+    load_parser.add_argument('--tolerance', type=float, default=0.25)
+    load_parser.set_defaults(func=bench_load)
+
+    vad_parser = subcommands.add_parser('vad', help='voice activity detection throughput per core')
+    vad_parser.add_argument('--seconds', type=float, default=60.0)
+    vad_parser.add_argument('--rate', type=int, default=16000)
+    vad_parser.add_argument('--chunk-ms', type=int, default=100)
+    vad_parser.set_defaults(func=bench_vad)
+
+    replay_parser = subcommands.add_parser('replay', help='feed a transcript journal back into a server')
+    replay_parser.add_argument('journal', nargs='+', help='journal files, oldest first (journal.jsonl.1 journal.jsonl)')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='pace multiplier (0: as fast as possible)')
+    replay_parser.add_argument('--url', help='replay into a running instance (it will type!) instead of in process')
+    replay_parser.add_argument('--mode', default='threaded', choices=sorted(voicewriter.SERVER_MODES))
+    replay_parser.add_argument('--min-interval', type=float, default=0.1, help='typing.min_interval in process')
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    # Benchmarks never write to the user's journal
+    settings = voicewriter.settings
+    voicewriter.settings = settings._replace(journal=settings.journal._replace(enabled=False))
+    return args.func(args)
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status if isinstance(status, int) else 0)
@@ -0,0 +1,89 @@
+"""
+VoiceWriter control - the control socket and PID file of a running instance
+
+Standard library only, so stop.py can talk to the server without importing
+it (and its config, vocabulary and optional dependencies).
+"""
+
+import json
+import os
+import socket
+import stat
+import time
+
+# Per-user runtime files: the control socket and the PID file
+RUNTIME_DIR = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or f"/tmp/voicewriter-{os.getuid()}",
+                           'voicewriter')
+CONTROL_SOCKET = os.path.join(RUNTIME_DIR, 'control.sock')
+PID_FILE = os.path.join(RUNTIME_DIR, 'voicewriter.pid')
+
+def private_dir(path, create=True):
+    """Make sure `path` and its parent are directories only this user can enter (mode 0700).
+
+    The /tmp fallback for RUNTIME_DIR could otherwise be created ahead of
+    time by another user, who could then swap the control socket. Raises
+    PermissionError for a directory that is not ours or is open to others.
+    """
+    for directory in (os.path.dirname(path), path):
+        if create:
+            try:
+                os.mkdir(directory, 0o700)
+            except FileExistsError:
+                pass
+        info = os.lstat(directory)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+                or info.st_mode & 0o077):
+            raise PermissionError(f"{directory} must be a directory owned by you with mode 0700")
+
+def control_request(command, timeout=2.0, path=CONTROL_SOCKET):
+    """Send one command to the running instance; None if nothing is listening"""
+    try:
+        private_dir(os.path.dirname(path), create=False)  # Never talk to a socket someone else planted
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(command.encode() + b'\n')
+            reply = sock.makefile('rb').readline()
+    except OSError:
+        return None
+    try:
+        return json.loads(reply)
+    except ValueError:
+        return None
+
+def read_pid_file():
+    try:
+        with open(PID_FILE, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def stop_running_instance(timeout=3.0):
+    """Stop the running instance over the control socket and wait for it to exit.
+
+    Returns the stopped PID, or None if no instance answered.
+    """
+    reply = control_request('stop', timeout)
+    if not reply or reply.get('status') != 'stopping':
+        return None
+    pid = reply.get('pid')
+    deadline = time.time() + timeout
+    while process_alive(pid) and time.time() < deadline:
+        time.sleep(0.01)
+    return pid
+
+def process_alive(pid):
+    """True while a process exists and has not exited (a zombie counts as exited)"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # The state follows the parenthesised command name
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except (OSError, IndexError):
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -13,11 +13,11 @@ SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 if [ "$EUID" -eq 0 ]; then
     echo "Installing system dependencies..."
     apt update
-    apt install -y xdotool xclip
+    apt install -y xdotool xclip python3-xlib
     echo "✅ System dependencies installed"
 else
     echo "⚠️  Not running as root. You may need to install dependencies manually:"
-    echo "   sudo apt install xdotool xclip"
+    echo "   sudo apt install xdotool xclip python3-xlib"
 fi
 
 # Check dependencies
@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 """
 Stop VoiceWriter servers - Optimized
+
+Talks to the running instance over its control socket. Other commands are
+passed through: ./stop.py status | reload-config | flush
+
+./stop.py --legacy also looks for versions without a control socket by
+process name and port (pkill/lsof).
 """
 
 import subprocess
 import signal
 import os
+import sys
+import json
+import time
 
-def stop_voicewriter():
-    """Stop VoiceWriter servers efficiently"""
-    print("🛑 Stopping VoiceWriter...")
-    
+# Only the control module: importing the server would load its config and dependencies
+import control
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def configured_port(default=8000):
+    """server.port from config.json, read directly; the default if it cannot be read"""
+    try:
+        with open(os.path.join(SCRIPT_DIR, 'config.json'), 'r') as f:
+            port = json.load(f).get('server', {}).get('port', default)
+    except (OSError, ValueError, AttributeError):
+        return default
+    return port if isinstance(port, int) and not isinstance(port, bool) else default
+
+def legacy_stop(port):
+    """Stop VoiceWriter servers found by process name and port (instances without a control socket)"""
     stopped_processes = 0
     
     # Kill processes containing 'voicewriter.py'
@@ -20,16 +41,14 @@ def stop_voicewriter():
         if result.returncode == 0:
             print("✅ VoiceWriter processes stopped")
             stopped_processes += 1
-        else:
-            print("ℹ️  No VoiceWriter processes found")
     except subprocess.TimeoutExpired:
         print("⚠️  Timeout stopping VoiceWriter processes")
     except Exception as e:
         print(f"❌ Error stopping VoiceWriter: {e}")
     
-    # Kill processes on port 8000
+    # Kill processes on the configured port
     try:
-        result = subprocess.run(['lsof', '-ti:8000'], 
+        result = subprocess.run(['lsof', f'-ti:{port}'], 
                               capture_output=True, text=True, timeout=5)
         if result.returncode == 0 and result.stdout.strip():
             pids = result.stdout.strip().split('\n')
@@ -37,23 +56,64 @@ def stop_voicewriter():
                 if pid and pid.isdigit():
                     try:
                         os.kill(int(pid), signal.SIGTERM)
-                        print(f"✅ Stopped process on port 8000 (PID {pid})")
+                        print(f"✅ Stopped process on port {port} (PID {pid})")
                         stopped_processes += 1
                     except ProcessLookupError:
                         pass  # Process already gone
                     except Exception as e:
                         print(f"⚠️  Could not stop PID {pid}: {e}")
-        else:
-            print("ℹ️  No processes on port 8000")
     except subprocess.TimeoutExpired:
-        print("⚠️  Timeout checking port 8000")
+        print(f"⚠️  Timeout checking port {port}")
     except Exception as e:
-        print(f"❌ Error checking port 8000: {e}")
+        print(f"❌ Error checking port {port}: {e}")
     
-    if stopped_processes > 0:
+    return stopped_processes
+
+def stop_pid_file(timeout=3.0):
+    """Stop the instance named in the PID file when its control socket does not answer"""
+    pid = control.read_pid_file()
+    if not pid or not control.process_alive(pid):
+        return None
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        return None
+    deadline = time.time() + timeout
+    while control.process_alive(pid) and time.time() < deadline:
+        time.sleep(0.01)
+    return pid
+
+def stop_voicewriter(legacy=False):
+    """Stop VoiceWriter servers efficiently"""
+    print("🛑 Stopping VoiceWriter...")
+    
+    pid = control.stop_running_instance() or stop_pid_file()
+    if pid:
+        print(f"✅ VoiceWriter stopped (PID {pid})")
+        return True
+    
+    # Nothing answered. Searching by name could hit unrelated processes, so
+    # only do it when asked to or when a socket shows an instance was there.
+    legacy = legacy or os.path.exists(control.CONTROL_SOCKET)
+    if legacy and legacy_stop(configured_port()) > 0:
         print("✅ Server cleanup completed")
-    else:
-        print("ℹ️  No servers were running")
+        return True
+    print("ℹ️  No servers were running")
+    return False
+
+def main():
+    args = sys.argv[1:]
+    legacy = '--legacy' in args
+    command = ' '.join(arg for arg in args if arg != '--legacy') or 'stop'
+    if command == 'stop':
+        stop_voicewriter(legacy)
+        return 0
+    reply = control.control_request(command)
+    if reply is None:
+        print("ℹ️  VoiceWriter is not running")
+        return 1
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get('status') != 'error' else 1
 
 if __name__ == "__main__":
-    stop_voicewriter()
+    sys.exit(main())
@@ -0,0 +1,1211 @@
+#!/usr/bin/env python3
+"""
+VoiceWriter unit tests - run with: python3 -m unittest
+"""
+
+import array
+import gzip
+import http.client
+import io
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import control
+import voicewriter
+from voicewriter import KeyAction, UndoAction
+
+def setUpModule():
+    # Default settings, whatever config.json and vocabulary sit next to the script
+    global config_dir
+    config_dir = tempfile.TemporaryDirectory()
+    voicewriter.settings = voicewriter.load_settings(os.path.join(config_dir.name, 'config.json'), raw={})
+
+def tearDownModule():
+    config_dir.cleanup()
+
+class FakeDisplay:
+    """Just enough of an Xlib display for XTestBackend: a keyboard map with three spare keycodes"""
+
+    def __init__(self):
+        XK = voicewriter.XK
+        self.display = types.SimpleNamespace(info=types.SimpleNamespace(min_keycode=8, max_keycode=15))
+        self.mapping = {8: [XK.XK_a, XK.XK_A], 9: [XK.XK_Shift_L, 0], 10: [XK.XK_BackSpace, 0],
+                        11: [XK.XK_Control_L, 0], 12: [XK.XK_v, XK.XK_V], 13: [0, 0], 14: [0, 0], 15: [0, 0]}
+        self.changes = []
+        self.closed = False
+
+    def has_extension(self, name):
+        return name == 'XTEST'
+
+    def get_keyboard_mapping(self, first, count):
+        return [self.mapping[keycode] for keycode in range(first, first + count)]
+
+    def change_keyboard_mapping(self, keycode, keysyms):
+        self.changes.append((keycode, keysyms[0][0]))
+        self.mapping[keycode] = list(keysyms[0])
+
+    def keysym_to_keycodes(self, keysym):
+        for keycode, keysyms in sorted(self.mapping.items()):
+            for index, value in enumerate(keysyms):
+                if value == keysym:
+                    yield keycode, index
+
+    def pending_events(self):
+        return 0
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+@unittest.skipIf(voicewriter.xtest is None, "needs python-xlib")
+class XTestBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.display = FakeDisplay()
+        self.events = []
+        patcher = mock.patch.object(voicewriter.xtest, 'fake_input', self.fake_input)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = voicewriter.XTestBackend(display=self.display)
+
+    def fake_input(self, display, event_type, detail=0, time=0):
+        self.events.append(('press' if event_type == voicewriter.X.KeyPress else 'release', detail))
+
+    def test_shifted_characters(self):
+        self.assertTrue(self.backend.type('aA'))
+        self.assertEqual(self.events, [('press', 8), ('release', 8),
+                                       ('press', 9), ('press', 8), ('release', 8), ('release', 9)])
+
+    def test_missing_keysyms_get_spare_keycodes_once(self):
+        self.assertTrue(self.backend.type('éé'))
+        self.assertTrue(self.backend.type('é'))
+        self.assertEqual(self.display.changes, [(15, 0xe9)])
+        self.assertEqual(self.events, [('press', 15), ('release', 15)] * 3)
+
+    def test_spares_are_recycled_least_recently_used_first(self):
+        self.assertTrue(self.backend.type('éü€'))
+        self.assertTrue(self.backend.type('é'))
+        self.events.clear()
+        self.assertTrue(self.backend.type('ñ'))
+        # ü went unused the longest; é was typed since
+        self.assertEqual(self.display.changes[-1], (14, 0xf1))
+        self.assertEqual(self.events, [('press', 14), ('release', 14)])
+
+    def test_strokes_are_sent_before_their_keycode_is_rebound(self):
+        self.assertTrue(self.backend.type('éü€ñ'))
+        self.assertEqual(self.display.changes[-1], (15, 0xf1))
+        self.assertEqual(self.events[:6], [('press', 15), ('release', 15), ('press', 14),
+                                           ('release', 14), ('press', 13), ('release', 13)])
+        self.assertEqual(self.events[6:], [('press', 15), ('release', 15)])
+
+    def test_key_combinations(self):
+        self.assertTrue(self.backend.key('ctrl+v'))
+        self.assertEqual(self.events, [('press', 11), ('press', 12), ('release', 12), ('release', 11)])
+        self.events.clear()
+        self.assertTrue(self.backend.key('BackSpace', 2))
+        self.assertEqual(self.events, [('press', 10), ('release', 10)] * 2)
+        self.assertFalse(self.backend.key('NoSuchKey'))
+
+    def test_key_sequences(self):
+        self.assertTrue(self.backend.key('ctrl+v BackSpace'))
+        self.assertEqual(self.events, [('press', 11), ('press', 12), ('release', 12), ('release', 11),
+                                       ('press', 10), ('release', 10)])
+
+    def test_close_unbinds_spares(self):
+        self.backend.type('é')
+        self.backend.close()
+        self.assertEqual(self.display.mapping[15], [0, 0])
+        self.assertTrue(self.display.closed)
+
+class CreateBackendTest(unittest.TestCase):
+    def test_auto_falls_back_to_xdotool_without_a_display(self):
+        with mock.patch.dict(os.environ, {'DISPLAY': ''}):
+            backend = voicewriter.create_backend('auto')
+            self.assertIsInstance(backend, voicewriter.SubprocessBackend)
+            with self.assertRaises(ValueError):
+                voicewriter.create_backend('xtest')
+
+class BlockingBackend(voicewriter.FakeBackend):
+    """Fake backend whose first type() call waits until released"""
+
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def type(self, text):
+        if not self.entered.is_set():
+            self.entered.set()
+            self.release.wait(5)
+        return super().type(text)
+
+class TypingQueueTest(unittest.TestCase):
+    def start(self, backend):
+        queue = voicewriter.TypingQueue(backend, min_interval=0)
+        queue.start()
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_utterances_are_typed_in_order(self):
+        backend = voicewriter.FakeBackend()
+        queue = self.start(backend)
+        seqs = [queue.submit(f'this is sentence {word}') for word in ('one', 'two', 'three')]
+        self.assertEqual(seqs, [1, 2, 3])
+        self.assertEqual(queue.wait(seqs[-1], 2), 'typed')
+        self.assertEqual(backend.text, 'this is sentence one. this is sentence two. this is sentence three. ')
+        self.assertEqual(queue.typed_seq, 3)
+        self.assertEqual(queue.status(4), 'unknown')
+
+    def test_failed_typing_is_reported(self):
+        queue = self.start(voicewriter.FakeBackend(fail=True))
+        seq = queue.submit('this will not work')
+        self.assertEqual(queue.wait(seq, 2), 'error')
+
+    def test_interim_hypotheses_are_diffed(self):
+        backend = voicewriter.FakeBackend()
+        queue = self.start(backend)
+        seq = queue.submit('hello word', 'u1', final=False, session='s')
+        self.assertEqual(queue.wait(seq, 2), 'typed')
+        seq = queue.submit('hello world', 'u1', final=True, session='s')
+        self.assertEqual(queue.wait(seq, 2), 'typed')
+        self.assertEqual(backend.text, 'hello world')
+        self.assertEqual(backend.events[1:], [('key', 'BackSpace'), ('type', 'ld')])
+
+    def test_late_interim_after_final_is_ignored(self):
+        backend = voicewriter.FakeBackend()
+        queue = self.start(backend)
+        queue.submit('hello world', 'u1', final=True, session='s')
+        seq = queue.submit('hello', 'u1', final=False, session='s')
+        queue.wait(seq, 2)
+        self.assertEqual(backend.text, 'hello world')
+
+    def test_exception_is_recorded_and_the_queue_goes_on(self):
+        backend = voicewriter.FakeBackend()
+        backend.key = mock.Mock(side_effect=RuntimeError('display gone'))
+        queue = self.start(backend)
+        seq = queue.submit('hello press enter', 'u1', final=True, session='s')
+        self.assertEqual(queue.wait(seq, 2), 'error')
+        seq = queue.submit('typed after the failure')
+        self.assertEqual(queue.wait(seq, 2), 'typed')
+        self.assertTrue(backend.text.endswith('typed after the failure. '))
+
+    def test_full_queue_refuses(self):
+        queue = voicewriter.TypingQueue(voicewriter.FakeBackend(), maxsize=1)
+        self.assertEqual(queue.submit('one'), 1)
+        self.assertIsNone(queue.submit('two'))
+
+    def test_cancel_drops_the_queue(self):
+        backend = BlockingBackend()
+        queue = self.start(backend)
+        queue.submit('first sentence goes here', session='s')
+        self.assertTrue(backend.entered.wait(2))
+        second = queue.submit('second sentence goes here', session='s')
+        third = queue.submit('third sentence goes here', session='t')
+        result = queue.cancel(timeout=0.1)
+        self.assertEqual(result['dropped'], 3)
+        backend.release.set()
+        self.assertEqual(queue.wait(second, 2), 'flushed')
+        self.assertEqual(queue.wait(third, 2), 'flushed')
+        self.assertNotIn('second', backend.text)
+        seq = queue.submit('after the cancel', session='s')
+        self.assertEqual(queue.wait(seq, 2), 'typed')
+
+    def test_newer_hypothesis_supersedes_queued_one(self):
+        backend = BlockingBackend()
+        queue = self.start(backend)
+        first = queue.submit('one two three four', session='s')
+        self.assertTrue(backend.entered.wait(2))
+        stale = queue.submit('good', 'u1', final=False, session='s')
+        self.assertEqual(queue.session_depth('s'), 0)
+        final = queue.submit('good morning', 'u1', final=True, session='s')
+        self.assertEqual(queue.status(stale), 'superseded')
+        self.assertEqual(queue.session_depth('s'), 1)
+        backend.release.set()
+        self.assertEqual(queue.wait(final, 2), 'typed')
+        self.assertEqual(queue.status(first), 'typed')
+        self.assertEqual(backend.text, 'one two three four. good morning')
+
+class QuietHandler(voicewriter.KeepAliveHandler):
+    def log_message(self, format, *args):
+        pass
+
+class TypeEndpointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = voicewriter.FakeBackend()
+        cls.httpd = voicewriter.ThreadingVoiceWriterServer(('127.0.0.1', 0), QuietHandler, cls.backend)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def post(self, body, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=5)
+        try:
+            if headers is None:
+                conn.request('POST', '/type', body)
+            else:
+                conn.putrequest('POST', '/type')
+                for name, value in headers.items():
+                    conn.putheader(name, value)
+                conn.endheaders(body)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read() or b'null')
+        finally:
+            conn.close()
+
+    def test_malformed_json(self):
+        for body in (b'not json', b'\xff\xfe', b'[1, 2]', b'"text"', b'null'):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body)[0], 400)
+
+    def test_invalid_fields(self):
+        for data in ({'text': 5}, {'text': None}, {'text': '   '}, {'text': 'hello there', 'n': 'x'},
+                     {'text': 'hello there', 'n': 0}, {'text': 'hi', 'utterance': 'u', 'final': False,
+                                                      'n': True}):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(json.dumps(data).encode())[0], 400)
+
+    def test_interim_text_must_be_a_string(self):
+        for text in (5, None, ['a']):
+            with self.subTest(text=text):
+                body = json.dumps({'text': text, 'utterance': 'u', 'final': False}).encode()
+                self.assertEqual(self.post(body)[0], 400)
+        code, payload = self.post(b'{"text": "  padded  ", "utterance": "u2", "final": true}')
+        self.assertEqual(code, 202)
+        self.assertEqual(self.httpd.typing_queue.wait(payload['seq'], 2), 'typed')
+        self.assertIn(('type', 'padded'), self.backend.events)
+
+    def test_body_length(self):
+        self.assertEqual(self.post(b'{}', {})[0], 411)
+        self.assertEqual(self.post(b'', {'Content-Length': 'lots'})[0], 400)
+        self.assertEqual(self.post(b'', {'Content-Length': str(self.httpd.max_body + 1)})[0], 413)
+
+    def test_valid_transcript_is_typed(self):
+        code, payload = self.post(json.dumps({'text': 'testing the endpoint now'}).encode())
+        self.assertEqual((code, payload['status']), (202, 'queued'))
+        self.assertEqual(self.httpd.typing_queue.wait(payload['seq'], 2), 'typed')
+        self.assertIn('testing the endpoint now. ', self.backend.text)
+
+    def test_connection_is_kept_alive(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=5)
+        try:
+            for text in ('first on this connection', 'second on this connection'):
+                conn.request('POST', '/type', json.dumps({'text': text}).encode())
+                response = conn.getresponse()
+                response.read()
+                self.assertEqual(response.status, 202)
+                self.assertFalse(response.will_close)
+        finally:
+            conn.close()
+
+def client_frame(payload, opcode=voicewriter.WebSocket.OP_TEXT, fin=True, mask=b'\x01\x02\x03\x04'):
+    """A masked frame as a browser sends it"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', (0x80 if fin else 0) | opcode, 0x80 | length)
+    else:
+        header = struct.pack('!BBH', (0x80 if fin else 0) | opcode, 0x80 | 126, length)
+    return header + mask + voicewriter.unmask(payload, mask)
+
+def server_frame(rfile):
+    """(opcode, payload) of the next unmasked frame from the server"""
+    first, second = rfile.read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', rfile.read(8))[0]
+    return first & 0x0F, rfile.read(length)
+
+class WebSocketTest(unittest.TestCase):
+    def make_socket(self, *frames, max_message=1024):
+        self.output = io.BytesIO()
+        return voicewriter.WebSocket(io.BytesIO(b''.join(frames)), self.output, max_message)
+
+    def test_accept_key(self):
+        # The example from RFC 6455
+        self.assertEqual(voicewriter.WebSocket.accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+                         's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+    def test_fragments_and_control_frames(self):
+        ws = self.make_socket(client_frame(b'hel', fin=False),
+                              client_frame(b'ping', voicewriter.WebSocket.OP_PING),
+                              client_frame(b'lo', voicewriter.WebSocket.OP_CONTINUATION),
+                              client_frame(b'\x00' * 300, voicewriter.WebSocket.OP_BINARY),
+                              client_frame(struct.pack('!H', 1000), voicewriter.WebSocket.OP_CLOSE))
+        self.assertEqual(ws.receive(), (voicewriter.WebSocket.OP_TEXT, b'hello'))
+        self.assertEqual(ws.receive(), (voicewriter.WebSocket.OP_BINARY, b'\x00' * 300))
+        self.assertIsNone(ws.receive())
+        output = io.BytesIO(self.output.getvalue())
+        self.assertEqual(server_frame(output), (voicewriter.WebSocket.OP_PONG, b'ping'))
+        self.assertEqual(server_frame(output), (voicewriter.WebSocket.OP_CLOSE, struct.pack('!H', 1000)))
+        self.assertFalse(ws.send(b'too late'))
+
+    def test_unmasked_and_oversized_frames(self):
+        with self.assertRaises(ConnectionError):
+            self.make_socket(b'\x81\x02hi').receive()
+        ws = self.make_socket(client_frame(b'x' * 2000))
+        with self.assertRaises(ConnectionError):
+            ws.receive()
+        self.assertEqual(server_frame(io.BytesIO(self.output.getvalue())),
+                         (voicewriter.WebSocket.OP_CLOSE, struct.pack('!H', 1009)))
+
+    def test_send_lengths(self):
+        ws = self.make_socket()
+        for size in (10, 200, 70000):
+            self.assertTrue(ws.send(b'a' * size))
+        output = io.BytesIO(self.output.getvalue())
+        for size in (10, 200, 70000):
+            self.assertEqual(server_frame(output), (voicewriter.WebSocket.OP_TEXT, b'a' * size))
+
+class StreamEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = voicewriter.FakeBackend()
+        self.httpd = voicewriter.ThreadingVoiceWriterServer(('127.0.0.1', 0), QuietHandler, self.backend)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def connect(self):
+        sock = socket.create_connection(self.httpd.server_address, timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                     b'Sec-WebSocket-Version: 13\r\n\r\n')
+        rfile = sock.makefile('rb')
+        self.addCleanup(rfile.close)
+        self.assertIn(b' 101 ', rfile.readline())
+        while rfile.readline() not in (b'\r\n', b''):
+            pass
+        return sock, rfile
+
+    def exchange(self, sock, rfile, payload):
+        sock.sendall(client_frame(payload))
+        return json.loads(server_frame(rfile)[1])
+
+    def test_transcripts_are_acked_then_reported(self):
+        sock, rfile = self.connect()
+        reply = self.exchange(sock, rfile, json.dumps({'type': 'transcript', 'text': 'streaming works just fine',
+                                                       'id': 7}).encode())
+        self.assertEqual((reply['type'], reply['status'], reply['id']), ('ack', 'queued', 7))
+        status = json.loads(server_frame(rfile)[1])
+        self.assertEqual(status, {'type': 'status', 'seq': reply['seq'], 'state': 'typed'})
+
+    def test_invalid_frames_keep_the_stream_open(self):
+        sock, rfile = self.connect()
+        for payload in (b'not json', b'[1, 2]', b'"x"', b'null'):
+            with self.subTest(payload=payload):
+                self.assertEqual(self.exchange(sock, rfile, payload),
+                                 {'type': 'error', 'message': 'Invalid frame'})
+        self.assertEqual(self.exchange(sock, rfile, b'{"type": "nope"}')['message'], 'Unknown frame type')
+        reply = self.exchange(sock, rfile, b'{"type": "transcript", "text": "still listening here"}')
+        self.assertEqual(reply['status'], 'queued')
+
+    def test_audio_start_needs_a_valid_sample_rate(self):
+        self.httpd.recognizer = mock.Mock()
+        sock, rfile = self.connect()
+        for rate in (b'"abc"', b'0', b'-16000', b'1000000000', b'[16000]', b'null', b'Infinity'):
+            with self.subTest(rate=rate):
+                frame = b'{"type": "audio", "action": "start", "sampleRate": %s}' % rate
+                self.assertEqual(self.exchange(sock, rfile, frame),
+                                 {'type': 'error', 'message': 'Invalid sample rate'})
+        sock.sendall(client_frame(b'{"type": "audio", "action": "start", "sampleRate": 16000}'))
+        reply = self.exchange(sock, rfile, b'{"type": "transcript", "text": "still listening here"}')
+        self.assertEqual(reply['type'], 'ack')
+
+class CommandEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = voicewriter.CommandEngine.from_config({})
+
+    def test_punctuation_attaches_to_previous_word(self):
+        self.assertEqual(self.engine.process('hello comma world period'), ['hello, world. '])
+
+    def test_sentence_completion(self):
+        self.assertEqual(self.engine.process('this is a sentence'), ['this is a sentence. '])
+        self.assertEqual(self.engine.process('hello world'), ['hello world'])
+        self.assertEqual(self.engine.process('that is great'), ['that is great. '])
+
+    def test_caps_carry_over_between_utterances(self):
+        state = voicewriter.CommandState()
+        self.assertEqual(self.engine.process('caps on hello', state), ['HELLO'])
+        self.assertTrue(state.caps)
+        self.assertEqual(self.engine.process('world caps off again', state), ['WORLD again. '])
+        self.assertFalse(state.caps)
+
+    def test_keys_and_undo_split_the_text(self):
+        self.assertEqual(self.engine.process('hello press enter'),
+                         ['hello', KeyAction('Return', 1)])
+        self.assertEqual(self.engine.process('one scratch that two'),
+                         ['one', UndoAction(1), 'two. '])
+        self.assertEqual(self.engine.process('new line next'), ['\nnext'])
+
+    def test_config_adds_and_removes_commands(self):
+        engine = voicewriter.CommandEngine.from_config(
+            {'commands': {'at sign': '@', 'comma': None, 'press escape twice': {'key': 'Escape', 'repeat': 2}}})
+        self.assertEqual(engine.process('at sign comma'), ['@ comma'])
+        self.assertEqual(engine.process('PRESS Escape twice'), [KeyAction('Escape', 2)])
+
+    def test_key_sequences(self):
+        engine = voicewriter.CommandEngine({'select all': {'key': ['ctrl+a', 'Delete']}})
+        self.assertEqual(engine.process('select all'), [KeyAction('ctrl+a Delete', 1)])
+
+    def test_malformed_specs_raise_value_error(self):
+        for spec in (5, ['text'], {'text': 5}, {'key': 5}, {'key': ''}, {'key': ['a', 3]}, {'key': []},
+                     {'key': 'Return', 'repeat': 0}, {'key': 'Return', 'repeat': '2'},
+                     {'key': 'Return', 'repeat': True}, {'undo': -1}, {'caps': 'yes'}, {'attach': 1}):
+            with self.subTest(spec=spec):
+                with self.assertRaisesRegex(ValueError, "^command 'oops': "):
+                    voicewriter.CommandEngine({'oops': spec})
+
+class VocabularyTest(unittest.TestCase):
+    def setUp(self):
+        self.vocabulary = voicewriter.Vocabulary([('btw', 'by the way'), ('new york', 'NYC'),
+                                                  ('new york city', 'Big Apple')])
+
+    def test_whole_words_case_insensitive(self):
+        self.assertEqual(self.vocabulary.apply('BTW, I moved'), 'by the way, I moved')
+        self.assertEqual(self.vocabulary.apply('abtw new yorker'), 'abtw new yorker')
+
+    def test_leftmost_longest(self):
+        self.assertEqual(self.vocabulary.apply('from new york city to new york'),
+                         'from Big Apple to NYC')
+
+    def test_empty_vocabulary_returns_text(self):
+        self.assertEqual(voicewriter.Vocabulary().apply('btw'), 'btw')
+
+    def test_load_parses_and_caches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'vocabulary.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('# comment\nsig => Kind regards,\\nSam\nnot a rule\n')
+            cache_dir = os.path.join(directory, 'cache')
+            for _ in range(2):
+                vocabulary = voicewriter.Vocabulary.load(path, cache_dir)
+                self.assertEqual(vocabulary.apply('sig'), 'Kind regards,\nSam')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_edited_file_replaces_its_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'vocabulary.txt')
+            cache_dir = os.path.join(directory, 'cache')
+            for replacement in ('first', 'second edit'):
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(f'word => {replacement}\n')
+                self.assertEqual(voicewriter.Vocabulary.load(path, cache_dir).apply('a word'), f'a {replacement}')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_missing_file_is_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            vocabulary = voicewriter.Vocabulary.load(os.path.join(directory, 'none.txt'), directory)
+            self.assertEqual(len(vocabulary), 0)
+
+class DedupCacheTest(unittest.TestCase):
+    def test_repeats_within_the_window(self):
+        cache = voicewriter.DedupCache(window=1.0)
+        self.assertFalse(cache.is_duplicate('a', 'Hello, world!', now=10.0))
+        self.assertTrue(cache.is_duplicate('a', 'hello   WORLD', now=10.5))
+        self.assertFalse(cache.is_duplicate('b', 'hello world', now=10.6))
+        self.assertFalse(cache.is_duplicate('a', 'hello world', now=12.0))
+
+    def test_forget_and_size_limit(self):
+        cache = voicewriter.DedupCache(window=5.0, max_entries=2)
+        cache.is_duplicate('a', 'one', now=1.0)
+        cache.forget('a', 'one')
+        self.assertFalse(cache.is_duplicate('a', 'one', now=1.1))
+        cache.is_duplicate('a', 'two', now=1.2)
+        cache.is_duplicate('a', 'three', now=1.3)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertFalse(cache.is_duplicate('a', 'one', now=1.4))
+
+    def test_server_skips_repeats_across_connections(self):
+        httpd = voicewriter.VoiceWriterServer(('127.0.0.1', 0), QuietHandler, voicewriter.FakeBackend())
+        self.addCleanup(httpd.server_close)
+        self.assertEqual(httpd.queue_transcript('a', 'the same sentence again')[0], 202)
+        code, payload = httpd.queue_transcript('a', 'The same sentence, again.')
+        self.assertEqual((code, payload['status']), (200, 'skipped'))
+
+class LivenessTest(unittest.TestCase):
+    def wait_in_background(self, liveness):
+        gone = threading.Event()
+        threading.Thread(target=lambda: (liveness.wait_until_gone(), gone.set()), daemon=True).start()
+        return gone
+
+    def test_idle_page_ends_the_session(self):
+        liveness = voicewriter.Liveness(idle_timeout=0.1, close_grace=5)
+        gone = self.wait_in_background(liveness)
+        self.assertFalse(gone.wait(0.2))  # Never seen yet
+        liveness.touch()
+        self.assertTrue(gone.wait(2))
+
+    def test_goodbye_ends_after_the_grace_unless_the_page_returns(self):
+        liveness = voicewriter.Liveness(idle_timeout=60, close_grace=0.2)
+        liveness.touch()
+        gone = self.wait_in_background(liveness)
+        liveness.goodbye()
+        liveness.touch()  # Reloaded
+        self.assertFalse(gone.wait(0.4))
+        liveness.goodbye()
+        self.assertTrue(gone.wait(2))
+
+    def test_open_stream_outlasts_the_idle_timeout(self):
+        liveness = voicewriter.Liveness(idle_timeout=0.1, close_grace=0.1)
+        liveness.stream_opened()
+        gone = self.wait_in_background(liveness)
+        self.assertFalse(gone.wait(0.3))
+        liveness.stream_closed()
+        self.assertTrue(gone.wait(2))
+
+    def test_heartbeat_stays_well_inside_the_idle_timeout(self):
+        self.assertEqual(voicewriter.page_settings()['heartbeatMs'], 30000)
+        current = voicewriter.settings
+        try:
+            voicewriter.settings = voicewriter.load_settings(os.path.join(config_dir.name, 'config.json'),
+                                                             raw={'server': {'idle_timeout': 6}})
+            self.assertEqual(voicewriter.page_settings()['heartbeatMs'], 2000)
+        finally:
+            voicewriter.settings = current
+
+class AssetTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = voicewriter.ThreadingVoiceWriterServer(('127.0.0.1', 0), QuietHandler,
+                                                           voicewriter.FakeBackend())
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def get(self, path, **headers):
+        conn = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=5)
+        try:
+            conn.request('GET', path, headers={name.replace('_', '-'): value for name, value in headers.items()})
+            response = conn.getresponse()
+            return response.status, response.getheader('ETag'), response.getheader('Content-Encoding'), response.read()
+        finally:
+            conn.close()
+
+    def test_each_encoding_has_its_own_etag(self):
+        status, plain, encoding, body = self.get('/')
+        self.assertEqual((status, encoding), (200, None))
+        self.assertIn(b'<html>', body)
+        status, gzipped, encoding, body = self.get('/', Accept_Encoding='gzip')
+        self.assertEqual((status, encoding), (200, 'gzip'))
+        self.assertEqual(gzip.decompress(body)[:15], b'<!DOCTYPE html>')
+        self.assertNotEqual(plain, gzipped)
+        self.assertTrue(gzipped.endswith('-gz"'))
+
+    def test_if_none_match_compares_the_negotiated_tag(self):
+        _, plain, _, _ = self.get('/')
+        _, gzipped, _, _ = self.get('/', Accept_Encoding='gzip')
+        self.assertEqual(self.get('/', Accept_Encoding='gzip', If_None_Match=gzipped)[0], 304)
+        self.assertEqual(self.get('/', If_None_Match=plain)[0], 304)
+        self.assertEqual(self.get('/', If_None_Match=gzipped)[0], 200)
+        self.assertEqual(self.get('/', Accept_Encoding='gzip', If_None_Match=plain)[0], 200)
+        self.assertEqual(self.get('/', Accept_Encoding='gzip', If_None_Match=f'"other", {gzipped}')[0], 304)
+
+    def test_unknown_path(self):
+        self.assertEqual(self.get('/secret.txt')[0], 404)
+
+class ControlSocketTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'run', 'control.sock')
+        self.httpd = voicewriter.VoiceWriterServer(('127.0.0.1', 0), QuietHandler, voicewriter.FakeBackend())
+        self.addCleanup(self.httpd.server_close)
+        server = voicewriter.ControlServer(self.httpd, self.path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_commands(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        reply = control.control_request('status', path=self.path)
+        self.assertEqual((reply['status'], reply['pid'], reply['backend']), ('running', os.getpid(), 'fake'))
+        reply = control.control_request('frobnicate', path=self.path)
+        self.assertEqual(reply['status'], 'error')
+        self.assertIn('stop', reply['commands'])
+
+    def test_nothing_listening(self):
+        self.assertIsNone(control.control_request('status', path=os.path.join(self.directory, 'run', 'none.sock')))
+
+    def test_directory_open_to_others_is_refused(self):
+        os.chmod(os.path.dirname(self.path), 0o755)
+        self.assertIsNone(control.control_request('status', path=self.path))
+        with self.assertRaises(PermissionError):
+            control.private_dir(os.path.dirname(self.path))
+        link = os.path.join(self.directory, 'link')
+        os.symlink(self.directory, link)
+        with self.assertRaises(PermissionError):
+            control.private_dir(link)
+
+    def test_stop_does_not_import_the_server(self):
+        script = 'import sys, stop; print(sorted(set(sys.modules) & {"voicewriter", "http.server", "numpy"}))'
+        output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout
+        self.assertEqual(output.strip(), '[]')
+
+class ConfigTest(unittest.TestCase):
+    def load(self, raw):
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            loaded = voicewriter.load_settings(os.path.join(config_dir.name, 'config.json'), raw=raw)
+        return loaded, out.getvalue()
+
+    def test_bad_command_rules_are_skipped(self):
+        for spec in (5, {'text': 5}, {'key': 5}, {'key': ['a', 5]}, {'key': 'a', 'repeat': 0},
+                     {'key': 'a', 'repeat': '2'}):
+            with self.subTest(spec=spec):
+                loaded, out = self.load({'commands': {'foo': spec, 'bar': 'baz'}})
+                self.assertIn('commands.foo:', out)
+                self.assertNotIn('foo', loaded.rules)
+                self.assertEqual(loaded.commands.process('foo bar'), ['foo baz'])
+
+    def test_good_command_rules_are_kept(self):
+        loaded, out = self.load({'commands': {'clear line': {'key': ['Home', 'shift+End'], 'repeat': 2},
+                                              'press tab': None}})
+        self.assertEqual(out, '')
+        self.assertEqual(loaded.commands.process('clear line'), [KeyAction('Home shift+End', 2)])
+
+    def test_commands_must_be_an_object(self):
+        loaded, out = self.load({'commands': ['foo']})
+        self.assertIn('commands: expected an object', out)
+        self.assertEqual(loaded.rules, {})
+
+    def test_values_below_minimum_fall_back_to_defaults(self):
+        loaded, out = self.load({'server': {'idle_timeout': 0}, 'recognition': {'sample_rate': 0},
+                                 'typing': {'batch_size': 0, 'queue_size': 0}})
+        defaults = voicewriter.CONFIG_DEFAULTS
+        self.assertEqual(loaded.server.idle_timeout, defaults['server']['idle_timeout'])
+        self.assertEqual(loaded.recognition.sample_rate, defaults['recognition']['sample_rate'])
+        self.assertEqual(loaded.typing.batch_size, defaults['typing']['batch_size'])
+        self.assertEqual(loaded.typing.queue_size, defaults['typing']['queue_size'])
+        self.assertEqual(out.count('invalid value'), 4)
+
+    def test_wrong_types_and_unknown_names(self):
+        loaded, out = self.load({'server': {'port': '8000', 'colour': 'red'}, 'typing': 5, 'extra': {}})
+        self.assertEqual(loaded.server.port, voicewriter.CONFIG_DEFAULTS['server']['port'])
+        self.assertIn('server.port: invalid value', out)
+        self.assertIn('server.colour: unknown setting', out)
+        self.assertIn('typing: expected an object', out)
+        self.assertIn('extra: unknown section', out)
+
+    def test_invalid_app_rates_are_dropped(self):
+        loaded, out = self.load({'typing': {'app_rates': {'xterm': 10, 'emacs': -1, 'vim': True}}})
+        self.assertEqual(loaded.typing.app_rates, {'xterm': 10})
+        self.assertIn('typing.app_rates.emacs', out)
+        self.assertIn('typing.app_rates.vim', out)
+
+    def test_invalid_json_raises(self):
+        path = os.path.join(config_dir.name, 'broken.json')
+        for text in ('{"server": ', '[1, 2]'):
+            with open(path, 'w') as f:
+                f.write(text)
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                voicewriter.load_settings(path)
+
+    def test_watcher_survives_a_failed_reload(self):
+        stamps = iter(range(1000))
+        watcher = voicewriter.ConfigWatcher(None, interval=0.01)
+        with mock.patch.object(voicewriter, 'file_stamp', side_effect=lambda path: next(stamps)), \
+             mock.patch.object(voicewriter, 'reload_config', side_effect=[RuntimeError('boom'), None, None]) as reload, \
+             mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            watcher.start()
+            for _ in range(200):
+                if reload.call_count >= 2:
+                    break
+                threading.Event().wait(0.01)
+            watcher.stop()
+            watcher.thread.join(1)
+        self.assertGreaterEqual(reload.call_count, 2)
+        self.assertIn('RuntimeError: boom', out.getvalue())
+
+def typing_settings(**changes):
+    """Patch the live settings' typing section for one test"""
+    current = voicewriter.settings
+    return mock.patch.object(voicewriter, 'settings', current._replace(typing=current.typing._replace(**changes)))
+
+class RoutingTest(unittest.TestCase):
+    def test_working_method_is_tried_first(self):
+        router = voicewriter.TypingRouter(voicewriter.FakeBackend())
+        self.assertEqual(router.order('xterm'), ['type', 'paste', 'chunked'])
+        router.record('xterm', 'paste', True, 0.01)
+        self.assertEqual(router.order('xterm'), ['paste', 'type', 'chunked'])
+        self.assertEqual(router.order('emacs'), ['type', 'paste', 'chunked'])
+        router.record('xterm', 'paste', False, 0.01)
+        self.assertEqual(router.order('xterm'), ['type', 'paste', 'chunked'])
+        self.assertEqual(router.snapshot()['xterm']['methods']['paste'],
+                         {'attempts': 2, 'failures': 1, 'mean_ms': 10.0, 'max_ms': 10.0})
+
+    def test_route_expires(self):
+        router = voicewriter.TypingRouter(voicewriter.FakeBackend())
+        with typing_settings(route_ttl=0.0):
+            router.record('xterm', 'chunked', True, 0.01)
+        self.assertEqual(router.order('xterm'), ['type', 'paste', 'chunked'])
+
+    def test_type_text_remembers_the_fallback(self):
+        backend = voicewriter.FakeBackend(window=voicewriter.Window(1, 'xterm'))
+        with typing_settings(batch_size=4, chunk_rate=0.0):
+            # Only short chunks get through, and pasting is unavailable
+            backend.type = mock.Mock(side_effect=lambda text: len(text) <= 4)
+            router = voicewriter.TypingRouter(backend)
+            with mock.patch.dict(voicewriter.TYPING_METHODS, {'paste': lambda backend, text, job: False}):
+                self.assertTrue(voicewriter.type_text(backend, 'hello world', router))
+                self.assertEqual(router.routes['xterm'].method, 'chunked')
+                backend.type.reset_mock()
+                self.assertTrue(voicewriter.type_text(backend, 'again', router))
+        self.assertEqual([c.args[0] for c in backend.type.call_args_list], ['agai', 'n'])
+
+    def test_unknown_window_is_its_own_app(self):
+        self.assertEqual(voicewriter.TypingRouter(voicewriter.FakeBackend()).focused_app(), 'unknown')
+
+class FocusTrackerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(voicewriter, 'xdisplay', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tracker = voicewriter.FocusTracker()
+
+    def test_xdotool_answer_is_reused(self):
+        done = subprocess.CompletedProcess([], 0, stdout='XTerm\n', stderr='')
+        with mock.patch('subprocess.run', return_value=done) as run:
+            self.assertEqual(self.tracker.focused(), voicewriter.Window(None, 'XTerm'))
+            self.assertEqual(self.tracker.focused(), voicewriter.Window(None, 'XTerm'))
+            self.tracker.last_at -= self.tracker.spawn_interval
+            self.tracker.focused()
+        self.assertEqual(run.call_count, 2)
+
+    def test_missing_xdotool_is_not_asked_again(self):
+        with mock.patch('subprocess.run', side_effect=FileNotFoundError) as run:
+            self.assertIsNone(self.tracker.focused())
+            self.tracker.last_at = None
+            self.assertIsNone(self.tracker.focused())
+        self.assertEqual(run.call_count, 1)
+
+    def test_old_xdotool_is_not_asked_again(self):
+        old = subprocess.CompletedProcess([], 1, stdout='', stderr='Unknown command: getwindowclassname')
+        with mock.patch('subprocess.run', return_value=old) as run, \
+             mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertIsNone(self.tracker.focused())
+            self.tracker.last_at = None
+            self.assertIsNone(self.tracker.focused())
+        self.assertEqual(run.call_count, 1)
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_paced(self):
+        with mock.patch('time.monotonic', return_value=100.0) as clock:
+            bucket = voicewriter.TokenBucket(100, 10)
+            self.assertEqual(bucket.delay(10), 0.0)
+            self.assertAlmostEqual(bucket.delay(5), 0.05)
+            clock.return_value = 100.15
+            self.assertAlmostEqual(bucket.delay(5), 0.0)
+            clock.return_value = 200.0
+            self.assertEqual(bucket.tokens, 5)
+            bucket.delay(0)
+            self.assertEqual(bucket.tokens, 10)  # Never more than the burst
+
+    def test_zero_rate_does_not_pace(self):
+        bucket = voicewriter.TokenBucket(0, 10)
+        self.assertEqual(bucket.delay(1000), 0.0)
+
+    def test_chunked_typing_stops_when_cancelled(self):
+        backend = voicewriter.FakeBackend()
+        job = voicewriter.TypingJob(is_cancelled=lambda: len(backend.events) >= 2)
+        job.bucket = voicewriter.TokenBucket(0, 4)
+        with typing_settings(batch_size=4):
+            self.assertFalse(voicewriter.type_chunked(backend, 'hello there world', job))
+        self.assertTrue(job.aborted)
+        self.assertEqual(job.delivered, 8)
+        self.assertEqual(backend.text, 'hello th')
+
+@unittest.skipIf(voicewriter.xdisplay is None, 'python-xlib is not installed')
+class ClipboardOwnerTest(unittest.TestCase):
+    def setUp(self):
+        X = voicewriter.X
+        self.owner = owner = voicewriter.ClipboardOwner()
+        names = (('CLIPBOARD', 'INCR', 'VOICEWRITER_SELECTION')
+                 + owner.META_TARGETS + owner.TEXT_TARGETS)
+        owner.atoms = {name: atom for atom, name in enumerate(names, 100)}
+        owner.atoms['STRING'] = voicewriter.Xatom.STRING
+        owner.display = mock.Mock()
+        owner.window = mock.Mock(id=7)
+        # No clipboard owner to save from, then ours once taken
+        owner.display.get_selection_owner.side_effect = [X.NONE, owner.window]
+        patcher = mock.patch.object(voicewriter.xevent, 'SelectionNotify', side_effect=types.SimpleNamespace)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, target, prop=5):
+        return types.SimpleNamespace(target=self.owner.atoms[target], property=prop, time=0,
+                                     selection=self.owner.atoms['CLIPBOARD'], requestor=mock.Mock())
+
+    def test_paste_waits_for_the_app_to_fetch_the_text(self):
+        owner = self.owner
+        request = self.request('UTF8_STRING')
+        self.assertTrue(owner.paste('héllo', lambda: owner._answer(request) or True, 1.0))
+        utf8 = owner.atoms['UTF8_STRING']
+        request.requestor.change_property.assert_called_once_with(5, utf8, 8, 'héllo'.encode())
+        self.assertEqual(request.requestor.send_event.call_args.args[0].property, 5)
+        self.assertTrue(owner.owned)
+        self.assertIsNotNone(owner.restore_at)
+
+    def test_paste_without_a_fetch_times_out(self):
+        self.assertFalse(self.owner.paste('hello', lambda: True, 0.05))
+
+    def test_unknown_target_is_refused(self):
+        owner = self.owner
+        owner.content = {owner.atoms['UTF8_STRING']: (owner.atoms['UTF8_STRING'], 8, b'hi')}
+        request = self.request('INCR')
+        owner._answer(request)
+        request.requestor.change_property.assert_not_called()
+        self.assertEqual(request.requestor.send_event.call_args.args[0].property, voicewriter.X.NONE)
+        self.assertFalse(owner.served.is_set())
+
+    def test_targets_lists_the_content(self):
+        owner = self.owner
+        owner.content = {owner.atoms['UTF8_STRING']: (owner.atoms['UTF8_STRING'], 8, b'hi')}
+        request = self.request('TARGETS')
+        owner._answer(request)
+        targets = request.requestor.change_property.call_args.args[3]
+        self.assertEqual(targets, [owner.atoms['TARGETS'], owner.atoms['TIMESTAMP'], owner.atoms['UTF8_STRING']])
+
+    def test_someone_else_copying_wins(self):
+        owner = self.owner
+        owner.owned, owner.content, owner.saved, owner.restore_at = True, {1: None}, {2: None}, 1.0
+        owner._handle(types.SimpleNamespace(type=voicewriter.X.SelectionClear))
+        self.assertEqual((owner.owned, owner.content, owner.saved, owner.restore_at), (False, None, None, None))
+
+    def test_previous_clipboard_is_restored(self):
+        owner = self.owner
+        owner.saved = {owner.atoms['UTF8_STRING']: (owner.atoms['UTF8_STRING'], 8, b'before')}
+        owner.content, owner.restore_at = {}, 1.0
+        owner._restore()
+        self.assertEqual(owner.content, owner.saved)
+        self.assertIsNone(owner.restore_at)
+
+    def test_type_paste_uses_the_clipboard_owner(self):
+        backend = voicewriter.FakeBackend()
+        clipboard = mock.Mock()
+        clipboard.paste.side_effect = lambda text, send_paste_key, timeout: send_paste_key()
+        backend.clipboard = lambda: clipboard
+        self.assertTrue(voicewriter.type_paste(backend, 'hello', voicewriter.TypingJob()))
+        self.assertEqual(clipboard.paste.call_args.args[0], 'hello')
+        self.assertEqual(backend.events, [('key', 'ctrl+v')])
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        histogram = voicewriter.Histogram((0.1, 1.0))
+        self.assertEqual(voicewriter.Histogram.quantile(histogram.snapshot()[0], histogram.buckets, 0.5), 0.0)
+        for value in (0.05, 0.05, 0.5, 5.0):
+            histogram.observe(value)
+        cumulative, total = histogram.snapshot()
+        self.assertEqual(cumulative, [2, 3, 4])
+        self.assertAlmostEqual(total, 5.6)
+        self.assertEqual(voicewriter.Histogram.quantile(cumulative, histogram.buckets, 0.5), 0.1)
+        self.assertEqual(voicewriter.Histogram.quantile(cumulative, histogram.buckets, 0.75), 1.0)
+        self.assertIsNone(voicewriter.Histogram.quantile(cumulative, histogram.buckets, 0.99))
+
+    def test_prometheus_text(self):
+        registry = voicewriter.Metrics()
+        registry.inc('transcripts_total', result='queued')
+        registry.inc('transcripts_total', 2, result='duplicate')
+        registry.observe('typed_latency_seconds', 0.003)
+        text = registry.prometheus()
+        self.assertIn('# TYPE voicewriter_transcripts_total counter\n', text)
+        self.assertEqual(text.count('# HELP voicewriter_transcripts_total '), 1)
+        self.assertIn('voicewriter_transcripts_total{result="duplicate"} 2\n', text)
+        self.assertIn('voicewriter_typed_latency_seconds_bucket{le="0.0025"} 0\n', text)
+        self.assertIn('voicewriter_typed_latency_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('voicewriter_typed_latency_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('voicewriter_typed_latency_seconds_count 1\n', text)
+        self.assertIn('voicewriter_uptime_seconds ', text)
+
+    def test_json(self):
+        registry = voicewriter.Metrics()
+        registry.inc('typing_method_total', method='type', result='ok')
+        registry.observe('queue_wait_seconds', 0.02)
+        registry.typed(10, 0.1)
+        data = registry.as_json()
+        self.assertEqual(data['counters']['typing_method_total'], {'method=type,result=ok': 1})
+        self.assertEqual(data['counters']['typed_characters_total'], {'total': 10})
+        self.assertEqual(data['histograms']['queue_wait_seconds']['total']['p99'], 0.025)
+        self.assertGreater(data['typed_characters_per_second'], 0)
+
+    def test_endpoints(self):
+        httpd = voicewriter.ThreadingVoiceWriterServer(('127.0.0.1', 0), QuietHandler, voicewriter.FakeBackend())
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+        self.addCleanup(conn.close)
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.getheader('Content-type').startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'voicewriter_queue_depth 0\n', response.read())
+        conn.request('GET', '/metrics.json')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        data = json.loads(response.read())
+        self.assertEqual((data['queue_depth'], data['sessions']), (0, 0))
+
+class ResolveUndoTest(unittest.TestCase):
+    def test_undo_erases_earlier_units(self):
+        units = [(1, 6), (2, 4)]
+        ops, undone = voicewriter.resolve_undo([UndoAction(2)], units, 3)
+        self.assertEqual(ops, [KeyAction('BackSpace', 10)])
+        self.assertEqual(undone, [2, 1])
+        self.assertEqual(units, [])
+
+    def test_text_before_undo_in_the_same_utterance_goes_first(self):
+        units = [(1, 6)]
+        ops, undone = voicewriter.resolve_undo(['oops', UndoAction(1), 'fine'], units, 2)
+        self.assertEqual(ops, ['oops', KeyAction('BackSpace', 4), 'fine'])
+        self.assertEqual(undone, [])
+        self.assertEqual(units, [(1, 6), (2, 4)])
+
+    def test_keys_stop_an_undo(self):
+        units = [(1, 6), (2, None)]
+        ops, undone = voicewriter.resolve_undo([UndoAction(1)], units, 3)
+        self.assertEqual(ops, [])
+        self.assertEqual(undone, [])
+        units = []
+        voicewriter.resolve_undo(['x', KeyAction('Escape', 1)], units, 4)
+        self.assertEqual(units, [(4, None)])
+
+    def test_inserting_keys_count_as_characters(self):
+        units = []
+        voicewriter.resolve_undo(['hi', KeyAction('Return', 2)], units, 1)
+        self.assertEqual(units, [(1, 4)])
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal.jsonl')
+
+    def test_owner_only_even_if_the_file_existed(self):
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o644)
+        journal = voicewriter.Journal(self.path)
+        journal.close()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_rotation_keeps_old_files(self):
+        journal = voicewriter.Journal(self.path, max_bytes=10, keep=2, flush_interval=60)
+        for n in range(6):
+            journal.append({'n': n})
+            journal.flush()
+        journal.close()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        paths = [f'{self.path}.2', f'{self.path}.1']
+        self.assertEqual(voicewriter.read_journal(paths), [{'n': 2}, {'n': 3}, {'n': 4}, {'n': 5}])
+        self.assertFalse(os.path.exists(f'{self.path}.3'))
+
+    def test_cut_lines_are_skipped(self):
+        with open(self.path, 'w') as f:
+            f.write('{"n":1}\n{"n":2\n')
+        self.assertEqual(voicewriter.read_journal([self.path]), [{'n': 1}])
+
+    def test_typed_and_undone_utterances_are_recorded(self):
+        backend = voicewriter.FakeBackend()
+        queue = voicewriter.TypingQueue(backend, min_interval=0)
+        queue.journal = voicewriter.Journal(self.path, flush_interval=60)
+        queue.start()
+        self.addCleanup(queue.close)
+        queue.submit('hello there', session='s')
+        seq = queue.undo(1, 's')
+        self.assertEqual(queue.wait(seq, 2), 'typed')
+        self.assertEqual(backend.text, '')
+        queue.journal.close()
+        first, undo = voicewriter.read_journal([self.path])
+        self.assertEqual((first['raw'], first['text'], first['state']), ('hello there', 'hello there', 'typed'))
+        self.assertEqual((undo['raw'], undo['count'], undo['undo']), (None, 1, [first['seq']]))
+
+class UndoEndpointTest(unittest.TestCase):
+    def test_undo_erases_the_last_utterance(self):
+        backend = voicewriter.FakeBackend()
+        httpd = voicewriter.ThreadingVoiceWriterServer(('127.0.0.1', 0), QuietHandler, backend)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+        self.addCleanup(conn.close)
+        def post(path, data):
+            conn.request('POST', path, json.dumps(data).encode())
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        for data in ({'count': 0}, {'count': 'x'}, [1]):
+            with self.subTest(data=data):
+                self.assertEqual(post('/undo', data)[0], 400)
+        status, reply = post('/type', {'text': 'hello there', 'session': 's'})
+        self.assertEqual(status, 202)
+        status, reply = post('/undo', {'session': 's'})
+        self.assertEqual(status, 202)
+        self.assertEqual(httpd.typing_queue.wait(reply['seq'], 2), 'typed')
+        self.assertEqual(backend.text, '')
+
+class RecognitionTest(unittest.TestCase):
+    def test_fake_recognizer(self):
+        self.assertEqual(voicewriter.FakeRecognizer().recognize(b'\0' * 32000, 16000), 'speech of 1.00 seconds')
+
+    def test_pool_recognizes_in_a_worker(self):
+        pool = voicewriter.RecognitionPool('fake', '', 1)
+        self.addCleanup(pool.close)
+        results = types.SimpleNamespace(done=threading.Event(), value=None)
+        def callback(result):
+            results.value = result
+            results.done.set()
+        pool.recognize(b'\0' * 8000, 8000, callback, callback)
+        self.assertTrue(results.done.wait(30))
+        text, seconds = results.value
+        self.assertEqual(text, 'speech of 0.50 seconds')
+        self.assertGreaterEqual(seconds, 0)
+
+    def test_unknown_engine_is_refused(self):
+        with self.assertRaises(ValueError):
+            voicewriter.RecognitionPool.check('nope', '')
+
+    def test_transcripts_are_delivered_in_spoken_order(self):
+        pool = mock.Mock()
+        delivered = []
+        stream = voicewriter.AudioStream(pool, 16000, lambda text, segment: delivered.append(text),
+                                         voicewriter.settings.recognition)
+        for n in range(3):
+            stream._submit(types.SimpleNamespace(pcm=b'', start=n, end=n + 1))
+        callbacks = [call.args[2:] for call in pool.recognize.call_args_list]
+        callbacks[2][0](('third', 0.1))
+        callbacks[1][1](RuntimeError('worker died'))
+        self.assertEqual(delivered, [])
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            callbacks[0][0](('first', 0.1))
+        self.assertEqual(delivered, ['first', 'third'])
+
+class VoiceActivityDetectorTest(unittest.TestCase):
+    rate = 16000
+
+    def tone(self, seconds, amplitude=5000):
+        samples = array.array('h', [amplitude, amplitude, -amplitude, -amplitude]) * int(self.rate * seconds / 4)
+        return samples.tobytes()
+
+    def silence(self, seconds):
+        return bytes(2 * int(self.rate * seconds))
+
+    def segments(self, pcm, chunk, **options):
+        segments = []
+        for vectorized in ([False, True] if voicewriter.numpy is not None else [False]):
+            detector = voicewriter.VoiceActivityDetector(self.rate, vectorized=vectorized, **options)
+            found = []
+            for offset in range(0, len(pcm), chunk):
+                found.extend(detector.feed(pcm[offset:offset + chunk]))
+            last = detector.finish()
+            if last:
+                found.append(last)
+            if segments:
+                self.assertEqual(found, segments)
+            segments = found
+        return segments
+
+    def test_utterances_and_clicks(self):
+        pcm = (self.silence(0.51) + self.tone(0.99) + self.silence(1.02) + self.tone(0.3)
+               + self.silence(1.02) + self.tone(0.03) + self.silence(1.02))
+        segments = self.segments(pcm, 3200)
+        self.assertEqual(len(segments), 2)
+        first = segments[0]
+        self.assertAlmostEqual(first.start, 0.21, delta=0.03)  # 0.3 s of pre-roll
+        self.assertTrue(1.5 <= first.end <= 1.85)
+        self.assertEqual(len(first.pcm), round((first.end - first.start) * self.rate) * 2)
+
+    def test_chunking_does_not_change_the_result(self):
+        pcm = self.silence(0.5) + self.tone(0.6) + self.silence(0.9) + self.tone(0.6)
+        self.assertEqual(self.segments(pcm, 3200), self.segments(pcm, 777))
+
+    def test_long_speech_is_cut_at_max_segment(self):
+        segments = self.segments(self.tone(3.0), 3200, max_segment=1.0)
+        self.assertEqual(len(segments), 3)
+        self.assertTrue(all(segment.end - segment.start <= 1.0 for segment in segments))
+
+    def test_quiet_audio_yields_nothing(self):
+        self.assertEqual(self.segments(self.tone(2.0, amplitude=50), 3200), [])
+
+class SessionTableTest(unittest.TestCase):
+    def make_table(self, **options):
+        self.delivered = []
+        self.queued = 0
+        table = voicewriter.SessionTable(self.deliver, lambda session: self.queued, **options)
+        table.start()
+        self.addCleanup(table.close)
+        return table
+
+    def deliver(self, session, text, utterance=None, final=True):
+        self.delivered.append(text)
+        return 202, {'status': 'queued', 'seq': len(self.delivered)}
+
+    def test_reorders_within_a_session(self):
+        table = self.make_table()
+        self.assertEqual(table.accept('a', 2, 'two'), (202, {'status': 'buffered', 'n': 2}))
+        self.assertEqual(self.delivered, [])
+        code, payload = table.accept('a', 1, 'one')
+        self.assertEqual((code, payload['n']), (202, 1))
+        self.assertEqual(self.delivered, ['one', 'two'])
+        self.assertEqual(table.accept('a', 2, 'two')[1]['status'], 'skipped')
+        table.accept('b', 1, 'other')
+        self.assertEqual(self.delivered, ['one', 'two', 'other'])
+
+    def test_gap_is_skipped_after_timeout(self):
+        table = self.make_table(gap_timeout=0.05)
+        table.accept('a', 3, 'three')
+        deadline = time.monotonic() + 2
+        while not self.delivered and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.delivered, ['three'])
+        self.assertEqual(table.snapshot()['a']['gap_skipped'], 2)
+
+    def test_full_reorder_window_skips_the_gap(self):
+        table = self.make_table(reorder_window=2)
+        table.accept('a', 2, 'two')
+        table.accept('a', 3, 'three')
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(table.accept('a', 4, 'four')[0], 202)
+        self.assertEqual(self.delivered, ['two', 'three', 'four'])
+
+    def test_limit_refuses_without_stalling(self):
+        table = self.make_table(max_pending=2)
+        self.queued = 2
+        self.assertEqual(table.accept('a', 1, 'one')[0], 429)
+        self.queued = 0
+        self.assertEqual(table.accept('a', 2, 'two')[0], 202)
+        self.assertEqual(self.delivered, ['two'])
+
+    def test_interim_hypotheses_do_not_count_toward_the_limit(self):
+        table = self.make_table(max_pending=1)
+        table.accept('a', 2, 'hel', 'u', False)
+        table.accept('a', 3, 'hello', 'u', False)
+        self.assertEqual(table.accept('a', 4, 'hello there', 'u', True)[0], 202)
+
+    def test_sessions_beyond_the_maximum_are_dropped(self):
+        table = self.make_table(max_sessions=2)
+        for session in 'abc':
+            table.accept(session, 1, session)
+        self.assertEqual(sorted(table.snapshot()), ['b', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
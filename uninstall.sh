@@ -28,7 +28,7 @@ echo "🗑️  Removing desktop integration..."
 rm -f "$USER_HOME/.local/share/applications/voicewriter.desktop"
 rm -f "$USER_HOME/Desktop/voicewriter.desktop"
 
-# Remove any generated files
+# Remove files generated by older versions
 echo "🧹 Cleaning up generated files..."
 rm -f "$SCRIPT_DIR/voicewriter.html"
 
@@ -19,10 +19,7 @@ fi
 
 # Stop any running instances
 echo "🛑 Stopping any running instances..."
-if pgrep -f "voicewriter.py" > /dev/null; then
-    pkill -f "voicewriter.py"
-    sleep 2
-fi
+python3 stop.py > /dev/null
 
 # Backup current configuration
 if [ -f "config.json" ]; then
@@ -13,40 +13,3069 @@ import time
 import os
 import webbrowser
 import gc
+import queue
+import collections
+import urllib.parse
+import base64
+import hashlib
+import struct
+import marshal
+import string
+import gzip
 
-def load_config():
-    """Load configuration from config.json"""
+import shutil
+import errno
+import http.client
+import socket
+import select
+import bisect
+import itertools
+import contextlib
+import cProfile
+import pstats
+import array
+import multiprocessing
+import math
+import operator
+
+# The control socket and PID file, shared with stop.py
+from control import (RUNTIME_DIR, CONTROL_SOCKET, PID_FILE, private_dir, control_request,
+                     read_pid_file, process_alive, stop_running_instance)
+
+try:
+    import brotli  # Optional: precompress with brotli when available
+except ImportError:
+    brotli = None
+
+try:
+    import vosk  # Optional: offline speech recognition on the server
+except ImportError:
+    vosk = None
+
+try:
+    import numpy  # Optional: vectorized voice activity detection
+except ImportError:
+    numpy = None
+
+try:
+    # Optional: type, query the focused window and own the clipboard in-process
+    from Xlib import X, XK, Xatom, display as xdisplay
+    from Xlib.ext import xtest
+    from Xlib.protocol import event as xevent, request as xrequest
+except ImportError:
+    xdisplay = xtest = None
+
+START_TIME = time.perf_counter()
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_PATH = os.path.join(SCRIPT_DIR, 'config.json')
+
+# Every setting config.json can hold, with its default. A value must have the
+# same type as its default (ints are accepted for floats); anything else is
+# reported and replaced by the default.
+CONFIG_DEFAULTS = {
+    'server': {'port': 8000, 'host': 'localhost', 'mode': 'single', 'max_body': 64 * 1024,
+               'idle_timeout': 900.0, 'close_grace': 2.0},
+    'typing': {'timeout': 1.5, 'batch_size': 10, 'delay': 0.005, 'backend': 'auto',
+               'queue_size': 100, 'coalesce_chars': 80, 'min_interval': 0.1,
+               'route_ttl': 600.0, 'chunk_rate': 150.0, 'app_rates': {}, 'clipboard_restore': 0.5},
+    'dedup': {'window': 1.0, 'max_entries': 256},
+    'sessions': {'reorder_window': 32, 'gap_timeout': 0.5, 'max_pending': 20,
+                 'idle_timeout': 300.0, 'max_sessions': 64, 'utterance_hold': 1.0},
+    'browser': {'preferred': 'chrome', 'fallback': 'firefox'},
+    'speech': {'language': 'en-US', 'continuous': True, 'interim_results': True,
+               'interim_typing': False},
+    'ui': {'theme': 'default', 'auto_close': True},
+    'startup': {'fast_start': True},
+    'debug': {'trace': False, 'trace_file': 'trace.json', 'trace_events': 200000,
+              'profile_every': 0, 'profile_file': 'profile.prof'},
+    'recognition': {'engine': 'browser', 'model': '', 'workers': 2, 'sample_rate': 16000,
+                    'threshold': 500, 'zcr_threshold': 0.25, 'silence': 0.6, 'pre_roll': 0.3,
+                    'min_speech': 0.1, 'max_segment': 15.0},
+    'journal': {'enabled': False, 'file': 'journal.jsonl', 'max_bytes': 1024 * 1024, 'keep': 3,
+                'flush_interval': 1.0, 'flush_records': 64},
+    'vocabulary': {'file': 'vocabulary.txt'},
+}
+
+# Smallest allowed value of the numeric settings a zero would break; the rest
+# only have to be non-negative
+CONFIG_MINIMUMS = {
+    'server': {'max_body': 1, 'idle_timeout': 3.0},
+    'typing': {'timeout': 0.01, 'batch_size': 1, 'queue_size': 1, 'chunk_rate': 1.0},
+    'dedup': {'max_entries': 1},
+    'debug': {'trace_events': 1},
+    'recognition': {'workers': 1, 'sample_rate': 8000, 'max_segment': 0.5},
+    'journal': {'max_bytes': 1, 'flush_interval': 0.01, 'flush_records': 1},
+    'sessions': {'reorder_window': 1, 'gap_timeout': 0.01, 'max_pending': 1, 'idle_timeout': 1.0,
+                 'max_sessions': 1},
+}
+
+# One immutable record per config.json section, e.g. settings.typing.timeout
+SECTIONS = {name: collections.namedtuple(f'{name.title()}Settings', list(defaults))
+            for name, defaults in CONFIG_DEFAULTS.items()}
+
+def keysym_for(char):
+    """Map a character to an X keysym name that xdotool understands"""
+    if char == '\n':
+        return 'Return'
+    if char == '\t':
+        return 'Tab'
+    return f'U{ord(char):04X}'
+
+# The window keystrokes go to; `id` is None when only the class is known
+Window = collections.namedtuple('Window', 'id wm_class')
+
+class FocusTracker:
+    """Finds the focused window and its WM class.
+
+    Uses one persistent python-xlib connection when the module is installed,
+    otherwise `xdotool getactivewindow getwindowclassname`. That spawns a
+    process, so its answer is reused for `spawn_interval` seconds, and an
+    xdotool too old to know getwindowclassname is not asked again.
+    """
+    spawn_interval = 2.0
+
+    def __init__(self):
+        self.display = None
+        self.lock = threading.Lock()
+        self.xdotool = True  # False once xdotool turned out unable to answer
+        self.last = None
+        self.last_at = None
+
+    def focused(self):
+        """The focused Window, or None if it cannot be determined"""
+        with self.lock:
+            if xdisplay is not None:
+                try:
+                    return self._query_xlib()
+                except Exception:
+                    self.display = None  # Reconnect next time
+            return self._query_xdotool()
+
+    def _query_xlib(self):
+        if self.display is None:
+            self.display = xdisplay.Display()
+            self.active_window = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+        active = self.display.screen().root.get_full_property(self.active_window, X.AnyPropertyType)
+        if not active or not active.value:
+            return None
+        window_id = int(active.value[0])
+        wm_class = self.display.create_resource_object('window', window_id).get_wm_class()
+        return Window(window_id, wm_class[1] if wm_class else '')
+
+    def _query_xdotool(self):
+        if not self.xdotool:
+            return None
+        now = time.monotonic()
+        if self.last_at is not None and now - self.last_at < self.spawn_interval:
+            return self.last
+        self.last_at = now
+        self.last = None
+        try:
+            result = subprocess.run(['xdotool', 'getactivewindow', 'getwindowclassname'],
+                                    capture_output=True, text=True, timeout=0.5)
+        except OSError:
+            self.xdotool = False
+            return None
+        except subprocess.TimeoutExpired:
+            return None
+        if result.returncode != 0:
+            if 'nknown command' in result.stderr:
+                # xdotool before 3.2021, e.g. Ubuntu 22.04
+                print("ℹ️  xdotool cannot name the focused app; install python3-xlib for per-app typing routes")
+                self.xdotool = False
+            return None  # Or no focused window right now
+        self.last = Window(None, result.stdout.strip())
+        return self.last
+
+class ClipboardOwner:
+    """Serves pastes by owning the X CLIPBOARD selection in-process (needs python-xlib).
+
+    A paste takes ownership, sends the paste keystroke and counts as done when
+    the target app fetches the text, so there is no xclip process and no fixed
+    sleep. Whatever the clipboard held before is saved first and served again
+    `typing.clipboard_restore` seconds after the last paste, so dictating does
+    not clobber the user's clipboard. Clipboard contents that are only sent in
+    increments (INCR), or that exceed `max_saved` bytes, cannot be saved.
+    """
+    # Targets answered by the protocol itself rather than stored
+    META_TARGETS = ('TARGETS', 'TIMESTAMP', 'MULTIPLE', 'SAVE_TARGETS', 'DELETE', 'INSERT_SELECTION',
+                    'INSERT_PROPERTY')
+    TEXT_TARGETS = ('UTF8_STRING', 'TEXT', 'text/plain;charset=utf-8', 'text/plain')
+    max_saved = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.display = None
+        self.failed = xdisplay is None
+        self.lock = threading.RLock()  # Serializes X requests between the caller and the event thread
+        self.served = threading.Event()
+        self.replies = queue.Queue()
+        self.content = None  # {target atom: (type atom, format, data)} currently offered
+        self.saved = None  # What the clipboard held before our first paste
+        self.owned = False
+        self.restore_at = None
+        self.stopped = False
+
+    def available(self):
+        """Connect on first use; False if there is no python-xlib or no display"""
+        with self.lock:
+            if self.display is None and not self.failed:
+                try:
+                    self.display = xdisplay.Display()
+                    self.window = self.display.screen().root.create_window(0, 0, 1, 1, 0, X.CopyFromParent)
+                    self.atoms = {name: self.display.intern_atom(name) for name in
+                                  ('CLIPBOARD', 'INCR', 'VOICEWRITER_SELECTION')
+                                  + self.META_TARGETS + self.TEXT_TARGETS}
+                    self.atoms['STRING'] = Xatom.STRING
+                    threading.Thread(target=self._run, name='clipboard', daemon=True).start()
+                except Exception as e:
+                    print(f"⚠️  In-process clipboard unavailable, using xclip: {e}")
+                    self.display = None
+                    self.failed = True
+            return self.display is not None
+
+    def paste(self, text, send_paste_key, timeout):
+        """Offer text, send the paste keystroke and wait until the focused app has fetched it"""
+        data = text.encode('utf-8')
+        content = {self.atoms[name]: (self.atoms['UTF8_STRING'], 8, data) for name in self.TEXT_TARGETS}
+        content[self.atoms['STRING']] = (Xatom.STRING, 8, text.encode('latin-1', 'replace'))
+        with self.lock:
+            # Waits out a restore in progress; none can start once restore_at is cleared
+            self.restore_at = None
+            owned = self.owned
+        saved = None if owned else self._save(timeout / 2)  # Needs the event thread, so unlocked
+        with self.lock:
+            if not owned:
+                self.saved = saved
+            self.content = content
+            self.served.clear()
+            self.window.set_selection_owner(self.atoms['CLIPBOARD'], X.CurrentTime)
+            # A round trip guarantees the server has processed the new owner before the keystroke
+            owner = self.display.get_selection_owner(self.atoms['CLIPBOARD'])
+            self.owned = getattr(owner, 'id', owner) == self.window.id
+        if not self.owned or not send_paste_key():
+            return False
+        confirmed = self.served.wait(timeout)
+        with self.lock:
+            self.restore_at = time.monotonic() + settings.typing.clipboard_restore
+        return confirmed
+
+    def _save(self, timeout):
+        """Fetch every target the current clipboard owner offers; None if the clipboard is empty"""
+        with self.lock:
+            if self.display.get_selection_owner(self.atoms['CLIPBOARD']) == X.NONE:
+                return None
+        deadline = time.monotonic() + timeout
+        reply = self._fetch(self.atoms['TARGETS'], timeout)
+        if reply is None:
+            return None
+        skip = {self.atoms[name] for name in self.META_TARGETS}
+        saved = {}
+        size = 0
+        for target in reply.value:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if target in skip or target in saved:
+                continue
+            reply = self._fetch(target, remaining)
+            if reply is None or reply.property_type == self.atoms['INCR']:
+                continue
+            size += len(reply.value) * reply.format // 8
+            if size > self.max_saved:
+                break
+            saved[target] = (reply.property_type, reply.format, reply.value)
+        return saved or None
+
+    def _fetch(self, target, timeout):
+        """Ask the clipboard owner to convert to a target; the event thread hands over the reply"""
+        while not self.replies.empty():
+            self.replies.get_nowait()  # Stale reply to an earlier timed-out request
+        with self.lock:
+            self.window.convert_selection(self.atoms['CLIPBOARD'], target,
+                                          self.atoms['VOICEWRITER_SELECTION'], X.CurrentTime)
+            self.display.flush()
+        try:
+            return self.replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _restore(self):
+        self.restore_at = None
+        if self.saved:
+            self.content = self.saved
+        else:
+            # The clipboard was empty: leave it empty again
+            self.content = None
+            xrequest.SetSelectionOwner(display=self.display.display, window=X.NONE,
+                                       selection=self.atoms['CLIPBOARD'], time=X.CurrentTime)
+            self.owned = False
+        self.display.flush()
+
+    def _answer(self, request):
+        """Serve one SelectionRequest from an app that is pasting"""
+        content = self.content
+        target = request.target
+        prop = request.property or target  # Obsolete clients leave the property unset
+        if content is None:
+            prop = X.NONE
+        elif target == self.atoms['TARGETS']:
+            request.requestor.change_property(prop, Xatom.ATOM, 32,
+                                              [self.atoms['TARGETS'], self.atoms['TIMESTAMP']] + list(content))
+        elif target == self.atoms['TIMESTAMP']:
+            request.requestor.change_property(prop, Xatom.INTEGER, 32, [X.CurrentTime])
+        elif target in content:
+            property_type, property_format, data = content[target]
+            request.requestor.change_property(prop, property_type, property_format, data)
+            self.served.set()
+        else:
+            prop = X.NONE
+        request.requestor.send_event(xevent.SelectionNotify(
+            time=request.time, requestor=request.requestor, selection=request.selection,
+            target=target, property=prop))
+
+    def _handle(self, event):
+        if event.type == X.SelectionRequest:
+            self._answer(event)
+        elif event.type == X.SelectionNotify:
+            reply = None
+            if event.property != X.NONE:
+                reply = self.window.get_full_property(event.property, X.AnyPropertyType)
+                self.window.delete_property(event.property)
+            self.replies.put(reply)
+        elif event.type == X.SelectionClear:
+            # Someone else copied something: their data wins, nothing to restore
+            self.owned = False
+            self.content = None
+            self.saved = None
+            self.restore_at = None
+
+    def _run(self):
+        while not self.stopped:
+            restore_at = self.restore_at
+            timeout = 0.1 if restore_at is None else min(0.1, max(0.0, restore_at - time.monotonic()))
+            if not self.display.pending_events():
+                select.select([self.display], [], [], timeout)
+            try:
+                with self.lock:
+                    if self.restore_at is not None and time.monotonic() >= self.restore_at:
+                        self._restore()
+                    while self.display.pending_events():
+                        self._handle(self.display.next_event())
+                    self.display.flush()
+            except Exception as e:
+                print(f"⚠️  Clipboard error: {e}")
+
+    def close(self):
+        self.stopped = True
+        with self.lock:
+            if self.display is not None:
+                try:
+                    self.display.close()
+                except Exception:
+                    pass
+                self.display = None
+
+class TypingBackend:
+    """Base class for typing backends"""
+    name = 'base'
+
+    def type(self, text):
+        """Type text at the cursor, returning True on success"""
+        raise NotImplementedError
+
+    def key(self, keys, repeat=1):
+        """Send a key combination such as 'ctrl+v', or several separated by spaces, returning True on success"""
+        raise NotImplementedError
+
+    def focused_window(self):
+        """The Window that will receive the keystrokes, or None if unknown"""
+        return None
+
+    def clipboard(self):
+        """An in-process ClipboardOwner for pasting, or None to paste through xclip"""
+        return None
+
+    def warm_up(self):
+        """Prepare the backend ahead of the first utterance"""
+
+    def close(self):
+        """Release any resources held by the backend"""
+
+class XdotoolBackend(TypingBackend):
+    """Single long-lived `xdotool -` process fed script lines over stdin.
+
+    Text is sent as keysym names (U0041 ...) so the script parser never has
+    to deal with quoting or whitespace, and each utterance costs a pipe write
+    instead of a fork/exec. Every write ends with `getmouselocation`, whose
+    reply on stdout confirms that the lines before it ran; anything xdotool
+    prints to stderr first, an exit or a missing reply counts as a failure.
+    An xdotool that only runs its script at end of input never replies, so
+    the backend is then given up for good rather than respawned.
+    """
+    name = 'xdotool'
+    keys_per_line = 200
+    respawn_interval = 10.0  # A failed xdotool is not restarted more often than this
+
+    def __init__(self, delay_ms=0, timeout=1.5):
+        self.delay_ms = delay_ms
+        self.timeout = timeout
+        self.process = None
+        self.output = queue.Queue()  # ('out' | 'err', line) from the reader threads
+        self.spawned_at = None
+        self.confirmed = False  # A reply proved that lines run as they arrive
+        self.unsupported = False
+        self.lock = threading.Lock()
+        self.focus = FocusTracker()
+        self.selection = ClipboardOwner()
+
+    def _ensure_process(self):
+        if self.process is not None and self.process.poll() is None:
+            return self.process
+        if self.process is not None:
+            self._discard(f"xdotool exited with status {self.process.returncode}")
+        if self.spawned_at is not None and time.monotonic() - self.spawned_at < self.respawn_interval:
+            raise OSError("xdotool failed recently")
+        self.spawned_at = time.monotonic()
+        self.output = queue.Queue()
+        self.process = subprocess.Popen(['xdotool', '-'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for stream, kind in ((self.process.stdout, 'out'), (self.process.stderr, 'err')):
+            threading.Thread(target=self._read, args=(stream, kind, self.output),
+                             name=f'xdotool-{kind}', daemon=True).start()
+        return self.process
+
+    @staticmethod
+    def _read(stream, kind, output):
+        for line in stream:
+            output.put((kind, line.decode(errors='replace').strip()))
+        output.put((kind, None))
+
+    def _stderr_line(self, timeout=0.2):
+        """What a dying xdotool said, e.g. that it cannot open the display"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                kind, line = self.output.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+            if kind == 'err' and line:
+                return line
+
+    def _discard(self, reason):
+        """Drop the process after a failure; the next call may start another after respawn_interval"""
+        print(f"⚠️  xdotool: {reason}")
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        self.process = None
+
+    def _send(self, script, keys):
+        with self.lock:
+            if self.unsupported:
+                return False
+            earlier = None
+            try:
+                process = self._ensure_process()
+                while not self.output.empty():
+                    kind, line = self.output.get_nowait()  # Left over from a write that timed out
+                    if kind == 'err' and line:
+                        earlier = line
+                process.stdin.write(script.encode() + b'getmouselocation\n')
+                process.stdin.flush()
+            except OSError as e:
+                if self.process is not None:
+                    self._discard(earlier or self._stderr_line() or f"write failed: {e}")
+                return False
+            deadline = time.monotonic() + self.timeout + keys * self.delay_ms / 1000
+            error = None
+            while True:
+                try:
+                    kind, line = self.output.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    if not self.confirmed:
+                        print("⚠️  xdotool does not run script lines as they arrive; "
+                              "set typing.backend to \"subprocess\"")
+                        self.unsupported = True
+                    self._discard("no reply in time")
+                    return False
+                if line is None:
+                    self._discard(error or "xdotool exited")
+                    return False
+                if kind == 'err':
+                    error = error or line
+                elif line.startswith('x:'):
+                    self.confirmed = True
+                    if error:
+                        print(f"⚠️  xdotool: {error}")
+                    return error is None
+
+    def type(self, text):
+        keysyms = [keysym_for(c) for c in text if c >= ' ' or c in '\n\t']
+        if not keysyms:
+            return True
+        lines = []
+        for i in range(0, len(keysyms), self.keys_per_line):
+            chunk = ' '.join(keysyms[i:i + self.keys_per_line])
+            lines.append(f'key --delay {self.delay_ms} {chunk}\n')
+        return self._send(''.join(lines), len(keysyms))
+
+    def key(self, keys, repeat=1):
+        return self._send(f'key --delay {self.delay_ms} {" ".join([keys] * repeat)}\n', repeat)
+
+    def focused_window(self):
+        return self.focus.focused()
+
+    def clipboard(self):
+        return self.selection if self.selection.available() else None
+
+    def warm_up(self):
+        with self.lock:
+            try:
+                self._ensure_process()
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.process and self.process.poll() is None:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(timeout=1)
+                except Exception:
+                    self.process.kill()
+            self.process = None
+        self.selection.close()
+
+class XTestBackend(TypingBackend):
+    """Types in-process through the XTEST extension on one display connection (needs python-xlib).
+
+    Every key press is a fake_input request, so an utterance costs neither a
+    fork nor a pipe round trip, and the X server itself spaces the presses
+    `delay_ms` apart. The keycode of each keysym is cached. A keysym the
+    keyboard map lacks (most non-ASCII characters) is bound to a spare
+    keycode, least recently used first, and the spares are unbound on close.
+    """
+    name = 'xtest'
+    # Modifier names in xdotool-style combinations such as 'ctrl+v'
+    MODIFIERS = {'ctrl': 'Control_L', 'control': 'Control_L', 'shift': 'Shift_L', 'alt': 'Alt_L',
+                 'super': 'Super_L', 'meta': 'Meta_L'}
+
+    def __init__(self, delay_ms=0, display=None):
+        self.delay_ms = delay_ms
+        self.display = display or xdisplay.Display()
+        if not self.display.has_extension('XTEST'):
+            raise OSError("the X server has no XTEST extension")
+        self.lock = threading.Lock()
+        self.codes = {}  # keysym -> (keycode, needs shift)
+        self.strokes = []  # Keycode combinations not yet sent, see _press()
+        info = self.display.display.info
+        mapping = self.display.get_keyboard_mapping(info.min_keycode, info.max_keycode - info.min_keycode + 1)
+        self.free = [info.min_keycode + i for i, keysyms in enumerate(mapping) if not any(keysyms)]
+        self.remapped = collections.OrderedDict()  # Spare keycode -> keysym bound to it, oldest first
+        self.shift = self._keycode(XK.XK_Shift_L)
+        self.focus = FocusTracker()
+        self.selection = ClipboardOwner()
+
+    @staticmethod
+    def keysym(char):
+        """The keysym that types a character"""
+        if char == '\n':
+            return XK.XK_Return
+        if char == '\t':
+            return XK.XK_Tab
+        code = ord(char)
+        # Latin-1 keysyms equal their code points; the rest of Unicode is offset
+        return code if code < 0x100 else 0x01000000 | code
+
+    def _keycode(self, keysym):
+        """(keycode, needs shift) for a keysym, binding it to a spare keycode if need be; None if impossible"""
+        cached = self.codes.get(keysym)
+        if cached is None:
+            for keycode, index in self.display.keysym_to_keycodes(keysym):
+                if index < 2 and self.remapped.get(keycode, keysym) == keysym:
+                    cached = self.codes[keysym] = (keycode, index == 1)
+                    break
+        if cached is not None:
+            if cached[0] in self.remapped:
+                self.remapped.move_to_end(cached[0])
+            return cached
+        if self.free:
+            keycode = self.free.pop()
+        elif self.remapped:
+            self._press()  # Queued strokes may still need the binding about to go
+            keycode, previous = self.remapped.popitem(last=False)
+            self.codes.pop(previous, None)
+        else:
+            return None
+        self.display.change_keyboard_mapping(keycode, [(keysym, keysym)])
+        self.remapped[keycode] = keysym
+        cached = self.codes[keysym] = (keycode, False)
+        return cached
+
+    def _refresh(self):
+        """Forget cached keycodes when the keyboard layout changed"""
+        while self.display.pending_events():
+            event = self.display.next_event()
+            if event.type == X.MappingNotify:
+                self.display.refresh_keyboard_mapping(event)
+                self.codes.clear()
+
+    def _press(self):
+        """Send the queued strokes, each a list of keycodes pressed in order and released in reverse"""
+        strokes, self.strokes = self.strokes, []
+        for keycodes in strokes:
+            for keycode in keycodes:
+                xtest.fake_input(self.display, X.KeyPress, keycode, time=self.delay_ms)
+            for keycode in reversed(keycodes):
+                xtest.fake_input(self.display, X.KeyRelease, keycode)
+        # Errors surface here rather than on some later request
+        self.display.sync()
+
+    def _stroke(self, keysym):
+        found = self._keycode(keysym)
+        if found is None:
+            return None
+        keycode, shifted = found
+        return [self.shift[0], keycode] if shifted and self.shift else [keycode]
+
+    def type(self, text):
+        with self.lock:
+            try:
+                self._refresh()
+                for char in text:
+                    if char < ' ' and char not in '\n\t':
+                        continue
+                    stroke = self._stroke(self.keysym(char))
+                    if stroke is None:
+                        self.strokes = []
+                        return False
+                    self.strokes.append(stroke)
+                self._press()
+                return True
+            except Exception as e:
+                self.strokes = []
+                print(f"⚠️  XTEST typing failed: {e}")
+                return False
+
+    def key(self, keys, repeat=1):
+        with self.lock:
+            try:
+                self._refresh()
+                strokes = []
+                for combination in keys.split():
+                    stroke = []
+                    for name in combination.split('+'):
+                        keysym = XK.string_to_keysym(self.MODIFIERS.get(name.lower(), name))
+                        if not keysym and len(name) == 1:
+                            keysym = self.keysym(name)
+                        found = self._keycode(keysym) if keysym else None
+                        if found is None:
+                            print(f"⚠️  Unknown key: {name}")
+                            return False
+                        stroke.append(found[0])
+                    strokes.append(stroke)
+                self.strokes = strokes * repeat
+                self._press()
+                return True
+            except Exception as e:
+                self.strokes = []
+                print(f"⚠️  XTEST key failed: {e}")
+                return False
+
+    def focused_window(self):
+        return self.focus.focused()
+
+    def clipboard(self):
+        return self.selection if self.selection.available() else None
+
+    def close(self):
+        with self.lock:
+            try:
+                for keycode in self.remapped:
+                    self.display.change_keyboard_mapping(keycode, [(X.NoSymbol, X.NoSymbol)])
+                self.display.close()
+            except Exception:
+                pass
+            self.remapped.clear()
+        self.selection.close()
+
+class SubprocessBackend(TypingBackend):
+    """Legacy backend: one `xdotool` process per call"""
+    name = 'subprocess'
+
+    def __init__(self, timeout=1.5):
+        self.timeout = timeout
+        self.focus = FocusTracker()
+        self.selection = ClipboardOwner()
+
+    def _run(self, args):
+        try:
+            result = subprocess.run(['xdotool'] + args, capture_output=True, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return result.returncode == 0
+
+    def type(self, text):
+        return self._run(['type', text])
+
+    def key(self, keys, repeat=1):
+        return self._run(['key'] + keys.split() * repeat)
+
+    def focused_window(self):
+        return self.focus.focused()
+
+    def clipboard(self):
+        return self.selection if self.selection.available() else None
+
+    def close(self):
+        self.selection.close()
+
+class FakeBackend(TypingBackend):
+    """Records typing calls in memory instead of touching the display (for tests)"""
+    name = 'fake'
+
+    def __init__(self, fail=False, window=None):
+        self.fail = fail
+        self.window = window
+        self.events = []
+        self.lock = threading.Lock()
+
+    def type(self, text):
+        with self.lock:
+            self.events.append(('type', text))
+        return not self.fail
+
+    def key(self, keys, repeat=1):
+        with self.lock:
+            self.events.extend([('key', keys)] * repeat)
+        return not self.fail
+
+    def focused_window(self):
+        return self.window
+
+    @property
+    def text(self):
+        """Text as it would appear on screen, with BackSpace applied"""
+        output = []
+        with self.lock:
+            for kind, value in self.events:
+                if kind == 'type':
+                    output.extend(value)
+                elif value == 'BackSpace' and output:
+                    output.pop()
+                elif value == 'Return':
+                    output.append('\n')
+                elif value == 'Tab':
+                    output.append('\t')
+        return ''.join(output)
+
+BACKENDS = {
+    'xtest': XTestBackend,
+    'xdotool': XdotoolBackend,
+    'subprocess': SubprocessBackend,
+    'fake': FakeBackend,
+}
+
+def xtest_usable():
+    """Whether the in-process XTEST backend can be tried: python-xlib and an X display"""
+    return xtest is not None and bool(os.environ.get('DISPLAY'))
+
+def create_backend(name):
+    """Create a typing backend by name from configuration; 'auto' prefers XTEST over xdotool"""
+    if name in ('auto', 'xtest'):
+        try:
+            if not xtest_usable():
+                raise OSError("needs python-xlib and $DISPLAY")
+            return XTestBackend(delay_ms=int(settings.typing.delay * 1000))
+        except Exception as e:
+            if name == 'xtest':
+                raise ValueError(f"XTEST typing unavailable: {e}")
+            print(f"ℹ️  In-process typing unavailable ({e}), using one xdotool per call")
+        return SubprocessBackend(timeout=settings.typing.timeout)
+    if name == 'xdotool':
+        return XdotoolBackend(delay_ms=int(settings.typing.delay * 1000), timeout=settings.typing.timeout)
+    if name == 'subprocess':
+        return SubprocessBackend(timeout=settings.typing.timeout)
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    raise ValueError(f"Unknown typing backend: {name}")
+
+# A key press produced by a spoken command, e.g. KeyAction('Return', 1)
+KeyAction = collections.namedtuple('KeyAction', 'keys repeat')
+
+# Erase the last `count` typed units (utterances); resolved by resolve_undo()
+UndoAction = collections.namedtuple('UndoAction', 'count')
+
+# Compiled form of one spoken command
+CommandRule = collections.namedtuple('CommandRule', 'text key repeat caps attach undo')
+
+# Spoken commands understood out of the box; "commands" in config.json adds
+# to these, and mapping a phrase to null removes it
+DEFAULT_COMMANDS = {
+    'comma': ',',
+    'period': '.',
+    'full stop': '.',
+    'question mark': '?',
+    'exclamation mark': '!',
+    'exclamation point': '!',
+    'colon': ':',
+    'semicolon': ';',
+    'new line': '\n',
+    'new paragraph': '\n\n',
+    'caps on': {'caps': True},
+    'caps off': {'caps': False},
+    'press enter': {'key': 'Return'},
+    'press tab': {'key': 'Tab'},
+    'scratch that': {'undo': 1},
+}
+
+# Phrases that end a short utterance as a complete sentence
+SENTENCE_ENDINGS = (
+    'thank you', 'thanks', 'please', 'okay', 'ok', 'yes', 'no',
+    'good', 'great', 'fine', 'sure', 'right', 'correct', 'exactly'
+)
+
+def compile_rule(spec):
+    """Compile a command spec (a string to insert, or a dict) into a CommandRule.
+
+    Raises ValueError for a spec of the wrong shape, since it comes straight
+    from config.json.
+    """
+    if isinstance(spec, str):
+        spec = {'text': spec}
+    if not isinstance(spec, dict):
+        raise ValueError("expected text or an object")
+    text = spec.get('text', '')
+    if not isinstance(text, str):
+        raise ValueError("text must be a string")
+    key = spec.get('key')
+    if isinstance(key, list) and key and all(isinstance(name, str) and name.strip() for name in key):
+        key = ' '.join(key)  # Pressed one after the other, as in `xdotool key a b`
+    if key is not None and (not isinstance(key, str) or not key.strip()):
+        raise ValueError("key must be a key name or a list of them")
+    counts = {}
+    for name, default, least in (('repeat', 1, 1), ('undo', 0, 0)):
+        value = spec.get(name, default)
+        if not isinstance(value, int) or isinstance(value, bool) or value < least:
+            raise ValueError(f"{name} must be an integer of at least {least}")
+        counts[name] = value
+    caps = spec.get('caps')
+    if caps is not None and not isinstance(caps, bool):
+        raise ValueError("caps must be true or false")
+    # Punctuation and line breaks stick to the previous word
+    attach = spec.get('attach', bool(text) and text[0] in ',.?!:;\n')
+    if not isinstance(attach, bool):
+        raise ValueError("attach must be true or false")
+    return CommandRule(text, key, counts['repeat'], caps, attach, counts['undo'])
+
+class CommandState:
+    """Command state that carries over between utterances (caps lock)"""
+
+    def __init__(self):
+        self.caps = False
+
+class CommandEngine:
+    """Spoken commands and punctuation, compiled once into a word trie.
+
+    process() makes a single pass over the transcript; at each word it
+    follows the trie for at most the longest phrase, so the cost per
+    utterance does not grow with the number of rules.
+    """
+
+    def __init__(self, commands):
+        self.trie = {}
+        for phrase, spec in commands.items():
+            words = phrase.lower().split()
+            if not words or spec is None:
+                continue
+            try:
+                rule = compile_rule(spec)
+            except ValueError as e:
+                raise ValueError(f"command {phrase!r}: {e}") from None
+            node = self.trie
+            for word in words:
+                node = node.setdefault(word, {})
+            node[None] = rule
+        self.endings = {tuple(phrase.split()) for phrase in SENTENCE_ENDINGS}
+        self.longest_ending = max(len(ending) for ending in self.endings)
+
+    @classmethod
+    def from_config(cls, config):
+        commands = dict(DEFAULT_COMMANDS)
+        commands.update(config.get('commands', {}))
+        return cls(commands)
+
+    def process(self, text, state=None):
+        """Turn a transcript into a list of text strings and KeyActions"""
+        words = text.split()
+        lowered = [word.lower() for word in words]
+        caps = state.caps if state else False
+        ops = []
+        pieces = []
+        space = False       # A space is due before the next word
+        tail_words = 0      # Plain words since the last command
+        i = 0
+        n = len(words)
+        while i < n:
+            # Longest command starting at this word
+            node = self.trie
+            rule = None
+            end = j = i
+            while j < n:
+                node = node.get(lowered[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    rule = node[None]
+                    end = j
+            
+            if rule is None:
+                if space:
+                    pieces.append(' ')
+                pieces.append(words[i].upper() if caps else words[i])
+                space = True
+                tail_words += 1
+                i += 1
+                continue
+            
+            i = end
+            tail_words = 0
+            if rule.caps is not None:
+                caps = rule.caps
+            if rule.text:
+                if space and not rule.attach:
+                    pieces.append(' ')
+                pieces.append(rule.text)
+                space = not rule.text.endswith('\n')
+            if rule.key:
+                if pieces:
+                    ops.append(''.join(pieces))
+                    pieces = []
+                ops.append(KeyAction(rule.key, rule.repeat))
+                space = False
+            if rule.undo:
+                if pieces:
+                    ops.append(''.join(pieces))
+                    pieces = []
+                ops.append(UndoAction(rule.undo))
+                space = False
+        
+        if state:
+            state.caps = caps
+        if pieces:
+            tail = ''.join(pieces)
+            if tail_words:
+                tail = self._finish_sentence(tail, lowered, len(words), tail_words)
+            elif tail.endswith(('.', '!', '?')):
+                tail += ' '
+            ops.append(tail)
+        return ops
+
+    def _finish_sentence(self, text, lowered, total_words, tail_words):
+        """Add a period and space when the utterance reads like a complete thought"""
+        if text.endswith(('.', '!', '?')):
+            return text + ' '
+        if text.endswith((':', ';', ',')) or total_words <= 2:
+            return text
+        ends_with_phrase = any(
+            tuple(lowered[-size:]) in self.endings
+            for size in range(1, min(self.longest_ending, tail_words) + 1))
+        if ends_with_phrase or total_words > 3:
+            return text + '. '
+        return text
+
+
+def is_word_char(char):
+    return char.isalnum() or char in "'_"
+
+class Vocabulary:
+    """User corrections and snippet expansions, matched with an Aho-Corasick automaton.
+
+    Phrases match case-insensitively on whole words; overlapping matches are
+    resolved leftmost-longest. Matching is one pass over the transcript
+    whatever the number of entries. The compiled automaton is cached on disk
+    keyed on the source file's path, size and mtime, so startup only pays
+    for a marshal load.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, entries=()):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [-1]  # Entry index ending at each state, or -1
+        self.link = [-1]    # Nearest state down the fail chain with an output
+        self.lengths = []
+        self.replacements = []
+        for phrase, replacement in entries:
+            self._add(' '.join(phrase.lower().split()), replacement)
+        self._build_links()
+
+    def __len__(self):
+        return len(self.replacements)
+
+    def _add(self, phrase, replacement):
+        if not phrase:
+            return
+        state = 0
+        for char in phrase:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(-1)
+                self.link.append(-1)
+            state = nxt
+        if self.output[state] >= 0:
+            self.replacements[self.output[state]] = replacement
+            return
+        self.output[state] = len(self.replacements)
+        self.lengths.append(len(phrase))
+        self.replacements.append(replacement)
+
+    def _build_links(self):
+        """Breadth-first pass filling in failure and output links"""
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, nxt in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.link[nxt] = target if self.output[target] >= 0 else self.link[target]
+                pending.append(nxt)
+
+    @staticmethod
+    def parse(lines):
+        """Yield (phrase, replacement) pairs from 'phrase => replacement' lines"""
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or '=>' not in line:
+                continue
+            phrase, replacement = line.split('=>', 1)
+            yield phrase.strip(), replacement.strip().replace('\\n', '\n')
+
+    @classmethod
+    def load(cls, path, cache_dir):
+        """Load a vocabulary file, using the compiled cache when it is current.
+
+        There is one cache file per vocabulary path, holding the size and
+        mtime it was built from, so edits overwrite it instead of adding files.
+        """
+        try:
+            info = os.stat(path)
+        except OSError:
+            return cls()
+        path = os.path.abspath(path)
+        key = f"{path}:{info.st_size}:{info.st_mtime_ns}:{cls.CACHE_VERSION}"
+        cache_path = os.path.join(cache_dir, f"vocab-{hashlib.sha1(path.encode()).hexdigest()[:16]}.bin")
+        try:
+            with open(cache_path, 'rb') as f:
+                # marshal.load() on a file reads in tiny chunks; loads() is far faster
+                cached_key, data = marshal.loads(f.read())
+            if cached_key == key:
+                return cls.from_compiled(data)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            vocabulary = cls(cls.parse(f))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(marshal.dumps((key, vocabulary.compiled())))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"⚠️  Could not cache vocabulary: {e}")
+        return vocabulary
+
+    def compiled(self):
+        return (self.goto, self.fail, self.output, self.link, self.lengths, self.replacements)
+
+    @classmethod
+    def from_compiled(cls, data):
+        vocabulary = cls()
+        (vocabulary.goto, vocabulary.fail, vocabulary.output, vocabulary.link,
+         vocabulary.lengths, vocabulary.replacements) = data
+        return vocabulary
+
+    def apply(self, text):
+        """Replace every whole-word vocabulary phrase in text"""
+        if not self.replacements:
+            return text
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # A few characters change length when lower-cased; keep offsets aligned
+            lowered = ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+        goto, fail, output, link, lengths = self.goto, self.fail, self.output, self.link, self.lengths
+        end = len(text)
+        matches = []
+        state = 0
+        for i, char in enumerate(lowered):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = state if output[state] >= 0 else link[state]
+            while found > 0:
+                index = output[found]
+                start = i - lengths[index] + 1
+                if ((start == 0 or not is_word_char(text[start - 1])) and
+                        (i + 1 == end or not is_word_char(text[i + 1]))):
+                    matches.append((start, i + 1, index))
+                found = link[found]
+        if not matches:
+            return text
+        
+        # Leftmost-longest, non-overlapping
+        matches.sort(key=lambda m: (m[0], -m[1]))
+        pieces = []
+        position = 0
+        for start, stop, index in matches:
+            if start < position:
+                continue
+            pieces.append(text[position:start])
+            pieces.append(self.replacements[index])
+            position = stop
+        pieces.append(text[position:])
+        return ''.join(pieces)
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'voicewriter')
+# Kept across logins and reboots, unlike RUNTIME_DIR: the journal
+STATE_DIR = os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'),
+                         'voicewriter')
+
+def process_ops(text, state=None):
+    """Full transcript pipeline: commands and punctuation, then vocabulary replacements.
+
+    The vocabulary runs last so expansions are typed exactly as written.
+    """
+    current = settings
+    return [current.vocabulary.apply(op) if isinstance(op, str) else op
+            for op in current.commands.process(text, state)]
+
+def process_text(text, state=None):
+    """Apply vocabulary, spoken commands and punctuation, keeping only the text to type"""
+    return ''.join(op for op in process_ops(text, state) if isinstance(op, str))
+
+# Keys that put one character on screen, so one BackSpace takes them back
+INSERTING_KEYS = {'Return', 'KP_Enter', 'Tab', 'space'}
+
+def resolve_undo(ops, units, seq=None):
+    """Turn UndoActions into the BackSpaces that erase the units before them.
+
+    `units` holds (seq, characters) for each unit typed so far, newest last;
+    characters is None when a unit cannot be erased (it pressed other keys),
+    which stops an undo. Text earlier in the same utterance counts as the
+    first unit. Records this utterance's own unit and returns the resolved
+    ops with the seqs that were undone.
+    """
+    resolved = []
+    undone = []
+    erase = 0  # Characters this utterance has put on screen since its last undo
+    for op in ops:
+        if isinstance(op, UndoAction):
+            count = op.count
+            total = 0
+            if erase is None:
+                count = 0
+            elif erase:
+                total += erase
+                count -= 1
+                erase = 0
+            while count and units and units[-1][1] is not None:
+                unit_seq, characters = units.pop()
+                total += characters
+                undone.append(unit_seq)
+                count -= 1
+            if total:
+                resolved.append(KeyAction('BackSpace', total))
+            continue
+        resolved.append(op)
+        if erase is None:
+            continue
+        if isinstance(op, KeyAction):
+            erase = erase + op.repeat if op.keys in INSERTING_KEYS else None
+        else:
+            erase += len(op)
+    if erase != 0:
+        units.append((seq, erase))
+    return resolved, undone
+
+def type_ops(backend, ops, router=None, job=None):
+    """Type a list of text strings and KeyActions in order, one backend call per text run"""
+    job = job or TypingJob()
+    success = True
+    run = []
+    for op in ops:
+        if job.aborted:
+            return False
+        if isinstance(op, KeyAction):
+            if run:
+                success = type_text(backend, ''.join(run), router, job) and success
+                run = []
+            success = backend.key(op.keys, op.repeat) and success
+        elif op:
+            run.append(op)
+    if run and not job.aborted:
+        success = type_text(backend, ''.join(run), router, job) and success
+    return success and not job.aborted
+
+class TokenBucket:
+    """Paces output to an application's input rate.
+
+    Holds up to `burst` characters; refills at `rate` characters per second.
+    A rate of 0 means no pacing.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, count):
+        """Take `count` characters' worth of tokens; returns how long to wait before sending them"""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        return max(0.0, -self.tokens / self.rate)
+
+class TypingJob:
+    """One batch on its way to the screen: how much got there, and whether it was cancelled.
+
+    `is_cancelled` is polled between chunks and `wake` interrupts a pacing
+    wait, so a cancel takes effect within one chunk.
+    """
+
+    def __init__(self, is_cancelled=None, wake=None):
+        self.is_cancelled = is_cancelled or (lambda: False)
+        self.wake = wake or threading.Event()
+        self.bucket = None
+        self.delivered = 0
+        self.aborted = False
+        self.method = None
+
+    def pause(self, seconds):
+        """Wait out a pacing delay; False (and the job aborted) if it was cancelled meanwhile"""
+        if seconds > 0:
+            self.wake.wait(seconds)
+        if self.is_cancelled():
+            self.aborted = True
+        return not self.aborted
+
+def type_direct(backend, text, job):
+    """Direct typing through the persistent backend (fastest)"""
+    return backend.type(text)
+
+def type_paste(backend, text, job):
+    """Clipboard paste (more reliable)"""
+    typing_settings = settings.typing
+    clipboard = backend.clipboard()
+    if clipboard is not None:
+        # Confirmed by the app fetching the text rather than by a fixed sleep
+        return clipboard.paste(text, lambda: backend.key('ctrl+v'), typing_settings.timeout)
+    with tracer.span('spawn:xclip'):
+        subprocess.run(['xclip', '-selection', 'clipboard'], check=True,
+                       input=text.encode(), capture_output=True, timeout=typing_settings.timeout / 2)
+    time.sleep(typing_settings.delay * 10)  # Slightly longer delay for clipboard
+    return backend.key('ctrl+v')
+
+def type_chunked(backend, text, job):
+    """Small batches through the same backend session, paced by the app's token bucket (most reliable)"""
+    size = settings.typing.batch_size
+    for i in range(0, len(text), size):
+        chunk = text[i:i + size]
+        if not job.pause(job.bucket.delay(len(chunk))):
+            return False
+        if not backend.type(chunk):
+            return False
+        job.delivered += len(chunk)
+    return True
+
+# Ways of getting text into the focused window, in the order they are tried
+TYPING_METHODS = {
+    'type': type_direct,
+    'paste': type_paste,
+    'chunked': type_chunked,
+}
+
+def type_text(backend, text, router=None, job=None):
+    """Type processed text, trying each typing method until one works.
+
+    With a router, the method known to work in the focused application is
+    tried first. A method that fails partway hands only the rest of the text
+    on, and a cancelled job stops right away.
+    """
+    job = job or TypingJob()
+    with tracer.span('focus'):
+        app = router.focused_app() if router else None
+    job.bucket = router.bucket(app) if router else TokenBucket(settings.typing.chunk_rate,
+                                                               settings.typing.batch_size)
+    done = 0
+    for method in (router.order(app) if router else TYPING_METHODS):
+        before = job.delivered
+        start = time.perf_counter()
+        try:
+            with tracer.span(f'type:{method}', app=app, chars=len(text) - done):
+                success = TYPING_METHODS[method](backend, text[done:], job)
+        except Exception as e:
+            print(f"❌ Typing by {method} failed: {e}")
+            success = False
+        elapsed = time.perf_counter() - start
+        if router:
+            # A cancelled method did not fail; keep its route
+            router.record(app, method, success or job.aborted, elapsed)
+        metrics.observe('typing_method_seconds', elapsed, method=method)
+        metrics.inc('typing_method_total', method=method,
+                    result='ok' if success else 'cancelled' if job.aborted else 'failed')
+        if success:
+            job.delivered = before + len(text) - done
+            job.method = method
+            return True
+        done += job.delivered - before
+        if job.aborted:
+            return False
+        metrics.inc('typing_fallbacks_total', method=method)
+    return False
+
+# The typing method remembered for one application, and when to re-probe
+Route = collections.namedtuple('Route', 'method expires')
+
+class RouteStats:
+    """Attempts, failures and latency of one typing method in one application"""
+
+    def __init__(self):
+        self.attempts = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, success, seconds):
+        self.attempts += 1
+        self.failures += not success
+        self.total_time += seconds
+        self.max_time = max(self.max_time, seconds)
+
+    def as_dict(self):
+        return {'attempts': self.attempts, 'failures': self.failures,
+                'mean_ms': round(self.total_time / self.attempts * 1000, 3) if self.attempts else 0,
+                'max_ms': round(self.max_time * 1000, 3)}
+
+class TypingRouter:
+    """Remembers which typing method works in each application.
+
+    Applications are told apart by the focused window's WM class. Once a
+    method works there it is tried first, so an app that rejects direct
+    typing stops paying for the failed attempt. A route is re-probed from the
+    fastest method after `typing.route_ttl` seconds, and dropped as soon as
+    its method fails.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.routes = {}
+        self.buckets = {}
+        self.stats = collections.defaultdict(lambda: collections.defaultdict(RouteStats))
+        self.lock = threading.Lock()
+
+    def focused_app(self):
+        try:
+            window = self.backend.focused_window()
+        except Exception:
+            window = None
+        return window.wm_class if window and window.wm_class else 'unknown'
+
+    def bucket(self, app):
+        """The token bucket pacing chunked typing into an application"""
+        typing_settings = settings.typing
+        rate = typing_settings.app_rates.get(app, typing_settings.chunk_rate)
+        bucket = self.buckets.get(app)
+        if bucket is None or bucket.rate != rate or bucket.burst != typing_settings.batch_size:
+            bucket = self.buckets[app] = TokenBucket(rate, typing_settings.batch_size)
+        return bucket
+
+    def order(self, app):
+        """Typing methods to try in an application, best known first"""
+        route = self.routes.get(app)
+        if route is None or route.expires <= time.time():
+            return list(TYPING_METHODS)
+        return [route.method] + [method for method in TYPING_METHODS if method != route.method]
+
+    def record(self, app, method, success, seconds):
+        now = time.time()
+        with self.lock:
+            self.stats[app][method].record(success, seconds)
+            route = self.routes.get(app)
+            if success:
+                # Keep the expiry of a live route so a slower method is re-probed in time
+                if route is None or route.method != method or route.expires <= now:
+                    self.routes[app] = Route(method, now + settings.typing.route_ttl)
+            elif route is not None and route.method == method:
+                del self.routes[app]
+
+    def snapshot(self):
+        """Routes and per-route statistics, as plain data"""
+        now = time.time()
+        with self.lock:
+            return {app: {'route': self.routes[app].method if app in self.routes else None,
+                          'expires_in': round(max(0.0, self.routes[app].expires - now), 1)
+                                        if app in self.routes else None,
+                          'methods': {method: stats.as_dict() for method, stats in methods.items()}}
+                    for app, methods in self.stats.items()}
+
+def common_prefix_length(a, b):
+    """Length of the common prefix of two strings"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+# Upper bounds in seconds shared by every latency histogram
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name: (Prometheus type, help); names are exported with a voicewriter_ prefix
+METRICS = {
+    'transcripts_total': ('counter', 'Transcripts received, by result (queued, duplicate, suspicious, rejected, full)'),
+    'utterances_total': ('counter', 'Queued utterances finished, by state (typed, error, cancelled, flushed, superseded)'),
+    'typed_latency_seconds': ('histogram', 'Time from a transcript being queued to it being typed'),
+    'queue_wait_seconds': ('histogram', 'Time a transcript waited in the queue before typing started'),
+    'session_events_total': ('counter', 'Ordering events on numbered transcripts, by event (reordered, gap_skipped, stale, limited)'),
+    'typing_method_seconds': ('histogram', 'Time spent in each typing method'),
+    'typing_method_total': ('counter', 'Typing method attempts, by method and result'),
+    'typing_fallbacks_total': ('counter', 'Times a typing method failed and the next one was tried'),
+    'typed_characters_total': ('counter', 'Characters delivered to the focused window'),
+    'typing_seconds_total': ('counter', 'Time the typing thread spent typing'),
+    'audio_received_seconds_total': ('counter', 'Seconds of audio streamed in by pages'),
+    'audio_seconds_total': ('counter', 'Seconds of speech sent to the recognition workers'),
+    'recognition_seconds': ('histogram', 'Time a recognition worker spent on one speech segment'),
+    'uptime_seconds': ('gauge', 'Seconds since the process started'),
+    'resident_memory_bytes': ('gauge', 'Resident set size of the process'),
+    'typed_characters_per_second': ('gauge', 'Characters typed per second over the last minute'),
+    'queue_depth': ('gauge', 'Transcripts waiting in the typing queue'),
+    'sessions': ('gauge', 'Client sessions sending numbered transcripts'),
+}
+
+class Histogram:
+    """Fixed-bucket histogram; memory does not grow with the number of observations"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Cumulative bucket counts (ending with +Inf) and the sum"""
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        return list(itertools.accumulate(counts)), total
+
+    @staticmethod
+    def quantile(cumulative, buckets, q):
+        """Upper bound of the bucket holding the q-quantile; None if it is beyond the last bucket"""
+        if not cumulative[-1]:
+            return 0.0
+        rank = q * cumulative[-1]
+        for bound, count in zip(buckets, cumulative):
+            if count >= rank:
+                return bound
+        return None
+
+class RateWindow:
+    """Events per second over the last `seconds`, kept in one slot per second"""
+
+    def __init__(self, seconds=60):
+        self.seconds = seconds
+        self.slots = [0] * seconds
+        self.stamps = [0] * seconds
+        self.lock = threading.Lock()
+
+    def add(self, amount, now=None):
+        second = int(time.time() if now is None else now)
+        index = second % self.seconds
+        with self.lock:
+            if self.stamps[index] != second:
+                self.stamps[index] = second
+                self.slots[index] = 0
+            self.slots[index] += amount
+
+    def rate(self, now=None):
+        second = int(time.time() if now is None else now)
+        with self.lock:
+            total = sum(count for count, stamp in zip(self.slots, self.stamps)
+                        if second - stamp < self.seconds)
+        return total / self.seconds
+
+def process_rss():
+    """Resident set size of this process in bytes, from /proc; 0 where unavailable"""
     try:
-        with open('config.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # Default configuration
-        return {
-            "server": {"port": 8000, "host": "localhost"},
-            "typing": {"timeout": 1.5, "batch_size": 10, "delay": 0.005},
-            "browser": {"preferred": "chrome", "fallback": "firefox"},
-            "speech": {"language": "en-US", "continuous": True, "interim_results": True},
-            "ui": {"theme": "default", "auto_close": True}
-        }
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+class Metrics:
+    """Server-wide counters and histograms behind /metrics and /metrics.json.
+
+    Every label takes values from a small fixed set (methods, states,
+    results), so memory stays fixed however long the server runs. Recording
+    costs a dict lookup and a short critical section.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.characters = RateWindow()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def typed(self, characters, seconds):
+        self.inc('typed_characters_total', characters)
+        self.inc('typing_seconds_total', seconds)
+        self.characters.add(characters)
+
+    def gauges(self, httpd=None):
+        values = {'uptime_seconds': time.perf_counter() - START_TIME,
+                  'resident_memory_bytes': process_rss(),
+                  'typed_characters_per_second': self.characters.rate()}
+        if httpd is not None:
+            values['queue_depth'] = httpd.typing_queue.depth()
+            values['sessions'] = len(httpd.sessions.sessions)
+        return values
+
+    @staticmethod
+    def format_value(value):
+        return str(value) if isinstance(value, int) else repr(float(value))
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    @staticmethod
+    def json_key(labels):
+        return ','.join(f'{key}={value}' for key, value in labels) or 'total'
+
+    def prometheus(self, httpd=None):
+        """Everything in the Prometheus text exposition format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        lines = []
+        described = set()
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP voicewriter_{name} {help_text}")
+                lines.append(f"# TYPE voicewriter_{name} {kind}")
+        for (name, labels), value in counters:
+            describe(name, *METRICS[name])
+            lines.append(f"voicewriter_{name}{self.format_labels(labels)} {self.format_value(value)}")
+        for (name, labels), histogram in histograms:
+            describe(name, *METRICS[name])
+            cumulative, total = histogram.snapshot()
+            bounds = [f"{bound:g}" for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, cumulative):
+                lines.append(f"voicewriter_{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"voicewriter_{name}_sum{self.format_labels(labels)} {self.format_value(total)}")
+            lines.append(f"voicewriter_{name}_count{self.format_labels(labels)} {cumulative[-1]}")
+        for name, value in self.gauges(httpd).items():
+            describe(name, *METRICS[name])
+            lines.append(f"voicewriter_{name} {self.format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def as_json(self, httpd=None):
+        """The same data as plain JSON, with p50/p95/p99 estimated from the buckets"""
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+        result = dict(self.gauges(httpd), counters={}, histograms={})
+        for (name, labels), value in counters:
+            result['counters'].setdefault(name, {})[self.json_key(labels)] = value
+        for (name, labels), histogram in histograms:
+            cumulative, total = histogram.snapshot()
+            count = cumulative[-1]
+            result['histograms'].setdefault(name, {})[self.json_key(labels)] = {
+                'count': count,
+                'mean': total / count if count else 0.0,
+                'p50': Histogram.quantile(cumulative, histogram.buckets, 0.50),
+                'p95': Histogram.quantile(cumulative, histogram.buckets, 0.95),
+                'p99': Histogram.quantile(cumulative, histogram.buckets, 0.99),
+                'buckets': dict(zip([f"{bound:g}" for bound in histogram.buckets] + ['+Inf'], cumulative)),
+            }
+        return result
+
+metrics = Metrics()
+
+# What a span or profile sample costs when tracing and profiling are off
+NO_SPAN = contextlib.nullcontext()
+
+class Span:
+    """One timed stage of a request or typing batch; recorded when the block exits"""
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.tracer.record('X', self.name, self.start, end - self.start, self.args)
+
+class Tracer:
+    """Opt-in spans for each stage of a transcript's way to the screen, saved as Chrome trace JSON.
+
+    The file opens in chrome://tracing and ui.perfetto.dev. Events go to a
+    bounded deque, so a forgotten trace costs fixed memory. Off, a span is a
+    flag check returning a shared no-op context manager.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = collections.deque(maxlen=200000)
+        self.threads = {}
+
+    def start(self, max_events=200000):
+        if self.events.maxlen != max_events:
+            self.events = collections.deque(maxlen=max_events)
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def span(self, name, **args):
+        """Time a `with` block as one span"""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def flow(self, seq, end=False):
+        """Link the request that queued `seq` to the batch that typed it"""
+        if self.enabled:
+            self.record('f' if end else 's', 'transcript', time.perf_counter_ns(), 0, seq)
+
+    def record(self, phase, name, start, duration, args):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        self.events.append((phase, name, start, duration, tid, args))
+
+    def trace_events(self):
+        """The recorded events in Chrome's trace event format"""
+        pid = os.getpid()
+        events = [{'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in list(self.threads.items())]
+        for phase, name, start, duration, tid, args in list(self.events):
+            event = {'ph': phase, 'name': name, 'cat': 'voicewriter', 'pid': pid, 'tid': tid,
+                     'ts': start / 1000}
+            if phase == 'X':
+                event['dur'] = duration / 1000
+                if args:
+                    event['args'] = args
+            else:
+                event['id'] = args
+                if phase == 'f':
+                    event['bp'] = 'e'  # Bind to the enclosing batch span
+            events.append(event)
+        return events
+
+    def dump(self, path):
+        """Write the trace to `path`; returns how many events it holds"""
+        events = self.trace_events()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+class ProfileSample:
+    """cProfile for one `with` block, merged into the profiler's totals afterwards"""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.profile = None
+
+    def __enter__(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return self  # Another profiler is active (Python 3.12+ allows only one)
+        self.profile = profile
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profiler.add(self.profile)
+
+class Profiler:
+    """Profiles one in `every` /type requests and typing batches with cProfile.
+
+    Sampling keeps the slowdown to a fraction of the traffic while the
+    merged statistics still show where the time goes. Dumps are pstats
+    files for `python3 -m pstats` or snakeviz.
+    """
+
+    def __init__(self):
+        self.every = 0
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = None
+        self.samples = 0
+
+    def start(self, every):
+        with self.lock:
+            self.every = every
+            self.stats = None
+            self.samples = 0
+
+    def stop(self):
+        self.every = 0
+
+    def sample(self):
+        """Profile the `with` block if it is one of the sampled ones"""
+        every = self.every
+        if not every or next(self.counter) % every:
+            return NO_SPAN
+        return ProfileSample(self)
+
+    def add(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.samples += 1
+
+    def top(self, count=10):
+        """The functions with the most time of their own, in seconds"""
+        with self.lock:
+            if self.stats is None:
+                return []
+            rows = sorted(self.stats.stats.items(), key=lambda row: row[1][2], reverse=True)[:count]
+        return [{'function': pstats.func_std_string(function), 'calls': nc,
+                 'own': round(tt, 6), 'cumulative': round(ct, 6)}
+                for function, (cc, nc, tt, ct, callers) in rows]
+
+    def dump(self, path):
+        """Write the merged statistics to `path`; returns how many samples they hold"""
+        with self.lock:
+            if self.stats is None:
+                return 0
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.stats.dump_stats(path)
+            return self.samples
+
+tracer = Tracer()
+profiler = Profiler()
+
+class Journal:
+    """Append-only JSON-lines log of what was typed, for replaying a session.
+
+    Records are buffered in memory and written by a background thread every
+    `flush_interval` seconds, or sooner once `flush_records` are waiting,
+    with one fsync per write. Past `max_bytes` the file rotates to
+    journal.jsonl.1, .2, ... keeping `keep` old files.
+    """
+
+    def __init__(self, path, max_bytes=1024 * 1024, keep=3, flush_interval=1.0, flush_records=64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.lock = threading.Lock()  # Guards the buffer
+        self.write_lock = threading.Lock()  # Guards the file
+        self.buffer = []
+        self.due = threading.Event()
+        self.closed = False
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        self.file = self._open()
+        self.thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        """Queue one record; never blocks on the disk"""
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            if self.closed:
+                return
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_records:
+                self.due.set()
+
+    def flush(self):
+        """Write and fsync everything buffered, rotating the file when it is full"""
+        with self.write_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+            if not lines or self.file is None:
+                return
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        if self.keep:
+            for index in range(self.keep - 1, 0, -1):
+                older = f"{self.path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+        self.file = self._open()
+
+    def _open(self):
+        # Every dictated word is in here: readable by the owner only, even if the file existed
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.fchmod(fd, 0o600)
+        return os.fdopen(fd, 'a', encoding='utf-8')
+
+    def _run(self):
+        while not self.closed:
+            self.due.wait(self.flush_interval)
+            self.due.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"⚠️  Journal write failed: {e}")
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.due.set()
+        self.thread.join(2)
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"⚠️  Journal write failed: {e}")
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def read_journal(paths):
+    """Records from journal files, oldest file first; unreadable lines are skipped"""
+    records = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # A line cut short by a crash
+    return records
+
+# One queued typing request; `utterance` is set for incremental (interim) hypotheses
+QueueItem = collections.namedtuple('QueueItem', 'seq text utterance final submitted session')
+
+class TypingQueue:
+    """Server-wide bounded queue of utterances, typed by one consumer thread.
+
+    Each session (a page, or a client address) has its own FIFO and the
+    consumer takes turns between sessions, so one busy client cannot starve
+    the others. A session typing an utterance incrementally keeps its turn
+    until the utterance is final, or idle for `utterance_hold` seconds, so
+    words from two sessions never interleave. When a session backs up, its
+    consecutive short utterances are coalesced into a single backend call,
+    and stale interim hypotheses are dropped in favour of the newest one.
+    """
+
+    def __init__(self, backend, maxsize=100, coalesce_chars=80, min_interval=0.1,
+                 history=1000, utterance_hold=1.0):
+        self.backend = backend
+        self.router = TypingRouter(backend)
+        self.maxsize = maxsize
+        self.coalesce_chars = coalesce_chars
+        self.min_interval = min_interval
+        self.history = history
+        self.utterance_hold = utterance_hold
+        self.lock = threading.Lock()
+        self.typed = threading.Condition(self.lock)
+        self.ready = threading.Condition(self.lock)
+        self.sessions = {}                  # session -> deque of QueueItems
+        self.turns = collections.deque()    # Sessions with queued items, next turn first
+        self.size = 0
+        self.pending = set()                # Sequence ids queued or being typed
+        self.holder = None                  # Session keeping its turn mid-utterance
+        self.hold_until = 0
+        self.stopping = False
+        self.next_seq = 1
+        self.flush_seq = 0
+        self.wake = threading.Event()
+        self.last_delivery = None
+        self.results = collections.OrderedDict()
+        self.last_typing_time = 0
+        self.listeners = []
+        # Incremental typing state, only touched by the consumer thread
+        self.current_utterance = None
+        self.current_typed = ''
+        self.finished_utterances = collections.OrderedDict()
+        self.command_state = CommandState()
+        self.units = collections.deque(maxlen=100)  # What an undo can erase, see resolve_undo()
+        self.journal = None
+        self.thread = threading.Thread(target=self._run, name='typing-queue', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self, timeout=2):
+        """Stop the consumer after the utterances already queued"""
+        with self.lock:
+            self.stopping = True
+            self.ready.notify()
+        self.thread.join(timeout)
+
+    def submit(self, text, utterance=None, final=True, session=None):
+        """Queue an utterance, returning its sequence id or None if the queue is full.
+
+        With an `utterance` id the text is a hypothesis for that utterance:
+        only the difference from what was already typed for it is typed.
+        Utterances of one `session` are typed in the order submitted, and a
+        hypothesis replaces a queued interim one for the same utterance.
+        """
+        superseded = None
+        with self.lock:
+            items = self.sessions.get(session)
+            if (utterance is not None and items and items[-1].utterance == utterance
+                    and not items[-1].final):
+                superseded = items.pop()  # Only the newest hypothesis would be typed anyway
+                self.size -= 1
+            if self.size >= self.maxsize:
+                return None
+            seq = self.next_seq
+            self.next_seq += 1
+            tracer.flow(seq)  # Before the consumer can take it
+            if items is None:
+                items = self.sessions[session] = collections.deque()
+                self.turns.append(session)
+            items.append(QueueItem(seq, text, utterance, final, time.monotonic(), session))
+            self.size += 1
+            self.pending.add(seq)
+            self.ready.notify()
+        if superseded is not None:
+            self._record([superseded], 'superseded')
+        return seq
+
+    def undo(self, count=1, session=None):
+        """Queue erasing the last `count` typed utterances; returns the sequence id or None"""
+        return self.submit(UndoAction(count), session=session)
+
+    def depth(self):
+        return self.size
+
+    def session_depth(self, session):
+        """Queued utterances of one session, not counting interim hypotheses a newer one replaces"""
+        with self.lock:
+            return sum(1 for item in self.sessions.get(session, ())
+                       if item.utterance is None or item.final)
+
+    @property
+    def typed_seq(self):
+        """The highest sequence id with nothing at or below it still pending"""
+        with self.lock:
+            return self._typed_seq()
+
+    def _typed_seq(self):
+        return min(self.pending) - 1 if self.pending else self.next_seq - 1
+
+    def add_listener(self, callback):
+        """Call callback(seq, state) from the consumer thread whenever an utterance finishes"""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def status(self, seq):
+        """Report the state of a sequence id: queued, typed, error or unknown"""
+        with self.lock:
+            if seq <= 0 or seq >= self.next_seq:
+                return 'unknown'
+            if seq in self.pending:
+                return 'queued'
+            return self.results.get(seq, 'typed')
+
+    def wait(self, seq, timeout):
+        """Block until a sequence id has been typed or the timeout expires"""
+        with self.typed:
+            self.typed.wait_for(lambda: seq not in self.pending, timeout)
+        return self.status(seq)
+
+    def flush(self):
+        """Drop everything queued but not yet typed; returns how many were pending"""
+        with self.lock:
+            self.flush_seq = self.next_seq - 1
+            self.holder = None
+            self.ready.notify()
+            return len(self.pending)
+
+    def cancel(self, timeout=1.0):
+        """Stop typing now: drop the queue and abort the batch being typed within one chunk.
+
+        Returns how many utterances were still pending, and for an aborted
+        batch how many characters had been delivered.
+        """
+        with self.lock:
+            target = self.next_seq - 1
+            before = set(self.pending)
+        dropped = self.flush()
+        self.wake.set()
+        with self.typed:
+            self.typed.wait_for(lambda: not any(seq <= target for seq in self.pending), timeout)
+        delivery = self.last_delivery
+        if delivery is None or delivery['seq'] not in before or delivery['state'] != 'cancelled':
+            delivery = None
+        return {'dropped': dropped, 'aborted': delivery}
+
+    def _pop(self, session):
+        items = self.sessions[session]
+        item = items.popleft()
+        self.size -= 1
+        if not items:
+            del self.sessions[session]
+            self.turns.remove(session)
+        return item
+
+    def _peek(self, session):
+        items = self.sessions.get(session)
+        return items[0] if items else None
+
+    def _take(self):
+        """Pop the next session's oldest item, blocking; None once stopping and drained"""
+        while True:
+            if self.holder is not None:
+                if self.holder in self.sessions:
+                    return self._pop(self.holder)
+                wait = self.hold_until - time.monotonic()
+                if wait > 0 and not self.stopping:
+                    self.ready.wait(wait)
+                    continue
+                self.holder = None
+            if self.turns:
+                session = self.turns[0]
+                self.turns.rotate(-1)
+                return self._pop(session)
+            if self.stopping:
+                return None
+            self.ready.wait()
+
+    def _next_batch(self):
+        """Take the next item plus whatever its session queued behind it that can be merged into one call"""
+        while True:
+            with self.lock:
+                item = self._take()
+                if item is None:
+                    return None
+                if item.seq > self.flush_seq:
+                    return self._extend(item)
+            self._record([item], 'flushed')
+
+    def _extend(self, item):
+        batch = [item]
+        if item.utterance is not None:
+            # Only the newest hypothesis for an utterance needs typing
+            while not batch[-1].final:
+                following = self._peek(item.session)
+                if following is None or following.utterance != item.utterance:
+                    break
+                batch.append(self._pop(item.session))
+            return batch
+        length = len(item.text)
+        while length <= self.coalesce_chars:
+            following = self._peek(item.session)
+            if (following is None or following.utterance is not None
+                    or length + len(following.text) > self.coalesce_chars):
+                break
+            batch.append(self._pop(item.session))
+            length += len(following.text)
+        return batch
+
+    def _finish_utterance(self):
+        if self.current_utterance is not None:
+            self.finished_utterances[self.current_utterance] = True
+            while len(self.finished_utterances) > self.history:
+                self.finished_utterances.popitem(last=False)
+        self.current_utterance = None
+        self.current_typed = ''
+
+    def _type_hypothesis(self, item, job, entries):
+        """Bring the typed text of an utterance in line with its newest hypothesis"""
+        key = (item.session, item.utterance)
+        if key in self.finished_utterances:
+            return True  # Late interim result for an utterance already finalized
+        if key != self.current_utterance:
+            self._finish_utterance()
+            self.current_utterance = key
+        if item.final:
+            # Key actions from commands run after the text that precedes them
+            with tracer.span('process_text'):
+                ops, undone = resolve_undo(process_ops(item.text, self.command_state),
+                                           self.units, item.seq)
+            entries.append((item, ''.join(op for op in ops if isinstance(op, str)), undone))
+            split = next((i for i, op in enumerate(ops) if isinstance(op, KeyAction)), len(ops))
+            target = ''.join(ops[:split])
+            after = ops[split:]
+        else:
+            target = item.text.strip()
+            after = []
+        typed = self.current_typed
+        prefix = common_prefix_length(typed, target)
+        success = True
+        if len(typed) > prefix:
+            with tracer.span('backspace', count=len(typed) - prefix):
+                success = self.backend.key('BackSpace', len(typed) - prefix)
+        if success and len(target) > prefix:
+            success = type_text(self.backend, target[prefix:], self.router, job)
+        # What is on screen is what was delivered
+        self.current_typed = target[:prefix + job.delivered] if job.aborted else target
+        if item.final:
+            if not job.aborted:
+                success = type_ops(self.backend, after, self.router, job) and success
+            self._finish_utterance()
+        return success
+
+    def _record(self, batch, state):
+        """Publish the outcome of a batch to status queries, waiters and listeners"""
+        metrics.inc('utterances_total', len(batch), state=state)
+        if state == 'typed':
+            now = time.monotonic()
+            for item in batch:
+                metrics.observe('typed_latency_seconds', now - item.submitted)
+        with self.typed:
+            for item in batch:
+                self.results[item.seq] = state
+                self.pending.discard(item.seq)
+            while len(self.results) > self.history:
+                self.results.popitem(last=False)
+            self.typed.notify_all()
+            listeners = list(self.listeners)
+        for callback in listeners:
+            for item in batch:
+                try:
+                    callback(item.seq, state)
+                except Exception as e:
+                    print(f"⚠️  Typing listener failed: {e}")
+
+    def _journal(self, entries, state, method):
+        journal = self.journal
+        if journal is None:
+            return
+        now = time.monotonic()
+        timestamp = round(time.time(), 3)
+        for item, text, undone in entries:
+            record = {'ts': timestamp, 'seq': item.seq, 'raw': item.text, 'text': text,
+                      'method': method, 'latency': round(now - item.submitted, 4), 'state': state}
+            if isinstance(item.text, UndoAction):
+                record['raw'] = None
+                record['count'] = item.text.count
+                record['undo'] = undone
+            elif undone:
+                record['undo'] = undone
+            if item.utterance is not None:
+                record['utterance'] = item.utterance
+            if item.session is not None:
+                record['session'] = item.session
+            journal.append(record)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            with tracer.span('batch', seqs=[item.seq for item in batch]), profiler.sample():
+                try:
+                    self._type_batch(batch)
+                except Exception as e:
+                    # One bad batch must not stop everything queued behind it
+                    print(f"❌ Typing failed: {e}")
+                    self.units.clear()
+                    self._finish_utterance()
+                    self._record(batch, 'error')
+            last = batch[-1]
+            with self.lock:
+                if last.utterance is not None and not last.final and last.seq > self.flush_seq:
+                    # Keep the turn until the utterance is final or its session goes quiet
+                    self.holder = last.session
+                    self.hold_until = time.monotonic() + self.utterance_hold
+                elif self.holder == last.session:
+                    self.holder = None
+
+    def _type_batch(self, batch):
+        """Type one batch and publish its outcome"""
+        for item in batch:
+            tracer.flow(item.seq, end=True)
+        self.wake.clear()
+        last_seq = batch[-1].seq
+        job = TypingJob(lambda: last_seq <= self.flush_seq, self.wake)
+        
+        # Rate limiting - keep a minimum gap between typing operations
+        wait = self.last_typing_time + self.min_interval - time.time()
+        with tracer.span('rate_limit'):
+            paused = job.pause(wait)
+        if not paused:
+            self._record(batch, 'flushed')
+            return
+        
+        start_time = time.time()
+        started = time.monotonic()
+        for item in batch:
+            metrics.observe('queue_wait_seconds', started - item.submitted)
+        entries = []  # (item, processed text, undone seqs) for the journal
+        if batch[-1].utterance is not None:
+            text = batch[-1].text
+            success = self._type_hypothesis(batch[-1], job, entries)
+        else:
+            self._finish_utterance()
+            ops = []
+            with tracer.span('process_text'):
+                for item in batch:
+                    if isinstance(item.text, UndoAction):
+                        item_ops = [item.text]
+                    else:
+                        item_ops = process_ops(item.text, self.command_state)
+                    item_ops, undone = resolve_undo(item_ops, self.units, item.seq)
+                    entries.append((item, ''.join(op for op in item_ops if isinstance(op, str)), undone))
+                    ops.extend(item_ops)
+            text = ''.join(op for op in ops if isinstance(op, str))
+            success = type_ops(self.backend, ops, self.router, job)
+        self.last_typing_time = time.time()
+        typing_time = self.last_typing_time - start_time
+        if typing_time > 0.5:  # Log slow typing
+            print(f"⏱️  Typing took {typing_time:.2f}s")
+        metrics.typed(job.delivered, typing_time)
+        
+        state = 'cancelled' if job.aborted else 'typed' if success else 'error'
+        self.last_delivery = {'seq': last_seq, 'state': state,
+                              'chars': len(text), 'delivered': job.delivered}
+        if job.aborted:
+            print(f"🛑 Typing cancelled after {job.delivered} of {len(text)} characters")
+        if state != 'typed':
+            self.units.clear()  # What is on screen is no longer known
+        self._journal(entries, state, job.method)
+        self._record(batch, state)
+        
+        # Memory optimization - garbage collection for long texts
+        if len(text) > 100:
+            with tracer.span('gc.collect'):
+                gc.collect()
+
+# One utterance cut from an audio stream; times are seconds from the stream's start
+Segment = collections.namedtuple('Segment', 'start end pcm')
+
+class VoiceActivityDetector:
+    """Cuts a 16-bit mono PCM stream into utterances and drops the silence between them.
+
+    Every complete 30 ms frame of a chunk gets its RMS energy and
+    zero-crossing rate at once, vectorized with NumPy when it is installed.
+    A frame is speech when it is loud, or a quarter as loud with many zero
+    crossings (fricatives such as "s" and "f"). An utterance opens with up
+    to `pre_roll` seconds of the audio before its first speech frame, held
+    in a ring buffer, so soft onsets are not clipped. It ends after a
+    `hangover` of quiet or at `max_segment` seconds. It is dropped when it
+    holds less than `min_speech` seconds of speech (clicks, coughs).
+    """
+
+    def __init__(self, sample_rate, threshold=500, zcr_threshold=0.25, hangover=0.6, pre_roll=0.3,
+                 min_speech=0.1, max_segment=15.0, frame_ms=30, vectorized=None):
+        self.frame_samples = max(2, sample_rate * frame_ms // 1000)
+        self.frame_bytes = 2 * self.frame_samples
+        self.frame_seconds = self.frame_samples / sample_rate
+        self.threshold = threshold
+        self.zcr_threshold = zcr_threshold
+        self.hangover_frames = max(1, round(hangover / self.frame_seconds))
+        self.min_speech_frames = round(min_speech / self.frame_seconds)
+        self.max_frames = max(1, round(max_segment / self.frame_seconds))
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        self.pending = bytearray()
+        self.ring = collections.deque(maxlen=round(pre_roll / self.frame_seconds))
+        self.frames = []    # The utterance in progress
+        self.start = 0      # Index of its first frame
+        self.voiced = 0     # Speech frames in it
+        self.quiet = 0      # Frames since its last speech frame
+        self.position = 0   # Index of the next frame
+
+    def classify(self, data, count):
+        """Speech flags for the first `count` frames of `data`"""
+        size = self.frame_samples
+        if self.vectorized:
+            frames = numpy.frombuffer(data, dtype='<i2', count=count * size).reshape(count, size)
+            frames = frames.astype(numpy.float32)
+            energy = numpy.sqrt(numpy.mean(frames * frames, axis=1))
+            negative = frames < 0
+            zcr = numpy.count_nonzero(negative[:, 1:] != negative[:, :-1], axis=1) / (size - 1)
+            speech = (energy >= self.threshold) | ((energy >= self.threshold / 4)
+                                                   & (zcr >= self.zcr_threshold))
+            return speech.tolist()
+        flags = []
+        samples = array.array('h', data[:count * self.frame_bytes])
+        for offset in range(0, count * size, size):
+            frame = samples[offset:offset + size]
+            energy = math.sqrt(sum(map(operator.mul, frame, frame)) / size)
+            if energy >= self.threshold:
+                flags.append(True)
+            elif energy >= self.threshold / 4:
+                negative = [sample < 0 for sample in frame]
+                zcr = sum(map(operator.ne, negative[1:], negative[:-1])) / (size - 1)
+                flags.append(zcr >= self.zcr_threshold)
+            else:
+                flags.append(False)
+        return flags
+
+    def feed(self, pcm):
+        """Take more audio; returns the utterances it completed"""
+        self.pending += pcm
+        count = len(self.pending) // self.frame_bytes
+        if not count:
+            return []
+        usable = count * self.frame_bytes
+        data = bytes(self.pending[:usable])
+        del self.pending[:usable]
+        flags = self.classify(data, count)
+        if not self.frames and not any(flags):
+            # Silence between utterances: only the pre-roll is worth keeping
+            for index in range(max(0, count - self.ring.maxlen), count):
+                self.ring.append(data[index * self.frame_bytes:(index + 1) * self.frame_bytes])
+            self.position += count
+            return []
+        segments = []
+        for index, speech in enumerate(flags):
+            frame = data[index * self.frame_bytes:(index + 1) * self.frame_bytes]
+            self.position += 1
+            if not self.frames:
+                if not speech:
+                    self.ring.append(frame)
+                    continue
+                self.start = self.position - 1 - len(self.ring)
+                self.frames.extend(self.ring)
+                self.ring.clear()
+            self.frames.append(frame)
+            if speech:
+                self.voiced += 1
+                self.quiet = 0
+            else:
+                self.quiet += 1
+            if self.quiet >= self.hangover_frames or len(self.frames) >= self.max_frames:
+                segment = self._cut()
+                if segment:
+                    segments.append(segment)
+        return segments
+
+    def finish(self):
+        """The utterance in progress when the stream ends, or None"""
+        return self._cut() if self.frames else None
+
+    def _cut(self):
+        # Keep as much trailing quiet as the pre-roll; the rest of the hangover holds no words
+        keep = len(self.frames) - max(0, self.quiet - self.ring.maxlen)
+        frames = self.frames[:keep]
+        self.ring.extend(self.frames[keep:])  # Pre-roll for the next utterance
+        voiced = self.voiced
+        self.frames = []
+        self.voiced = 0
+        self.quiet = 0
+        if voiced < max(1, self.min_speech_frames):
+            return None
+        return Segment(self.start * self.frame_seconds, (self.start + keep) * self.frame_seconds,
+                       b''.join(frames))
+
+class FakeRecognizer:
+    """Describes each segment instead of recognizing it; no model needed (for tests)"""
+    name = 'fake'
+
+    def __init__(self, model=''):
+        self.model = model
+
+    def recognize(self, pcm, sample_rate):
+        return f"speech of {len(pcm) / 2 / sample_rate:.2f} seconds"
+
+class VoskRecognizer:
+    """Offline recognition with a Vosk (Kaldi) model directory"""
+    name = 'vosk'
+
+    def __init__(self, model):
+        vosk.SetLogLevel(-1)
+        self.model = vosk.Model(model)
+
+    @staticmethod
+    def check(model):
+        if vosk is None:
+            raise ValueError("recognition.engine 'vosk' needs the vosk package: pip install vosk")
+        if not os.path.isdir(model):
+            raise ValueError(f"recognition.model: no Vosk model directory at {model}")
+
+    def recognize(self, pcm, sample_rate):
+        recognizer = vosk.KaldiRecognizer(self.model, sample_rate)
+        recognizer.AcceptWaveform(pcm)
+        return json.loads(recognizer.FinalResult()).get('text', '')
+
+RECOGNIZERS = {
+    'fake': FakeRecognizer,
+    'vosk': VoskRecognizer,
+}
+
+# The engine a recognition worker process loaded at startup
+worker_recognizer = None
+
+def load_recognizer(engine, model):
+    """Worker initializer: load the model once for every segment this process will see"""
+    global worker_recognizer
+    start = time.perf_counter()
+    worker_recognizer = RECOGNIZERS[engine](model)
+    print(f"🧠 {engine} recognizer ready in worker {os.getpid()} "
+          f"({(time.perf_counter() - start) * 1000:.0f} ms)")
+
+def recognize_segment(pcm, sample_rate):
+    """Runs in a worker: one segment to (text, seconds spent)"""
+    start = time.perf_counter()
+    text = worker_recognizer.recognize(pcm, sample_rate)
+    return text, time.perf_counter() - start
+
+class RecognitionPool:
+    """Worker processes that load the recognizer at startup and turn speech segments into text.
+
+    Recognition is CPU-bound, so it runs in processes rather than threads.
+    They are spawned rather than forked, which is safe with the server's
+    threads and the X connection already running.
+    """
+
+    def __init__(self, engine, model, workers):
+        self.engine = engine
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(max(1, workers), initializer=load_recognizer, initargs=(engine, model))
+
+    @staticmethod
+    def model_path(model):
+        """A relative model path is found next to voicewriter.py"""
+        return os.path.join(SCRIPT_DIR, os.path.expanduser(model)) if model else ''
+
+    @staticmethod
+    def check(engine, model):
+        """Raise ValueError now rather than have every worker fail to start"""
+        recognizer = RECOGNIZERS.get(engine)
+        if recognizer is None:
+            raise ValueError(f"Unknown recognition engine: {engine}")
+        if hasattr(recognizer, 'check'):
+            recognizer.check(model)
+
+    def recognize(self, pcm, sample_rate, callback, error_callback):
+        self.pool.apply_async(recognize_segment, (pcm, sample_rate),
+                              callback=callback, error_callback=error_callback)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+# Lowest and highest sample rate a page may stream audio at
+SAMPLE_RATES = (8000, 48000)
+
+class AudioStream:
+    """One page's microphone stream: cut into utterances, recognized in parallel, delivered in order"""
+
+    def __init__(self, pool, sample_rate, deliver, options):
+        self.pool = pool
+        self.sample_rate = sample_rate
+        self.deliver = deliver
+        self.vad = VoiceActivityDetector(sample_rate, options.threshold, options.zcr_threshold,
+                                         options.silence, options.pre_roll, options.min_speech,
+                                         options.max_segment)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.delivered = 0
+        self.results = {}
+
+    def feed(self, pcm):
+        metrics.inc('audio_received_seconds_total', len(pcm) / 2 / self.sample_rate)
+        with tracer.span('vad', bytes=len(pcm)):
+            segments = self.vad.feed(pcm)
+        for segment in segments:
+            self._submit(segment)
+
+    def finish(self):
+        segment = self.vad.finish()
+        if segment:
+            self._submit(segment)
+
+    def _submit(self, segment):
+        """Only speech reaches the workers"""
+        index = self.submitted
+        self.submitted += 1
+        metrics.inc('audio_seconds_total', segment.end - segment.start)
+        self.pool.recognize(segment.pcm, self.sample_rate,
+                            lambda result: self._done(index, segment, result),
+                            lambda error: self._done(index, segment, None, error))
+
+    def _done(self, index, segment, result, error=None):
+        """Collect a worker's result; hand transcripts on in the order they were spoken"""
+        if error is not None:
+            print(f"⚠️  Recognition failed: {error}")
+        with self.lock:
+            self.results[index] = (segment, result)
+            while self.delivered in self.results:
+                segment, result = self.results.pop(self.delivered)
+                self.delivered += 1
+                if result is None:
+                    continue
+                text, seconds = result
+                metrics.observe('recognition_seconds', seconds)
+                if text:
+                    try:
+                        self.deliver(text, segment)
+                    except Exception as e:
+                        print(f"⚠️  Transcript delivery failed: {e}")
+
+class DedupCache:
+    """Server-wide suppression of transcripts the recognizer sends twice.
+
+    Entries are keyed on (session, normalized text), where normalizing drops
+    case, punctuation and extra whitespace, so a re-emitted sentence with
+    different capitalization still counts as a repeat. Entries expire after
+    `window` seconds and the cache never holds more than `max_entries`.
+    """
+    STRIP_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+    def __init__(self, window=1.0, max_entries=256):
+        self.window = window
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, text):
+        return ' '.join(text.lower().translate(cls.STRIP_PUNCTUATION).split())
+
+    def is_duplicate(self, session, text, now=None):
+        """Record a transcript, returning True if it repeats one seen within the window"""
+        now = time.time() if now is None else now
+        key = (session, self.normalize(text))
+        with self.lock:
+            seen = self.entries.get(key)
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return seen is not None and now - seen < self.window
+
+    def forget(self, session, text):
+        """Drop a transcript that was recorded but never queued"""
+        with self.lock:
+            self.entries.pop((session, self.normalize(text)), None)
+
+class ClientSession:
+    """Ordering state and counters of one client session"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.next_n = 1             # The number expected next
+        self.buffer = {}            # n -> (transcript or None if rejected, arrival time)
+        self.last_seen = time.monotonic()
+        self.counts = collections.Counter()
+
+    def buffered(self, interim=True):
+        """Transcripts waiting in the reorder buffer, optionally leaving out interim hypotheses"""
+        return sum(1 for transcript, _ in self.buffer.values()
+                   if transcript is not None and (interim or transcript[1] is None or transcript[2]))
 
-# Load configuration
-config = load_config()
+class SessionTable:
+    """Per-session ordering and limits in front of the typing queue.
 
-class VoiceWriterHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.last_processed_text = ""
-        self.last_processed_time = 0
-        self.min_interval = 0.5  # Minimum time between processing same text
-        super().__init__(*args, **kwargs)
+    Clients number their transcripts 1, 2, 3... within a session, but
+    separate requests can arrive out of order. One that arrives early waits
+    in a reorder buffer of at most `reorder_window` entries until the ones
+    before it arrive; a gap still open after `gap_timeout` seconds is
+    skipped, so a lost request never stalls the session. Numbers below the
+    next expected one are stale repeats. A session may have at most
+    `max_pending` transcripts buffered or queued, and sessions are dropped
+    after `idle_timeout` seconds or beyond `max_sessions`.
+    """
+
+    def __init__(self, deliver, pending, reorder_window=32, gap_timeout=0.5, max_pending=20,
+                 idle_timeout=300.0, max_sessions=64):
+        self.deliver = deliver  # deliver(session, text, utterance, final) -> (HTTP status, payload)
+        self.pending = pending  # pending(session) -> utterances queued for typing
+        self.reorder_window = reorder_window
+        self.gap_timeout = gap_timeout
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()  # Least recently seen first
+        self.seqs = {}  # Typing sequence id -> session, until typed
+        self.lock = threading.RLock()  # Superseding a hypothesis calls on_typed() from accept()
+        self.changed = threading.Condition(self.lock)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='session-gaps', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.changed.notify()
+        self.thread.join(1)
+
+    def accept(self, session_id, n, text, utterance=None, final=True):
+        """Take transcript number `n` of a session; returns (HTTP status, response payload)"""
+        with self.lock:
+            session = self._session(session_id)
+            session.counts['received'] += 1
+            if n < session.next_n or n in session.buffer:
+                self._count(session, 'stale')
+                return 200, {'status': 'skipped', 'message': 'Stale sequence number', 'n': n}
+            # Interim hypotheses are superseded rather than typed, so only the others count
+            if session.buffered(interim=False) + self.pending(session_id) >= self.max_pending:
+                self._count(session, 'limited')
+                # Later numbers need not wait for this one
+                session.buffer[n] = (None, time.monotonic())
+                self._release(session)
+                return 429, {'status': 'error', 'message': 'Too many pending transcripts', 'n': n}
+            session.buffer[n] = ((text, utterance, final), time.monotonic())
+            if n == session.next_n:
+                return self._release(session)[n]
+            self._count(session, 'reordered')
+            buffered = (202, {'status': 'buffered', 'n': n})
+            if len(session.buffer) <= self.reorder_window:
+                self.changed.notify()  # Start the gap clock
+                return buffered
+            return self._skip_gap(session).get(n, buffered)
+
+    def on_typed(self, seq, state):
+        """Typing queue listener counting outcomes per session"""
+        with self.lock:
+            session = self.sessions.get(self.seqs.pop(seq, None))
+            if session is not None:
+                session.counts[state] += 1
+
+    def snapshot(self):
+        """Per-session status for GET /sessions and the control socket"""
+        now = time.monotonic()
+        with self.lock:
+            sessions = list(self.sessions.values())
+            return {session.id: dict(session.counts, next=session.next_n,
+                                     buffered=session.buffered(),
+                                     queued=self.pending(session.id),
+                                     idle=round(now - session.last_seen, 1))
+                    for session in sessions}
+
+    def _count(self, session, event, amount=1):
+        session.counts[event] += amount
+        metrics.inc('session_events_total', amount, event=event)
+
+    def _session(self, session_id):
+        now = time.monotonic()
+        session = self.sessions.get(session_id)
+        if session is None:
+            # A page that outlived a restart waits out one gap timeout, then carries on
+            session = self.sessions[session_id] = ClientSession(session_id)
+        session.last_seen = now
+        self.sessions.move_to_end(session_id)
+        while True:
+            oldest = next(iter(self.sessions.values()))
+            if oldest is session or (len(self.sessions) <= self.max_sessions
+                                     and now - oldest.last_seen < self.idle_timeout):
+                break
+            while oldest.buffer:
+                self._skip_gap(oldest)  # Type what it sent before forgetting it
+            del self.sessions[oldest.id]
+        return session
+
+    def _release(self, session):
+        """Hand the transcripts that are next in line to the typing queue, in order"""
+        replies = {}
+        while session.next_n in session.buffer:
+            n = session.next_n
+            transcript, _ = session.buffer.pop(n)
+            session.next_n += 1
+            if transcript is None:
+                continue
+            code, payload = self.deliver(session.id, *transcript)
+            if 'seq' in payload:
+                self.seqs[payload['seq']] = session.id
+            replies[n] = (code, dict(payload, n=n))
+        return replies
+
+    def _skip_gap(self, session):
+        """Give up on the missing numbers before the oldest buffered transcript"""
+        first = min(session.buffer)
+        self._count(session, 'gap_skipped', first - session.next_n)
+        print(f"⏭️  Session {session.id[:8]}: skipping {first - session.next_n} missing transcript(s)")
+        session.next_n = first
+        return self._release(session)
+
+    def _run(self):
+        with self.lock:
+            while not self.closed:
+                now = time.monotonic()
+                deadline = None
+                for session in list(self.sessions.values()):
+                    while session.buffer:
+                        expires = min(arrival for _, arrival in session.buffer.values()) + self.gap_timeout
+                        if expires > now:
+                            deadline = expires if deadline is None else min(deadline, expires)
+                            break
+                        self._skip_gap(session)
+                self.changed.wait(None if deadline is None else deadline - now)
+
+class Liveness:
+    """Tracks whether the page is still open, from inside the server.
+
+    Every request or heartbeat from the page refreshes `last_seen`, and open
+    WebSocket streams keep the session alive outright. Once the last stream
+    closes, or the page says goodbye, the session ends after `close_grace`
+    seconds unless the page comes back; with no streams, it ends after
+    `idle_timeout` seconds without a heartbeat.
+    """
+
+    def __init__(self, idle_timeout=900.0, close_grace=2.0):
+        self.idle_timeout = idle_timeout
+        self.close_grace = close_grace
+        self.changed = threading.Condition()
+        self.last_seen = None
+        self.closed_at = None
+        self.streams = 0
+
+    def touch(self):
+        with self.changed:
+            if self.last_seen is None:
+                self.changed.notify_all()  # First contact starts the idle clock
+            self.last_seen = time.time()
+            self.closed_at = None
+
+    def stream_opened(self):
+        with self.changed:
+            self.streams += 1
+            self.last_seen = time.time()
+            self.closed_at = None
+
+    def stream_closed(self):
+        with self.changed:
+            self.streams -= 1
+            self.last_seen = time.time()
+            if self.streams == 0:
+                self.closed_at = self.last_seen
+            self.changed.notify_all()
+
+    def goodbye(self):
+        """The page is being unloaded"""
+        with self.changed:
+            self.closed_at = time.time()
+            self.changed.notify_all()
+
+    def wait_until_gone(self):
+        """Block until the page has been seen and then gone away"""
+        with self.changed:
+            while True:
+                if self.streams or self.last_seen is None:
+                    self.changed.wait()
+                    continue
+                deadline = self.last_seen + self.idle_timeout
+                if self.closed_at is not None:
+                    deadline = min(deadline, self.closed_at + self.close_grace)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.changed.wait(remaining)
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def unmask(payload, mask):
+    """XOR a client frame payload with its 4-byte mask"""
+    n = len(payload)
+    if not n:
+        return payload
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+class WebSocket:
+    """Minimal server side of an RFC 6455 WebSocket over a handler's rfile/wfile"""
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    def __init__(self, rfile, wfile, max_message):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.max_message = max_message
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def accept_key(key):
+        """Compute Sec-WebSocket-Accept for a client's Sec-WebSocket-Key"""
+        digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        return base64.b64encode(digest).decode()
+
+    def _read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError('WebSocket connection closed')
+        return data
+
+    def receive(self):
+        """Return the next (opcode, payload) data message, or None once the peer closes"""
+        message = None
+        message_opcode = None
+        while True:
+            first, second = self._read_exact(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read_exact(8))[0]
+            if not second & 0x80:
+                raise ConnectionError('Client frames must be masked')
+            mask = self._read_exact(4)
+            if length > self.max_message:
+                self.close(1009)
+                raise ConnectionError('WebSocket frame too large')
+            payload = unmask(self._read_exact(length), mask)
+            
+            if opcode == self.OP_CLOSE:
+                self.close()
+                return None
+            if opcode == self.OP_PING:
+                self.send(payload, self.OP_PONG)
+                continue
+            if opcode == self.OP_PONG:
+                continue
+            if opcode == self.OP_CONTINUATION:
+                if message is None:
+                    raise ConnectionError('Unexpected continuation frame')
+                message += payload
+                if len(message) > self.max_message:
+                    self.close(1009)
+                    raise ConnectionError('WebSocket message too large')
+            else:
+                message_opcode = opcode
+                message = bytearray(payload)
+            if first & 0x80:
+                return message_opcode, bytes(message)
+
+    def send(self, payload, opcode=OP_TEXT):
+        """Send one unfragmented frame; returns False if the connection is gone"""
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                self.wfile.write(header + payload)
+            except OSError:
+                self.closed = True
+                return False
+        return True
+
+    def send_json(self, payload):
+        return self.send(json.dumps(payload).encode())
+
+    def close(self, code=1000):
+        """Send a close frame once"""
+        if self.send(struct.pack('!H', code), self.OP_CLOSE):
+            self.closed = True
+
+class VoiceWriterServer(socketserver.TCPServer):
+    """TCP server that owns the typing backend and queue shared by all requests"""
+    allow_reuse_address = True
+    request_queue_size = 64  # Bursts of dictation must not overflow the listen backlog
+    streaming = False  # Long-lived WebSockets would block a single-threaded server
+
+    def __init__(self, server_address, handler_class, backend):
+        self.handed_off = False
+        self.debug = None
+        self.journal_settings = None
+        self.liveness = Liveness()
+        self.dedup = DedupCache()
+        self.backend = backend
+        self.typing_queue = TypingQueue(backend, maxsize=settings.typing.queue_size)
+        self.sessions = SessionTable(self.queue_transcript, self.typing_queue.session_depth)
+        self.typing_queue.add_listener(self.sessions.on_typed)
+        self.recognizer = None
+        self.apply_settings(settings)
+        recognition = settings.recognition
+        model = RecognitionPool.model_path(recognition.model)
+        if recognition.engine != 'browser':
+            RecognitionPool.check(recognition.engine, model)
+        super().__init__(server_address, handler_class)
+        self.typing_queue.start()
+        self.sessions.start()
+        if recognition.engine != 'browser':
+            if self.streaming:
+                self.recognizer = RecognitionPool(recognition.engine, model, recognition.workers)
+            else:
+                print('⚠️  Server-side recognition needs server mode "threaded"')
+
+    def apply_settings(self, current):
+        """Take over the tunables of a settings snapshot; queue size, port and backend need a restart"""
+        self.max_body = current.server.max_body
+        self.assets = build_assets()
+        self.liveness.idle_timeout = current.server.idle_timeout
+        self.liveness.close_grace = current.server.close_grace
+        self.dedup.window = current.dedup.window
+        self.dedup.max_entries = current.dedup.max_entries
+        self.typing_queue.coalesce_chars = current.typing.coalesce_chars
+        self.typing_queue.min_interval = current.typing.min_interval
+        self.typing_queue.utterance_hold = current.sessions.utterance_hold
+        for name in ('reorder_window', 'gap_timeout', 'max_pending', 'idle_timeout', 'max_sessions'):
+            setattr(self.sessions, name, getattr(current.sessions, name))
+        if current.journal != self.journal_settings:
+            self.journal_settings = current.journal
+            self.open_journal(current.journal)
+        if current.debug != self.debug:
+            # Only a change to the section itself overrides the control commands
+            self.debug = current.debug
+            configure_debugging(current.debug)
+
+    def open_journal(self, options):
+        """Switch the typing queue to a journal as configured, closing the previous one"""
+        previous = self.typing_queue.journal
+        journal = None
+        if options.enabled:
+            path = os.path.join(STATE_DIR, os.path.expanduser(options.file))
+            try:
+                journal = Journal(path, options.max_bytes, options.keep,
+                                  options.flush_interval, max(1, options.flush_records))
+            except OSError as e:
+                print(f"⚠️  Journal unavailable: {e}")
+        self.typing_queue.journal = journal
+        if previous is not None:
+            previous.close()
+
+    def server_close(self):
+        super().server_close()
+        # A failed bind also lands here; the backend then stays with the caller
+        if self.typing_queue.thread.ident is not None:
+            self.sessions.close()
+            self.typing_queue.close()
+            self.backend.close()
+        if self.typing_queue.journal is not None:
+            self.typing_queue.journal.close()
+            self.typing_queue.journal = None
+        if self.recognizer is not None:
+            self.recognizer.close()
+            self.recognizer = None
+
+    def queue_transcript(self, session, text, utterance=None, final=True):
+        """Validate and queue a transcript for a session; returns (HTTP status, response payload)"""
+        if not isinstance(text, str):
+            metrics.inc('transcripts_total', result='rejected')
+            return 400, {'status': 'error', 'message': 'Text must be a string'}
+        if utterance is not None:
+            # Incremental hypotheses are diffed against what was typed, never filtered
+            seq = self.typing_queue.submit(text.strip(), str(utterance), bool(final), session)
+            if seq is None:
+                metrics.inc('transcripts_total', result='full')
+                return 503, {'status': 'error', 'message': 'Typing queue full'}
+            metrics.inc('transcripts_total', result='queued')
+            return 202, {'status': 'queued', 'seq': seq}
+
+        text = text.strip()
+        if not text:
+            metrics.inc('transcripts_total', result='rejected')
+            return 400, {'status': 'error', 'message': 'No text'}
+
+        # Prevent duplicate processing, across requests and connections
+        if self.dedup.is_duplicate(session, text):
+            print(f"🔄 Skipping duplicate text: {text[:50]}...")
+            metrics.inc('transcripts_total', result='duplicate')
+            return 200, {'status': 'skipped', 'message': 'Duplicate text'}
+
+        # Prevent very short or suspicious text
+        if len(text) < 2 or text.count(text[0]) == len(text):
+            print(f"⚠️  Skipping suspicious text: {text}")
+            metrics.inc('transcripts_total', result='suspicious')
+            return 200, {'status': 'skipped', 'message': 'Suspicious text'}
+
+        print(f"🎤 {text}")
+        seq = self.typing_queue.submit(text, session=session)
+        if seq is None:
+            print("⚠️  Typing queue full, dropping text")
+            self.dedup.forget(session, text)
+            metrics.inc('transcripts_total', result='full')
+            return 503, {'status': 'error', 'message': 'Typing queue full'}
+        metrics.inc('transcripts_total', result='queued')
+
+        # Typing happens on the queue's thread; answer right away
+        return 202, {'status': 'queued', 'seq': seq}
+
+class ThreadingVoiceWriterServer(socketserver.ThreadingMixIn, VoiceWriterServer):
+    """Serves each connection on its own thread so slow clients never block others"""
+    daemon_threads = True
+    streaming = True
+
+class VoiceWriterHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, code, payload):
+        """Send a JSON response"""
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
     
     def do_GET(self):
         """Handle GET requests"""
-        if self.path == '/stop':
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in ('/metrics', '/metrics.json'):
+            self.server.liveness.touch()  # A metrics scraper is not the page
+        if url.path == '/stop':
             print("🛑 Stop request received")
+            body = b'<h1>VoiceWriter Stopped</h1>'
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(b'<h1>VoiceWriter Stopped</h1>')
+            self.wfile.write(body)
+            self.close_connection = True
             # Force server shutdown immediately
             def shutdown_server():
                 try:
@@ -57,90 +3086,319 @@ class VoiceWriterHandler(http.server.SimpleHTTPRequestHandler):
                     # Force exit if normal shutdown fails
                     os._exit(0)
             threading.Timer(0.5, shutdown_server).start()
+        elif url.path == '/ws':
+            self.handle_websocket()
+        elif url.path == '/status':
+            self.handle_status(urllib.parse.parse_qs(url.query))
+        elif url.path == '/sessions':
+            self.handle_sessions(urllib.parse.parse_qs(url.query))
+        elif url.path == '/metrics':
+            body = metrics.prometheus(self.server).encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == '/metrics.json':
+            self.send_json(200, metrics.as_json(self.server))
+        else:
+            self.send_asset(url.path)
+    
+    def do_HEAD(self):
+        """Handle HEAD requests for the UI assets"""
+        self.send_asset(urllib.parse.urlsplit(self.path).path, head=True)
+    
+    def send_asset(self, path, head=False):
+        """Serve an in-memory asset from the route table; nothing is read from disk"""
+        asset = self.server.assets.get(path)
+        if asset is None:
+            self.send_error(404)
+            return
+        
+        accepted = self.headers.get('Accept-Encoding', '')
+        body, encoding, etag = asset.body, None, asset.etag
+        # Each encoding is a different byte sequence, so it gets its own strong ETag
+        if asset.brotli and 'br' in accepted:
+            body, encoding, etag = asset.brotli, 'br', asset.etag[:-1] + '-br"'
+        elif asset.gzip and 'gzip' in accepted:
+            body, encoding, etag = asset.gzip, 'gzip', asset.etag[:-1] + '-gz"'
+        
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            self.send_response(304)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', asset.cache_control)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', asset.cache_control)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+    
+    def handle_status(self, query):
+        """Report whether a sequence id from POST /type has been typed"""
+        typing_queue = self.server.typing_queue
+        try:
+            seq = int(query.get('seq', ['0'])[0])
+            wait = min(float(query.get('wait', ['0'])[0]), 10.0)
+        except ValueError:
+            self.send_json(400, {'status': 'error', 'message': 'Invalid seq'})
+            return
+        # A long poll would hold the only thread of a single-threaded server
+        if wait > 0 and self.server.streaming:
+            state = typing_queue.wait(seq, wait)
         else:
-            super().do_GET()
+            state = typing_queue.status(seq)
+        self.send_json(200, {'seq': seq, 'state': state,
+                             'typed_seq': typing_queue.typed_seq,
+                             'queue_depth': typing_queue.depth()})
+    
+    def handle_sessions(self, query):
+        """Report ordering state and counters per session, or for one with ?id="""
+        sessions = self.server.sessions.snapshot()
+        if 'id' in query:
+            session = sessions.get(query['id'][0])
+            if session is None:
+                self.send_json(404, {'status': 'error', 'message': 'Unknown session'})
+            else:
+                self.send_json(200, dict(session, id=query['id'][0]))
+            return
+        self.send_json(200, {'sessions': sessions})
+    
+    def read_body(self):
+        """Read the request body, bounded by the server's max_body; None means an error was sent"""
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            self.send_json(411, {'status': 'error', 'message': 'Content-Length required'})
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        max_body = self.server.max_body
+        if length < 0 or length > max_body:
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            code = 413 if length > max_body else 400
+            self.send_json(code, {'status': 'error', 'message': 'Invalid Content-Length'})
+            return None
+        return self.rfile.read(length)
+    
+    def submit_transcript(self, text, utterance=None, final=True, session=None, n=None):
+        """Validate and queue a transcript; returns (HTTP status, response payload)
+
+        Transcripts numbered with `n` go through the session's reorder
+        buffer; without a session the client address is the session.
+        """
+        session = str(session or self.client_address[0])
+        if n is None:
+            return self.server.queue_transcript(session, text, utterance, final)
+        if not isinstance(n, int) or isinstance(n, bool) or n < 1:
+            metrics.inc('transcripts_total', result='rejected')
+            return 400, {'status': 'error', 'message': 'Invalid n'}
+        return self.server.sessions.accept(session, n, text, utterance, final)
     
     def do_POST(self):
         """Handle POST requests from the web interface"""
-        if self.path == '/type':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
+        self.server.liveness.touch()
+        if self.path == '/handoff':
+            if self.read_body() is None:
+                return
+            # A newly started instance wants the port
+            print("🔄 Handing over to a new instance...")
+            self.close_connection = True
+            self.send_json(200, {'status': 'stopping'})
+            self.server.handed_off = True
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        elif self.path in ('/heartbeat', '/bye'):
+            if self.read_body() is None:
+                return
+            if self.path == '/bye':
+                self.server.liveness.goodbye()
+            self.send_response(204)
+            self.end_headers()
+        elif self.path == '/cancel':
+            if self.read_body() is None:
+                return
+            self.send_json(200, dict(self.server.typing_queue.cancel(), status='cancelled'))
+        elif self.path == '/undo':
+            post_data = self.read_body()
+            if post_data is None:
+                return
             try:
-                data = json.loads(post_data.decode('utf-8'))
-                text = data.get('text', '').strip()
-                
-                if text:
-                    # Prevent duplicate processing
-                    current_time = time.time()
-                    if (text == self.last_processed_text and 
-                        current_time - self.last_processed_time < self.min_interval):
-                        print(f"🔄 Skipping duplicate text: {text[:50]}...")
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'status': 'skipped', 'message': 'Duplicate text'}).encode())
-                        return
-                    
-                    # Prevent very short or suspicious text
-                    if len(text) < 2 or text.count(text[0]) == len(text):
-                        print(f"⚠️  Skipping suspicious text: {text}")
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.send_header('Access-Control-Allow-Origin', '*')
-                        self.end_headers()
-                        self.wfile.write(json.dumps({'status': 'skipped', 'message': 'Suspicious text'}).encode())
-                        return
-                    
-                    start_time = time.time()
-                    print(f"🎤 {text}")
-                    success = self.type_text(text)
-                    typing_time = time.time() - start_time
-                    if typing_time > 0.5:  # Log slow typing
-                        print(f"⏱️  Typing took {typing_time:.2f}s")
-                    
-                    # Update tracking
-                    self.last_processed_text = text
-                    self.last_processed_time = current_time
-                    
-                    # Memory optimization - garbage collection for long texts
-                    if len(text) > 100:
-                        gc.collect()
-                    
-                    # Send response
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'status': 'success' if success else 'error'}).encode())
-                else:
-                    self.send_response(400)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'status': 'error', 'message': 'No text'}).encode())
-                    
-            except Exception as e:
-                print(f"❌ Error: {e}")
-                try:
-                    self.send_response(500)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'status': 'error', 'message': str(e)}).encode())
-                except:
-                    pass
+                data = json.loads(post_data or b'{}')
+                count = int(data.get('count', 1))
+            except (ValueError, TypeError, AttributeError):
+                count = 0
+            if count < 1:
+                self.send_json(400, {'status': 'error', 'message': 'Invalid count'})
+                return
+            # Typed after what the session already queued
+            session = str(data.get('session') or self.client_address[0])
+            seq = self.server.typing_queue.undo(count, session)
+            if seq is None:
+                self.send_json(503, {'status': 'error', 'message': 'Typing queue full'})
+            else:
+                self.send_json(202, {'status': 'queued', 'seq': seq})
+        elif self.path == '/type':
+            with tracer.span('POST /type'), profiler.sample():
+                self.handle_type()
         else:
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
+    def handle_type(self):
+        """Queue the transcript posted to /type"""
+        with tracer.span('read_body'):
+            post_data = self.read_body()
+        if post_data is None:
+            return
+
+        try:
+            with tracer.span('parse_json'):
+                data = json.loads(post_data.decode('utf-8'))
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            metrics.inc('transcripts_total', result='rejected')
+            self.send_json(400, {'status': 'error', 'message': 'Invalid JSON'})
+            return
+
+        try:
+            with tracer.span('submit'):
+                code, payload = self.submit_transcript(data.get('text', ''),
+                                                       data.get('utterance'),
+                                                       data.get('final', True),
+                                                       data.get('session'), data.get('n'))
+            with tracer.span('respond'):
+                self.send_json(code, payload)
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            try:
+                self.send_json(500, {'status': 'error', 'message': str(e)})
+            except:
+                pass
+    
+    def handle_websocket(self):
+        """Stream transcripts in, and acks plus typing status out, over one WebSocket"""
+        if not self.server.streaming:
+            self.send_json(503, {'status': 'error', 'message': 'Streaming needs server mode "threaded"'})
+            return
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_json(400, {'status': 'error', 'message': 'WebSocket upgrade required'})
+            return
+        
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', WebSocket.accept_key(key))
+        self.end_headers()
+        self.close_connection = True
+        self.connection.settimeout(None)  # The stream idles between utterances
+        
+        ws = WebSocket(self.rfile, self.wfile, self.server.max_body)
+        pending = set()
+        lock = threading.Lock()
+        
+        def on_typed(seq, state):
+            # Holding the lock keeps each status frame behind its ack
+            with lock:
+                if seq in pending:
+                    pending.discard(seq)
+                    ws.send_json({'type': 'status', 'seq': seq, 'state': state})
+        
+        def on_recognized(text, segment):
+            # From a recognition worker: the same path as a transcript from the page
+            with lock:
+                _, result = self.submit_transcript(text)
+                if 'seq' in result:
+                    pending.add(result['seq'])
+                ws.send_json(dict(result, type='ack', text=text,
+                                  start=round(segment.start, 3), end=round(segment.end, 3)))
+        
+        typing_queue = self.server.typing_queue
+        typing_queue.add_listener(on_typed)
+        liveness = self.server.liveness
+        liveness.stream_opened()
+        audio = None
+        try:
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                liveness.touch()
+                if message[0] == WebSocket.OP_BINARY:
+                    # 16-bit little-endian mono PCM from the page's AudioWorklet
+                    if audio is not None:
+                        audio.feed(message[1])
+                    continue
+                try:
+                    frame = json.loads(message[1].decode('utf-8'))
+                except ValueError:
+                    frame = None
+                if not isinstance(frame, dict):
+                    ws.send_json({'type': 'error', 'message': 'Invalid frame'})
+                    continue
+                if frame.get('type') == 'transcript':
+                    final = frame.get('final', True)
+                    with lock:
+                        _, result = self.submit_transcript(frame.get('text', ''),
+                                                           frame.get('utterance'), final,
+                                                           frame.get('session'), frame.get('n'))
+                        # Interim hypotheses are fire-and-forget; only finals are acked
+                        if final or result['status'] not in ('queued', 'buffered'):
+                            if 'seq' in result:
+                                pending.add(result['seq'])
+                            ws.send_json(dict(result, type='ack', id=frame.get('id')))
+                elif frame.get('type') == 'cancel':
+                    # Waits at most one chunk for the batch being typed to stop
+                    ws.send_json(dict(typing_queue.cancel(), type='cancelled'))
+                elif frame.get('type') == 'audio':
+                    if audio is not None:
+                        audio.finish()
+                        audio = None
+                    if frame.get('action') == 'start':
+                        if self.server.recognizer is None:
+                            ws.send_json({'type': 'error', 'message': 'Server-side recognition is off'})
+                            continue
+                        try:
+                            sample_rate = int(frame.get('sampleRate', settings.recognition.sample_rate))
+                        except (TypeError, ValueError, OverflowError):
+                            sample_rate = 0
+                        if not SAMPLE_RATES[0] <= sample_rate <= SAMPLE_RATES[1]:
+                            ws.send_json({'type': 'error', 'message': 'Invalid sample rate'})
+                            continue
+                        audio = AudioStream(self.server.recognizer, sample_rate, on_recognized,
+                                            settings.recognition)
+                else:
+                    ws.send_json({'type': 'error', 'message': 'Unknown frame type'})
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if audio is not None:
+                audio.finish()  # Still type what was said before the page went away
+            typing_queue.remove_listener(on_typed)
+            liveness.stream_closed()
+            ws.close()
+    
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def end_headers(self):
@@ -149,110 +3407,45 @@ class VoiceWriterHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
-    
-    def process_text(self, text):
-        """Process text to add punctuation and formatting - optimized"""
-        if not text or not text.strip():
-            return text
-        
-        # Clean up the text
-        text = text.strip()
-        
-        # Quick check for existing punctuation
-        if text.endswith(('.', '!', '?', ':', ';', ',')):
-            # Just add space if needed
-            if text.endswith('.') and not text.endswith('. '):
-                text += ' '
-            return text
-        
-        # Optimized sentence detection
-        words = text.split()
-        if len(words) <= 2:
-            return text  # Too short to be a sentence
-        
-        # Use set for faster lookups
-        sentence_endings = {
-            'thank you', 'thanks', 'please', 'okay', 'ok', 'yes', 'no',
-            'good', 'great', 'fine', 'sure', 'right', 'correct', 'exactly'
-        }
-        
-        # Check last few words for ending phrases
-        text_lower = text.lower()
-        ends_with_phrase = any(text_lower.endswith(ending) for ending in sentence_endings)
-        
-        # Add period if it seems like a complete thought
-        if ends_with_phrase or len(words) > 5:
-            text += '. '
-        elif len(words) > 3:  # Medium length sentences
-            text += '. '
-        
-        return text
-    
-    def type_text(self, text):
-        """Type text using optimized methods with configuration"""
-        try:
-            # Rate limiting - prevent too rapid typing
-            current_time = time.time()
-            if hasattr(self, 'last_typing_time') and current_time - self.last_typing_time < 0.1:
-                time.sleep(0.1)  # Minimum delay between typing operations
-            self.last_typing_time = current_time
-            
-            # Process text to add punctuation
-            processed_text = self.process_text(text)
-            
-            # Get configuration values
-            timeout = config.get('typing', {}).get('timeout', 1.5)
-            batch_size = config.get('typing', {}).get('batch_size', 10)
-            delay = config.get('typing', {}).get('delay', 0.005)
-            
-            # Method 1: Direct typing (fastest)
-            result = subprocess.run(['xdotool', 'type', processed_text], 
-                                  capture_output=True, timeout=timeout)
-            if result.returncode == 0:
-                return True
-            
-            # Method 2: Clipboard (more reliable)
-            subprocess.run(['xclip', '-selection', 'clipboard'], 
-                         input=processed_text.encode(), capture_output=True, timeout=timeout/2)
-            time.sleep(delay * 10)  # Slightly longer delay for clipboard
-            result = subprocess.run(['xdotool', 'key', 'ctrl+v'], 
-                                  capture_output=True, timeout=timeout/2)
-            if result.returncode == 0:
-                return True
-            
-            # Method 3: Character by character (most reliable)
-            for i in range(0, len(processed_text), batch_size):
-                batch = processed_text[i:i+batch_size]
-                subprocess.run(['xdotool', 'type', batch], 
-                             capture_output=True, timeout=timeout/3)
-                time.sleep(delay)
-            return True
-            
-        except Exception as e:
-            print(f"❌ Typing failed: {e}")
-            return False
 
-def create_html():
-    """Create the optimized HTML interface"""
-    html = '''<!DOCTYPE html>
+class KeepAliveHandler(VoiceWriterHandler):
+    """HTTP/1.1 handler so the browser reuses one connection for every utterance"""
+    protocol_version = 'HTTP/1.1'
+    timeout = 30  # Close idle keep-alive connections
+    # Headers and body are separate writes; without TCP_NODELAY every
+    # response on a reused connection waits out the peer's delayed ACK
+    disable_nagle_algorithm = True
+
+SERVER_MODES = {
+    'single': (VoiceWriterServer, VoiceWriterHandler),
+    'threaded': (ThreadingVoiceWriterServer, KeepAliveHandler),
+}
+
+def create_server(mode, server_address, backend):
+    """Create the HTTP server for a configured mode ('single' or 'threaded')"""
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown server mode: {mode}")
+    server_class, handler_class = SERVER_MODES[mode]
+    return server_class(server_address, handler_class, backend)
+
+def page_settings():
+    """Settings passed from config.json to the page's script"""
+    return {
+        'language': settings.speech.language,
+        'interimTyping': settings.speech.interim_typing,
+        # Well inside the idle timeout; a background tab may still only fire once a minute
+        'heartbeatMs': int(max(1.0, min(settings.server.idle_timeout / 3, 30.0)) * 1000),
+        # Capture audio for the server's recognizer instead of using the browser's
+        'serverRecognition': settings.recognition.engine != 'browser',
+        'sampleRate': settings.recognition.sample_rate,
+    }
+
+UI_HTML = '''<!DOCTYPE html>
 <html>
 <head>
     <title>VoiceWriter</title>
-    <style>
-        body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; background: #f5f5f5; }
-        .container { background: white; padding: 30px; border-radius: 15px; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }
-        button { padding: 15px 30px; font-size: 16px; border: none; border-radius: 8px; cursor: pointer; margin: 8px; transition: all 0.3s; }
-        .start { background: #4CAF50; color: white; }
-        .start:hover { background: #45a049; }
-        .stop { background: #f44336; color: white; }
-        .stop:hover { background: #da190b; }
-        .quit { background: #ff9800; color: white; }
-        .quit:hover { background: #f57c00; }
-        .status { text-align: center; margin: 20px 0; padding: 15px; border-radius: 8px; font-weight: bold; }
-        .ready { background: #e8f5e8; color: #2e7d32; }
-        .recording { background: #fff3e0; color: #ef6c00; }
-        h1 { text-align: center; color: #333; margin-bottom: 30px; }
-    </style>
+    <link rel="icon" href="/favicon.png">
+    <link rel="stylesheet" href="__CSS_URL__">
 </head>
 <body>
     <div class="container">
@@ -265,161 +3458,879 @@ def create_html():
         <div id="status" class="status ready">Ready to dictate</div>
     </div>
 
-    <script>
-        class VoiceWriter {
-            constructor() {
-                this.recognition = null;
-                this.isRecording = false;
-                this.shouldBeRecording = false;
-                this.lastSentText = "";
-                this.lastSentTime = 0;
-                this.initSpeechRecognition();
-                this.bindEvents();
-            }
+    <script>const SETTINGS = __SETTINGS__;</script>
+    <script src="__JS_URL__"></script>
+</body>
+</html>'''
 
-            initSpeechRecognition() {
-                if (!('webkitSpeechRecognition' in window) && !('SpeechRecognition' in window)) {
-                    this.showError('Speech recognition not supported. Use Chrome or Edge.');
-                    return;
-                }
+UI_CSS = '''body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; background: #f5f5f5; }
+.container { background: white; padding: 30px; border-radius: 15px; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }
+button { padding: 15px 30px; font-size: 16px; border: none; border-radius: 8px; cursor: pointer; margin: 8px; transition: all 0.3s; }
+.start { background: #4CAF50; color: white; }
+.start:hover { background: #45a049; }
+.stop { background: #f44336; color: white; }
+.stop:hover { background: #da190b; }
+.quit { background: #ff9800; color: white; }
+.quit:hover { background: #f57c00; }
+.status { text-align: center; margin: 20px 0; padding: 15px; border-radius: 8px; font-weight: bold; }
+.ready { background: #e8f5e8; color: #2e7d32; }
+.recording { background: #fff3e0; color: #ef6c00; }
+h1 { text-align: center; color: #333; margin-bottom: 30px; }
+'''
 
-                const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
-                this.recognition = new SpeechRecognition();
-                
-                this.recognition.continuous = false;  // Changed to false to prevent loops
-                this.recognition.interimResults = false;  // Changed to false to prevent partial results
-                this.recognition.lang = 'en-US';
-                
-                this.recognition.onstart = () => {
-                    this.isRecording = true;
-                    this.updateUI();
-                    this.showStatus('Recording...', 'recording');
-                };
-                
-                this.recognition.onresult = (event) => {
-                    let finalTranscript = '';
-                    
-                    for (let i = event.resultIndex; i < event.results.length; i++) {
-                        const transcript = event.results[i][0].transcript;
-                        if (event.results[i].isFinal) {
-                            finalTranscript += transcript;
-                        }
-                    }
-                    
-                    if (finalTranscript) {
-                        this.sendToPython(finalTranscript);
-                    }
-                };
-                
-                this.recognition.onerror = (event) => {
-                    this.showError(`Error: ${event.error}`);
-                    this.stopRecording();
-                };
-                
-                this.recognition.onend = () => {
-                    this.isRecording = false;
-                    this.updateUI();
-                    this.showStatus('Ready to dictate', 'ready');
-                    
-                    // Restart recognition if it was supposed to be recording
-                    if (this.shouldBeRecording) {
-                        setTimeout(() => {
-                            if (this.shouldBeRecording) {
-                                this.startRecording();
-                            }
-                        }, 100);
-                    }
-                };
+UI_JS = '''class VoiceWriter {
+    constructor() {
+        this.recognition = null;
+        this.isRecording = false;
+        this.shouldBeRecording = false;
+        this.socket = null;
+        this.nextFrameId = 1;
+        this.runId = 0;
+        // Transcripts are numbered per session so the server types them in order
+        this.session = window.crypto && crypto.randomUUID ? crypto.randomUUID()
+                                                          : Math.random().toString(36).slice(2);
+        this.nextN = 1;
+        this.typing = new Set();
+        this.audio = null;
+        this.initSpeechRecognition();
+        this.bindEvents();
+        this.connectStream();
+        this.startHeartbeat();
+    }
+
+    startHeartbeat() {
+        // An open stream already tells the server the page is alive
+        setInterval(() => {
+            if (!this.socket || this.socket.readyState !== WebSocket.OPEN) {
+                fetch('/heartbeat', { method: 'POST' }).catch(() => {});
             }
+        }, SETTINGS.heartbeatMs);
+        window.addEventListener('pagehide', () => navigator.sendBeacon('/bye'));
+    }
 
-            bindEvents() {
-                document.getElementById('startBtn').addEventListener('click', () => this.startRecording());
-                document.getElementById('stopBtn').addEventListener('click', () => this.stopRecording());
-                document.getElementById('quitBtn').addEventListener('click', () => this.quitServer());
+    connectStream() {
+        if (!('WebSocket' in window)) return;
+        const socket = new WebSocket(`ws://${location.host}/ws`);
+        let opened = false;
+        socket.onopen = () => {
+            opened = true;
+            this.socket = socket;
+        };
+        socket.onmessage = (event) => this.handleFrame(JSON.parse(event.data));
+        socket.onclose = () => {
+            this.socket = null;
+            if (this.audio) {
+                this.stopAudio();
             }
+            // A server without streaming refuses the upgrade; keep using fetch then
+            if (opened) {
+                setTimeout(() => this.connectStream(), 1000);
+            }
+        };
+    }
 
-            startRecording() {
-                if (!this.recognition) return;
-                this.shouldBeRecording = true;
-                try {
-                    this.recognition.start();
-                } catch (error) {
-                    this.showError('Error starting recognition');
-                }
+    handleFrame(frame) {
+        if (frame.type === 'ack') {
+            if (frame.seq) {
+                this.typing.add(frame.seq);
+                this.updateUI();
             }
+            if (frame.text && this.audio) {
+                this.showStatus(`Heard: ${frame.text}`, 'recording');
+            }
+            if (frame.status === 'skipped') {
+                console.log('Server skipped text:', frame.message);
+            } else if (frame.status !== 'queued' && frame.status !== 'buffered') {
+                this.showError('Error sending text');
+            }
+        } else if (frame.type === 'status') {
+            this.typing.delete(frame.seq);
+            this.updateUI();
+            if (frame.state === 'error') {
+                this.showError('Typing failed');
+            }
+        } else if (frame.type === 'cancelled') {
+            this.typing.clear();
+            this.updateUI();
+            const aborted = frame.aborted;
+            this.showStatus(aborted ? `Stopped after ${aborted.delivered} of ${aborted.chars} characters`
+                                    : 'Typing stopped', 'ready');
+        } else if (frame.type === 'error') {
+            this.showError(`Error: ${frame.message}`);
+        }
+    }
+
+    initSpeechRecognition() {
+        // Audio goes to the server's recognizer instead
+        if (SETTINGS.serverRecognition) return;
+
+        if (!('webkitSpeechRecognition' in window) && !('SpeechRecognition' in window)) {
+            this.showError('Speech recognition not supported. Use Chrome or Edge.');
+            return;
+        }
+
+        const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
+        this.recognition = new SpeechRecognition();
 
-            stopRecording() {
-                this.shouldBeRecording = false;
-                if (this.recognition && this.isRecording) {
-                    this.recognition.stop();
+        // Low-latency mode types interim results and lets the server correct them
+        this.recognition.continuous = SETTINGS.interimTyping;
+        this.recognition.interimResults = SETTINGS.interimTyping;
+        this.recognition.lang = SETTINGS.language;
+
+        this.recognition.onstart = () => {
+            this.runId++;
+            this.isRecording = true;
+            this.updateUI();
+            this.showStatus('Recording...', 'recording');
+        };
+
+        this.recognition.onresult = (event) => {
+            if (SETTINGS.interimTyping) {
+                for (let i = event.resultIndex; i < event.results.length; i++) {
+                    const result = event.results[i];
+                    this.sendHypothesis(`${this.runId}:${i}`, result[0].transcript, result.isFinal);
                 }
+                return;
             }
 
-            async sendToPython(text) {
-                // Prevent rapid-fire requests
-                if (this.lastSentText === text && Date.now() - this.lastSentTime < 500) {
-                    console.log('Skipping duplicate text on client side');
-                    return;
-                }
-                
-                this.lastSentText = text;
-                this.lastSentTime = Date.now();
-                
-                try {
-                    const response = await fetch('/type', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ text: text })
-                    });
-                    
-                    const result = await response.json();
-                    if (result.status === 'skipped') {
-                        console.log('Server skipped text:', result.message);
-                    } else if (result.status !== 'success') {
-                        this.showError('Error sending text');
-                    }
-                } catch (error) {
-                    this.showError('Error sending text');
+            let finalTranscript = '';
+
+            for (let i = event.resultIndex; i < event.results.length; i++) {
+                const transcript = event.results[i][0].transcript;
+                if (event.results[i].isFinal) {
+                    finalTranscript += transcript;
                 }
             }
 
-            updateUI() {
-                document.getElementById('startBtn').disabled = this.isRecording;
-                document.getElementById('stopBtn').disabled = !this.isRecording;
+            if (finalTranscript) {
+                this.sendToPython(finalTranscript);
             }
+        };
+
+        this.recognition.onerror = (event) => {
+            this.showError(`Error: ${event.error}`);
+            this.stopRecording();
+        };
 
-            showStatus(message, type = 'ready') {
-                const status = document.getElementById('status');
-                status.textContent = message;
-                status.className = `status ${type}`;
+        this.recognition.onend = () => {
+            this.isRecording = false;
+            this.updateUI();
+            this.showStatus('Ready to dictate', 'ready');
+
+            // Restart recognition if it was supposed to be recording
+            if (this.shouldBeRecording) {
+                setTimeout(() => {
+                    if (this.shouldBeRecording) {
+                        this.startRecording();
+                    }
+                }, 100);
             }
+        };
+    }
 
-            showError(message) {
-                this.showStatus(message, 'error');
+    bindEvents() {
+        document.getElementById('startBtn').addEventListener('click', () => this.startRecording());
+        document.getElementById('stopBtn').addEventListener('click', () => {
+            // First stop listening; while text is still being typed, stop typing
+            if (this.isRecording) {
+                this.stopRecording();
+            } else {
+                this.cancelTyping();
             }
-            
-            quitServer() {
-                if (confirm('Quit VoiceWriter?')) {
-                    window.location.href = '/stop';
+        });
+        document.getElementById('quitBtn').addEventListener('click', () => this.quitServer());
+    }
+
+    startRecording() {
+        if (SETTINGS.serverRecognition) {
+            this.startAudio();
+            return;
+        }
+        if (!this.recognition) return;
+        this.shouldBeRecording = true;
+        try {
+            this.recognition.start();
+        } catch (error) {
+            this.showError('Error starting recognition');
+        }
+    }
+
+    stopRecording() {
+        this.shouldBeRecording = false;
+        if (this.audio) {
+            this.stopAudio();
+        } else if (this.recognition && this.isRecording) {
+            this.recognition.stop();
+        }
+    }
+
+    async startAudio() {
+        if (this.audio) return;
+        if (!this.socket || this.socket.readyState !== WebSocket.OPEN) {
+            this.showError('Server recognition needs server mode "threaded"');
+            return;
+        }
+        try {
+            const media = await navigator.mediaDevices.getUserMedia({
+                audio: { channelCount: 1, echoCancellation: true, noiseSuppression: true }
+            });
+            const context = new AudioContext({ sampleRate: SETTINGS.sampleRate });
+            await context.audioWorklet.addModule(SETTINGS.workletUrl);
+            // 100 ms of 16-bit PCM per binary frame
+            const node = new AudioWorkletNode(context, 'pcm-capture', {
+                processorOptions: { chunk: Math.round(context.sampleRate / 10) }
+            });
+            node.port.onmessage = (event) => {
+                if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+                    this.socket.send(event.data);
                 }
+            };
+            context.createMediaStreamSource(media).connect(node);
+            node.connect(context.destination);  // Outputs silence; keeps the node running
+            this.audio = { media, context, node };
+            this.socket.send(JSON.stringify({ type: 'audio', action: 'start', sampleRate: context.sampleRate }));
+            this.isRecording = true;
+            this.updateUI();
+            this.showStatus('Recording...', 'recording');
+        } catch (error) {
+            this.showError(`Error starting audio: ${error.message}`);
+        }
+    }
+
+    stopAudio() {
+        const audio = this.audio;
+        this.audio = null;
+        audio.node.port.onmessage = null;
+        audio.media.getTracks().forEach((track) => track.stop());
+        audio.context.close();
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            // The server still recognizes what was said before the stop
+            this.socket.send(JSON.stringify({ type: 'audio', action: 'stop' }));
+        }
+        this.isRecording = false;
+        this.updateUI();
+        this.showStatus('Ready to dictate', 'ready');
+    }
+
+    cancelTyping() {
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify({ type: 'cancel' }));
+        } else {
+            fetch('/cancel', { method: 'POST' }).catch(() => {});
+            this.typing.clear();
+            this.updateUI();
+        }
+    }
+
+    async sendToPython(text) {
+        // Repeated transcripts are filtered by the server's dedup cache
+        const frame = { type: 'transcript', id: this.nextFrameId++, text: text,
+                        session: this.session, n: this.nextN++ };
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify(frame));
+            return;
+        }
+
+        try {
+            const response = await fetch('/type', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(frame)
+            });
+
+            const result = await response.json();
+            if (result.status === 'skipped') {
+                console.log('Server skipped text:', result.message);
+            } else if (result.status !== 'queued' && result.status !== 'buffered') {
+                this.showError('Error sending text');
             }
+        } catch (error) {
+            this.showError('Error sending text');
         }
+    }
 
-        document.addEventListener('DOMContentLoaded', () => {
-            new VoiceWriter();
-        });
-    </script>
-</body>
-</html>'''
+    sendHypothesis(utterance, text, final) {
+        const frame = { type: 'transcript', id: this.nextFrameId++, utterance: utterance, text: text,
+                        final: final, session: this.session, n: this.nextN++ };
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify(frame));
+        } else {
+            // Separate fetches may arrive out of order; the server puts them back in order by n
+            fetch('/type', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(frame)
+            }).catch(() => this.showError('Error sending text'));
+        }
+    }
+
+    updateUI() {
+        document.getElementById('startBtn').disabled = this.isRecording;
+        document.getElementById('stopBtn').disabled = !this.isRecording && this.typing.size === 0;
+    }
+
+    showStatus(message, type = 'ready') {
+        const status = document.getElementById('status');
+        status.textContent = message;
+        status.className = `status ${type}`;
+    }
+
+    showError(message) {
+        this.showStatus(message, 'error');
+    }
+
+    quitServer() {
+        if (confirm('Quit VoiceWriter?')) {
+            window.location.href = '/stop';
+        }
+    }
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    new VoiceWriter();
+});
+'''
+
+UI_WORKLET_JS = '''// Runs on the audio thread: converts microphone samples to 16-bit PCM chunks
+class PcmCapture extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        this.chunk = options.processorOptions.chunk;
+        this.buffer = new Int16Array(this.chunk);
+        this.length = 0;
+    }
+
+    process(inputs) {
+        const channel = inputs[0][0];
+        if (channel) {
+            for (let i = 0; i < channel.length; i++) {
+                const sample = Math.max(-1, Math.min(1, channel[i]));
+                this.buffer[this.length++] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+                if (this.length === this.chunk) {
+                    // Hand the buffer over without copying
+                    this.port.postMessage(this.buffer.buffer, [this.buffer.buffer]);
+                    this.buffer = new Int16Array(this.chunk);
+                    this.length = 0;
+                }
+            }
+        }
+        return true;
+    }
+}
+
+registerProcessor('pcm-capture', PcmCapture);
+'''
+
+# One servable file held in memory, with precompressed variants
+Asset = collections.namedtuple('Asset', 'content_type body gzip brotli etag cache_control')
+
+def make_asset(content_type, body, cache_control='no-cache', compress=True):
+    """Precompute compressed variants and the ETag for an in-memory asset"""
+    compressed = gzip.compress(body, 9, mtime=0) if compress else None
+    compressed_br = brotli.compress(body) if brotli and compress else None
+    etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+    return Asset(content_type, body,
+                 compressed if compressed and len(compressed) < len(body) else None,
+                 compressed_br if compressed_br and len(compressed_br) < len(body) else None,
+                 etag, cache_control)
+
+def build_assets():
+    """Build the route table of everything the server will serve"""
+    immutable = 'public, max-age=31536000, immutable'
+    css = make_asset('text/css; charset=utf-8', UI_CSS.encode(), immutable)
+    js = make_asset('application/javascript; charset=utf-8', UI_JS.encode(), immutable)
+    worklet = make_asset('application/javascript; charset=utf-8', UI_WORKLET_JS.encode(), immutable)
+    # Content-hashed URLs let the browser cache CSS and JS forever
+    css_digest, js_digest = css.etag.strip('"'), js.etag.strip('"')
+    worklet_digest = worklet.etag.strip('"')
+    css_url = f"/app.{css_digest}.css"
+    js_url = f"/app.{js_digest}.js"
+    worklet_url = f"/worklet.{worklet_digest}.js"
+    html = (UI_HTML.replace('__CSS_URL__', css_url)
+                   .replace('__JS_URL__', js_url)
+                   .replace('__SETTINGS__', json.dumps(dict(page_settings(), workletUrl=worklet_url))))
+    page = make_asset('text/html; charset=utf-8', html.encode())
+    assets = {'/': page, '/voicewriter.html': page, css_url: css, js_url: js, worklet_url: worklet}
+    try:
+        with open(os.path.join(SCRIPT_DIR, 'icons', 'voice_writer_icon.png'), 'rb') as f:
+            # PNG is already compressed
+            assets['/favicon.png'] = make_asset('image/png', f.read(), 'public, max-age=86400',
+                                                compress=False)
+    except OSError:
+        pass
+    return assets
+
+# A complete, validated configuration. Derived objects (the compiled command
+# rules and vocabulary) live in the snapshot too, so swapping the module-level
+# `settings` is the only step needed to apply a new config.json. The
+# "vocabulary" section becomes `vocabulary_path` and the loaded `vocabulary`.
+Settings = collections.namedtuple(
+    'Settings', [name for name in CONFIG_DEFAULTS if name != 'vocabulary']
+                + ['rules', 'commands', 'vocabulary_path', 'vocabulary', 'stamp'])
+
+def file_stamp(path):
+    """Identity of a file's current contents for change detection; None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def validate_section(name, values, problems):
+    """Build one section record, replacing invalid or missing values with defaults"""
+    defaults = CONFIG_DEFAULTS[name]
+    minimums = CONFIG_MINIMUMS.get(name, {})
+    if not isinstance(values, dict):
+        problems.append(f"{name}: expected an object")
+        values = {}
+    fields = {}
+    for key, default in defaults.items():
+        value = values.get(key, default)
+        if isinstance(default, bool):
+            valid = isinstance(value, bool)
+        elif isinstance(default, (int, float)):
+            # Ints are fine for floats; no negative sizes or times anywhere
+            numeric = float if isinstance(default, float) else int
+            valid = (isinstance(value, (int, numeric)) and not isinstance(value, bool)
+                     and value >= minimums.get(key, 0))
+            value = numeric(value) if valid else value
+        else:
+            valid = isinstance(value, type(default))
+        if not valid:
+            problems.append(f"{name}.{key}: invalid value {value!r}, using {default!r}")
+            value = default
+        if isinstance(value, dict):
+            value = dict(value)  # Never share the defaults' dict between snapshots
+        fields[key] = value
+    for key in values:
+        if key not in defaults:
+            problems.append(f"{name}.{key}: unknown setting")
+    return SECTIONS[name](**fields)
+
+def read_config(path):
+    """The raw config.json object; {} when the file is missing, ValueError when it is not valid JSON"""
+    try:
+        with open(path, 'r') as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from None
+    if not isinstance(raw, dict):
+        raise ValueError(f"{path}: expected a JSON object")
+    return raw
+
+def load_settings(path=CONFIG_PATH, previous=None, raw=None):
+    """Read config.json (or use `raw`) into a new Settings snapshot.
+
+    The compiled commands and vocabulary of `previous` are reused when their
+    sources have not changed.
+    """
+    stamp = file_stamp(path)
+    if raw is None:
+        raw = read_config(path)
+    
+    problems = []
+    sections = {name: validate_section(name, raw.get(name, {}), problems) for name in CONFIG_DEFAULTS}
+    if sections['server'].mode not in SERVER_MODES:
+        problems.append(f"server.mode: unknown mode {sections['server'].mode!r}")
+    if sections['typing'].backend not in BACKENDS and sections['typing'].backend != 'auto':
+        problems.append(f"typing.backend: unknown backend {sections['typing'].backend!r}")
+    if sections['recognition'].engine != 'browser' and sections['recognition'].engine not in RECOGNIZERS:
+        problems.append(f"recognition.engine: unknown engine {sections['recognition'].engine!r}")
+    for name in raw:
+        if name not in CONFIG_DEFAULTS and name != 'commands':
+            problems.append(f"{name}: unknown section")
+    app_rates = sections['typing'].app_rates
+    for app, rate in list(app_rates.items()):
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate < 0:
+            problems.append(f"typing.app_rates.{app}: invalid rate {rate!r}")
+            del app_rates[app]
+    rules = raw.get('commands', {})
+    if not isinstance(rules, dict):
+        problems.append("commands: expected an object")
+        rules = {}
+    rules = dict(rules)
+    for phrase, spec in list(rules.items()):
+        if spec is None:
+            continue
+        try:
+            compile_rule(spec)
+        except ValueError as e:
+            problems.append(f"commands.{phrase}: {e}, rule skipped")
+            del rules[phrase]
+    for problem in problems:
+        print(f"⚠️  config.json: {problem}")
+    
+    if previous is not None and previous.rules == rules:
+        commands = previous.commands
+    else:
+        commands = CommandEngine.from_config({'commands': rules})
+    
+    # A relative vocabulary file is found next to config.json
+    vocabulary_path = os.path.join(os.path.dirname(path), sections.pop('vocabulary').file)
+    vocabulary_stamp = file_stamp(vocabulary_path)
+    if (previous is not None and previous.vocabulary_path == vocabulary_path
+            and previous.stamp[1] == vocabulary_stamp):
+        vocabulary = previous.vocabulary
+    else:
+        vocabulary = Vocabulary.load(vocabulary_path, CACHE_DIR)
+    
+    return Settings(rules=rules, commands=commands, vocabulary_path=vocabulary_path,
+                    vocabulary=vocabulary, stamp=(stamp, vocabulary_stamp), **sections)
+
+# Settings needing a restart to take effect
+RESTART_SETTINGS = [('server', 'port'), ('server', 'host'), ('server', 'mode'),
+                    ('typing', 'backend'), ('typing', 'queue_size'),
+                    ('recognition', 'engine'), ('recognition', 'model'), ('recognition', 'workers')]
+
+def reload_config(httpd=None):
+    """Load config.json and swap the new snapshot in, then hand it to the server.
+
+    An invalid file raises ValueError and leaves the current settings in place.
+    """
+    global settings
+    previous = settings
+    settings = load_settings(previous=previous)
+    if httpd is not None:
+        httpd.apply_settings(settings)
+    for section, key in RESTART_SETTINGS:
+        if getattr(getattr(previous, section), key) != getattr(getattr(settings, section), key):
+            print(f"ℹ️  {section}.{key} changes after a restart")
+    return settings
+
+class ConfigWatcher:
+    """Reloads the settings when config.json or the vocabulary file changes.
+
+    Polls the files' mtime, size and inode; that costs two stat() calls per
+    interval and works on every filesystem.
+    """
+
+    def __init__(self, httpd, interval=1.0):
+        self.httpd = httpd
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='config-watcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        seen = settings.stamp
+        while not self.stopped.wait(self.interval):
+            current = (file_stamp(CONFIG_PATH), file_stamp(settings.vocabulary_path))
+            if current == seen:
+                continue
+            seen = current
+            try:
+                reload_config(self.httpd)
+                print("🔄 Configuration reloaded")
+            except ValueError as e:
+                print(f"⚠️  Keeping the previous configuration: {e}")
+            except Exception as e:
+                # The watcher must outlive a bad edit; the next change is tried again
+                print(f"⚠️  Keeping the previous configuration: {type(e).__name__}: {e}")
+
+try:
+    settings = load_settings()
+except ValueError as e:
+    print(f"⚠️  Using the default configuration: {e}")
+    settings = load_settings(raw={})
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """One command per connection: a line `command [argument]`, answered with one JSON line"""
+
+    def handle(self):
+        line = self.rfile.readline(4096).decode(errors='replace').split(None, 1)
+        command = line[0] if line else ''
+        argument = line[1].strip() if len(line) > 1 else ''
+        action = self.server.commands.get(command)
+        if action is None:
+            reply = {'status': 'error', 'message': f"Unknown command: {command or '(none)'}",
+                     'commands': sorted(self.server.commands)}
+        else:
+            try:
+                reply = action(self.server.httpd, argument)
+            except Exception as e:
+                reply = {'status': 'error', 'message': str(e)}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+def control_stop(httpd, argument):
+    threading.Thread(target=httpd.shutdown, daemon=True).start()
+    return {'status': 'stopping', 'pid': os.getpid()}
+
+def control_status(httpd, argument):
+    typing_queue = httpd.typing_queue
+    return {'status': 'running', 'pid': os.getpid(),
+            'uptime': round(time.perf_counter() - START_TIME, 3),
+            'port': httpd.server_address[1], 'mode': type(httpd).__name__,
+            'backend': httpd.backend.name, 'queue_depth': typing_queue.depth(),
+            'typed_seq': typing_queue.typed_seq, 'sessions': len(httpd.sessions.sessions)}
+
+def control_reload_config(httpd, argument):
+    reload_config(httpd)
+    return {'status': 'reloaded', 'config': CONFIG_PATH}
+
+def control_routes(httpd, argument):
+    return {'status': 'ok', 'routes': httpd.typing_queue.router.snapshot()}
+
+def control_cancel(httpd, argument):
+    return dict(httpd.typing_queue.cancel(), status='cancelled')
+
+def runtime_path(name, argument=''):
+    """Where a trace or profile goes: `argument` if given, else `name`; relative to RUNTIME_DIR"""
+    return os.path.join(RUNTIME_DIR, os.path.expanduser(argument or name))
+
+def configure_debugging(debug):
+    """Start or stop tracing and profiling as the debug section says, saving what was collected"""
+    if debug.trace and not tracer.enabled:
+        tracer.start(max(1, debug.trace_events))
+        print("🔬 Tracing started")
+    elif tracer.enabled and not debug.trace:
+        tracer.stop()
+        path = runtime_path(debug.trace_file)
+        print(f"🔬 Trace saved to {path} ({tracer.dump(path)} events)")
+    if debug.profile_every != profiler.every:
+        if profiler.every:
+            path = runtime_path(debug.profile_file)
+            profiler.stop()
+            if profiler.dump(path):
+                print(f"🔬 Profile saved to {path}")
+        if debug.profile_every:
+            profiler.start(debug.profile_every)
+            print(f"🔬 Profiling 1 in {debug.profile_every} requests")
+
+def control_trace(httpd, argument):
+    """trace [start|stop|dump] [file]: record spans, and save them as Chrome trace JSON"""
+    action, _, path = argument.partition(' ')
+    path = runtime_path(settings.debug.trace_file, path.strip())
+    if action == 'start':
+        tracer.start(max(1, settings.debug.trace_events))
+        return {'status': 'tracing'}
+    if action in ('stop', 'dump'):
+        if action == 'stop':
+            tracer.stop()
+        return {'status': 'saved', 'file': path, 'events': tracer.dump(path)}
+    return {'status': 'tracing' if tracer.enabled else 'off', 'events': len(tracer.events)}
+
+def control_profile(httpd, argument):
+    """profile [start [N]|stop|dump] [file]: cProfile one in N requests and typing batches"""
+    action, _, rest = argument.partition(' ')
+    if action == 'start':
+        every = int(rest or 10)
+        if every < 1:
+            raise ValueError("profile start: N must be at least 1")
+        profiler.start(every)
+        return {'status': 'profiling', 'every': every}
+    if action in ('stop', 'dump'):
+        if action == 'stop':
+            profiler.stop()
+        path = runtime_path(settings.debug.profile_file, rest.strip())
+        return {'status': 'saved', 'file': path, 'samples': profiler.dump(path), 'top': profiler.top()}
+    return {'status': 'profiling' if profiler.every else 'off', 'every': profiler.every,
+            'samples': profiler.samples, 'top': profiler.top()}
+
+def control_undo(httpd, argument):
+    """undo [N]: erase the last N typed utterances, as saying "scratch that" N times would"""
+    count = int(argument or 1)
+    if count < 1:
+        raise ValueError("undo: N must be at least 1")
+    typing_queue = httpd.typing_queue
+    seq = typing_queue.undo(count)
+    if seq is None:
+        return {'status': 'error', 'message': 'Typing queue full'}
+    return {'status': typing_queue.wait(seq, 2.0), 'seq': seq}
+
+def control_sessions(httpd, argument):
+    """sessions [id]: ordering state and counters of every session, or of one"""
+    sessions = httpd.sessions.snapshot()
+    if argument:
+        if argument not in sessions:
+            raise ValueError(f"sessions: unknown session {argument}")
+        return dict(sessions[argument], status='ok', id=argument)
+    return {'status': 'ok', 'sessions': sessions}
+
+def control_flush(httpd, argument):
+    return {'status': 'flushed', 'dropped': httpd.typing_queue.flush()}
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket for local tools (stop.py, launch.sh) to drive a running instance.
+
+    Only the owning user can connect: the directory is 0700 and the socket 0600.
+    """
+    daemon_threads = True
+    commands = {
+        'stop': control_stop,
+        'status': control_status,
+        'reload-config': control_reload_config,
+        'flush': control_flush,
+        'cancel': control_cancel,
+        'routes': control_routes,
+        'trace': control_trace,
+        'profile': control_profile,
+        'undo': control_undo,
+        'sessions': control_sessions,
+    }
+
+    def __init__(self, httpd, path=CONTROL_SOCKET):
+        self.httpd = httpd
+        self.path = path
+        private_dir(os.path.dirname(path))
+        try:
+            os.unlink(path)  # Left over from an instance that died without cleaning up
+        except FileNotFoundError:
+            pass
+        super().__init__(path, ControlHandler)
+        os.chmod(path, 0o600)
+        self.inode = os.stat(path).st_ino
+
+    def server_close(self):
+        super().server_close()
+        try:
+            # Leave the socket alone if a newer instance has replaced it
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+def write_pid_file():
+    private_dir(RUNTIME_DIR)
+    tmp_path = f"{PID_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(f"{os.getpid()}\n")
+    os.replace(tmp_path, PID_FILE)
+
+def remove_pid_file():
+    # A newer instance may already have written its own PID
+    if read_pid_file() == os.getpid():
+        try:
+            os.unlink(PID_FILE)
+        except FileNotFoundError:
+            pass
+
+class StartupTimer:
+    """Phase-by-phase timing of startup, up to the point the server is ready"""
+
+    def __init__(self, start=START_TIME):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        """Close the current phase"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        phases = ', '.join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in self.phases)
+        print(f"⏱️  Ready in {(self.last - self.start) * 1000:.0f} ms ({phases})")
+
+# Commands that prove each external tool actually runs
+DEPENDENCY_PROBES = {
+    'xdotool': ['xdotool', '--version'],
+    'xclip': ['xclip', '-version'],
+}
+
+def probe_dependencies(names, use_cache=True):
+    """Return the tools that are missing or broken.
+
+    A successful probe is cached keyed on the binary's path, size and mtime,
+    so later starts skip the subprocess until the binary changes.
+    """
+    cache_path = os.path.join(CACHE_DIR, 'probe.json')
+    cache = {}
+    if use_cache:
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+    
+    missing = []
+    changed = False
+    for name in names:
+        path = shutil.which(name)
+        if not path:
+            missing.append(name)
+            continue
+        stat = os.stat(path)
+        key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        if cache.get(name) == key:
+            continue
+        try:
+            subprocess.run(DEPENDENCY_PROBES[name], capture_output=True, check=True, timeout=5)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            missing.append(name)
+            continue
+        cache[name] = key
+        changed = True
+    
+    if use_cache and changed:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return missing
+
+def request_handoff(port):
+    """Ask the VoiceWriter on a port to shut down; False if nothing there agrees to"""
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+        conn.request('POST', '/handoff', b'')
+        response = conn.getresponse()
+        reply = json.loads(response.read() or b'{}')
+        conn.close()
+        return reply.get('status') == 'stopping'
+    except (OSError, ValueError, http.client.HTTPException):
+        return False
+
+def bind_server(mode, port, backend, timeout=3.0):
+    """Bind the server, taking the port over from a running instance if needed"""
+    try:
+        return create_server(mode, ("", port), backend)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
     
-    with open('voicewriter.html', 'w') as f:
-        f.write(html)
+    print(f"🔄 Port {port} is in use. Asking the running instance to hand over...")
+    if not request_handoff(port):
+        raise OSError(errno.EADDRINUSE, f"Port {port} is in use by another program")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return create_server(mode, ("", port), backend)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or time.time() > deadline:
+                raise
+            time.sleep(0.02)
+
+def legacy_takeover(port):
+    """Stop whatever holds the port with lsof/pkill (used when fast_start is off)"""
+    try:
+        result = subprocess.run(['lsof', f'-ti:{port}'], capture_output=True, text=True)
+        if result.returncode == 0 and result.stdout.strip():
+            print(f"🔄 Port {port} is in use. Stopping existing process...")
+            subprocess.run(['pkill', '-f', 'voicewriter.py'], capture_output=True)
+            time.sleep(2)  # Wait for process to stop
+    except:
+        pass
 
 def main():
     """Main function"""
+    timer = StartupTimer()
+    timer.mark('import')
+    
     # Get version
     try:
-        with open('VERSION', 'r') as f:
+        with open(os.path.join(SCRIPT_DIR, 'VERSION'), 'r') as f:
             version = f.read().strip()
     except FileNotFoundError:
         version = "unknown"
@@ -428,87 +4339,105 @@ def main():
     print(f"Version: {version}")
     print("=" * 50)
     
+    # Get configuration
+    port = settings.server.port
+    host = settings.server.host
+    mode = settings.server.mode
+    backend_name = settings.typing.backend
+    fast_start = settings.startup.fast_start
+    auto_close = settings.ui.auto_close
+    
     # Check dependencies
-    try:
-        subprocess.run(['xdotool', '--version'], capture_output=True, check=True)
-        subprocess.run(['xclip', '-version'], capture_output=True, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if backend_name == 'fake' or (backend_name in ('auto', 'xtest') and xtest_usable()):
+        needed = []  # Typing, focus and clipboard all stay in-process
+    else:
+        needed = ['xdotool', 'xclip']
+    missing = probe_dependencies(needed, use_cache=fast_start)
+    if missing:
         print("❌ Missing dependencies. Install with:")
-        print("   sudo apt install xdotool xclip")
+        print(f"   sudo apt install {' '.join(missing)}")
         return
+    timer.mark('probe')
     
-    # Get server configuration
-    server_config = config.get('server', {})
-    port = server_config.get('port', 8000)
-    host = server_config.get('host', 'localhost')
-    
-    # Check if port is already in use
+    # The control socket and PID file must not live where another user can reach them
     try:
-        result = subprocess.run(['lsof', f'-ti:{port}'], capture_output=True, text=True)
-        if result.returncode == 0 and result.stdout.strip():
-            print(f"🔄 Port {port} is in use. Stopping existing process...")
-            subprocess.run(['pkill', '-f', 'voicewriter.py'], capture_output=True)
-            time.sleep(2)  # Wait for process to stop
-    except:
-        pass
+        private_dir(RUNTIME_DIR)
+    except OSError as e:
+        print(f"❌ {e}")
+        return
     
-    # Create HTML file
-    create_html()
+    # Create the typing backend once for the whole session
+    try:
+        backend = create_backend(backend_name)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+    timer.mark('backend')
     
     # Start server
-    socketserver.TCPServer.allow_reuse_address = True
+    try:
+        if fast_start:
+            if stop_running_instance():
+                print("🔄 Stopped the running instance")
+            httpd = bind_server(mode, port, backend)
+        else:
+            legacy_takeover(port)
+            httpd = create_server(mode, ("", port), backend)
+    except (ValueError, OSError) as e:
+        print(f"❌ {e}")
+        if isinstance(e, OSError):
+            print("   Try running ./stop.py")
+        backend.close()
+        return
+    timer.mark('bind')
+    
+    # Local control socket for stop.py and launch.sh
+    try:
+        control = ControlServer(httpd)
+        threading.Thread(target=control.serve_forever, args=(0.1,), daemon=True).start()
+        write_pid_file()
+    except OSError as e:
+        print(f"⚠️  Control socket unavailable: {e}")
+        control = None
+    
+    # Apply edits to config.json and the vocabulary file while running
+    watcher = ConfigWatcher(httpd)
+    watcher.start()
     
-    with socketserver.TCPServer(("", port), VoiceWriterHandler) as httpd:
-        print(f"🌐 Server started at http://{host}:{port}")
+    # Start the typist process now rather than on the first utterance
+    threading.Thread(target=backend.warm_up, daemon=True).start()
+    
+    with httpd:
+        print(f"🌐 Server started at http://{host}:{port} ({mode} mode)")
+        print(f"⌨️  Typing backend: {backend.name}")
         print("📱 Opening browser...")
         print("Press Ctrl+C or click Quit to stop")
-        print("🔄 Server will auto-close when browser closes")
+        if auto_close:
+            print("🔄 Server will auto-close when browser closes")
         
         # Open browser
-        browser_process = None
         try:
-            webbrowser.open('http://localhost:8000/voicewriter.html')
+            webbrowser.open(f'http://{host}:{port}/voicewriter.html')
         except:
             pass
+        timer.mark('browser')
+        timer.report()
         
-        # Start browser monitoring thread - optimized
-        def monitor_browser():
-            import time
-            import psutil
-            
-            # Track if we've seen any browser connections
-            has_seen_connection = False
-            consecutive_failures = 0
+        # Shut down once the page is gone; liveness is tracked by the server itself
+        if auto_close:
+            def monitor_browser():
+                httpd.liveness.wait_until_gone()
+                print("🔄 Browser closed, shutting down...")
+                httpd.shutdown()
             
-            while True:
-                time.sleep(5)  # Increased interval for better performance
-                try:
-                    # Use more efficient connection check
-                    result = subprocess.run(['ss', '-tuln', 'sport = :8000'], 
-                                          capture_output=True, text=True, timeout=2)
-                    
-                    if 'ESTABLISHED' in result.stdout:
-                        has_seen_connection = True
-                        consecutive_failures = 0
-                    elif has_seen_connection and 'ESTABLISHED' not in result.stdout:
-                        consecutive_failures += 1
-                        if consecutive_failures >= 2:  # Wait for 2 consecutive checks
-                            print("🔄 Browser connection lost, shutting down...")
-                            httpd.shutdown()
-                            break
-                        
-                except Exception as e:
-                    consecutive_failures += 1
-                    if consecutive_failures >= 3:  # More lenient for errors
-                        print("🔄 Browser monitoring failed, shutting down...")
-                        httpd.shutdown()
-                        break
-        
-        browser_thread = threading.Thread(target=monitor_browser, daemon=True)
-        browser_thread.start()
+            browser_thread = threading.Thread(target=monitor_browser, daemon=True)
+            browser_thread.start()
         
         try:
-            httpd.serve_forever()
+            # A short poll interval lets a handoff release the port quickly
+            httpd.serve_forever(poll_interval=0.1)
+            if httpd.handed_off:
+                print("✅ Handed over to the new instance")
         except KeyboardInterrupt:
             print("\n🛑 Stopped by user")
         except Exception as e:
@@ -516,6 +4445,13 @@ def main():
         finally:
             print("🧹 Cleaning up...")
             try:
+                watcher.stop()
+                # Save any trace or profile still being collected
+                configure_debugging(settings.debug._replace(trace=False, profile_every=0))
+                if control:
+                    control.shutdown()
+                    control.server_close()
+                    remove_pid_file()
                 httpd.shutdown()
                 httpd.server_close()
                 print("✅ Server cleanup completed")